@@ -0,0 +1,144 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import time
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger('create_map.batch')
+
+def parse_batch_args(args=None):
+    """
+    Parse command line arguments for batch mode (create_map.py --batch requests.jsonl --workers N).
+    """
+    parser = argparse.ArgumentParser(description="Process a JSONL file of map requests")
+    parser.add_argument("--batch", type=str, help="JSONL file with one request per line", required=True)
+    parser.add_argument("--workers", type=int, help="Number of worker processes", default=os.cpu_count() or 1)
+
+    if args is None:
+        args = sys.argv[1:]
+
+    return parser.parse_args(args)
+
+def request_to_argv(request: Dict[str, Any]):
+    """
+    Converts a request dict into command line arguments.
+
+    The dict either holds the arguments by name (as in conf.json) or the recorded
+    command line under "args" (as in the stored errors).
+    """
+    if 'args' in request:
+        argv = list(request['args'])
+        # Stored errors include the script name
+        if len(argv) > 0 and not argv[0].startswith('--'):
+            argv = argv[1:]
+        return argv
+
+    argv = []
+    for key, value in request.items():
+        # conf.json uses the name of the request field
+        if key == 'reamulation_layers':
+            key = 'reambulation_layers'
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        elif isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        argv += [f'--{key}', str(value)]
+    return argv
+
+def percentile(values: list[float], p: float):
+    """
+    Nearest-rank percentile of the values.
+    """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(len(values) * p / 100 + 0.5) - 1))]
+
+# Start times of the requests (time.time(), NaN until started), shared with the worker processes
+request_starts = None
+
+def init_batch_worker(starts):
+    global request_starts
+    request_starts = starts
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+def run_timed_request(run_request: Callable[[list[str]], dict], argv: list[str], index: int):
+    """
+    Runs a single request in a worker process and records when it started,
+    so the latency of a request whose worker dies can still be reported.
+    """
+    request_starts[index] = time.time()
+    return run_request(argv)
+
+def print_line(tag: str, data: dict):
+    print(f'{tag}: {json.dumps(data)}', flush=True)
+
+def run_batch(run_request: Callable[[list[str]], dict], batch_file: str, workers: int):
+    """
+    Runs all requests from the batch file on a pool of worker processes.
+
+    Worker processes are reused between requests, so imports and in-process state stay warm,
+    and all requests share the cache in their output folder. A RESULT line is printed for every
+    request as it finishes and a SUMMARY line with throughput and latency percentiles at the end.
+
+    Parameters
+    ----------
+    run_request : callable
+        Picklable function that runs a single request from its command line arguments
+        and returns its result dict (with status and latency_s).
+    """
+    start = time.monotonic()
+    results = []
+
+    requests = []
+    with open(batch_file, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if line == '':
+                continue
+            try:
+                requests.append((line_no, request_to_argv(json.loads(line))))
+            except (ValueError, TypeError, AttributeError) as e:
+                result = {'line': line_no, 'status': 'error', 'error': f'Invalid request: {e}', 'latency_s': 0.0}
+                results.append(result)
+                print_line('RESULT', result)
+
+    starts = multiprocessing.Array('d', [math.nan] * max(len(requests), 1), lock=False)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker, initargs=(starts,)) as executor:
+        futures = {executor.submit(run_timed_request, run_request, argv, i): (i, line_no) for i, (line_no, argv) in enumerate(requests)}
+
+        logger.info(f'Running {len(futures)} requests on {workers} workers.')
+        for future in concurrent.futures.as_completed(futures):
+            i, line_no = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker itself failed (eg. it was killed), the latency is measured from the start of the request
+                latency = time.time() - starts[i] if not math.isnan(starts[i]) else 0.0
+                result = {'status': 'error', 'error': f'{type(e).__name__}: {e}', 'latency_s': latency}
+            result = {'line': line_no, **result}
+            results.append(result)
+            print_line('RESULT', result)
+
+    wall_time = time.monotonic() - start
+    latencies = [r['latency_s'] for r in results if r['status'] == 'ok']
+    summary = {
+        'requests': len(results),
+        'ok': sum(1 for r in results if r['status'] == 'ok'),
+        'failed': sum(1 for r in results if r['status'] != 'ok'),
+        'workers': workers,
+        'wall_time_s': round(wall_time, 3),
+        'throughput_rps': round(len(results) / wall_time, 3) if wall_time > 0 else None,
+        'latency_p50_s': percentile(latencies, 50),
+        'latency_p90_s': percentile(latencies, 90),
+        'latency_p99_s': percentile(latencies, 99),
+    }
+    print_line('SUMMARY', summary)
+    return summary
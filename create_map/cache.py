@@ -0,0 +1,212 @@
+import contextlib
+import logging
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger('create_map.cache')
+
+# Temporary files of the writes in progress, see remove_pending_writes
+_pending_writes = set()
+# Reference files of the cached files this process uses, see acquire
+_references = {}
+
+class FileLock:
+    """
+    Exclusive lock on a lock file, shared between processes and threads.
+    Blocks until the lock is acquired.
+
+    With remove the lock file is removed when the lock is released, so one-off lock files
+    (eg. one per cached file) do not pile up.
+    """
+    def __init__(self, path: str, remove: bool = False):
+        self.path = path
+        self.remove = remove
+        self._f = None
+
+    def _is_current(self):
+        """
+        Whether the locked file is still the lock file at the path (and was not removed by the previous holder).
+        """
+        try:
+            return os.stat(self.path).st_ino == os.fstat(self._f.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+    def __enter__(self):
+        while True:
+            self._f = open(self.path, 'a+b')
+            if fcntl is not None:
+                fcntl.flock(self._f.fileno(), fcntl.LOCK_EX)
+                if self._is_current():
+                    break
+                # The previous holder removed the lock file while we were waiting, lock the new one
+                self._f.close()
+                continue
+            self._f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds, keep waiting
+                    continue
+            break
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if fcntl is not None:
+                if self.remove:
+                    # Removed while still locked, processes waiting on the removed file retry on a new one
+                    with contextlib.suppress(OSError):
+                        os.remove(self.path)
+                fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+            else:
+                self._f.seek(0)
+                msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._f.close()
+            self._f = None
+        if self.remove and fcntl is None:
+            # Windows can not remove open files, this fails if another process opened the lock file in the meantime
+            with contextlib.suppress(OSError):
+                os.remove(self.path)
+
+@contextlib.contextmanager
+def atomic_path(fn: str):
+    """
+    Returns the path of a temporary file next to fn and renames it to fn once it is written
+    (for writers that open the file themselves, eg. GDAL), see atomic_write.
+    """
+    tmp_fn = f'{fn}.{os.getpid()}.{threading.get_ident()}.tmp'
+    _pending_writes.add(tmp_fn)
+    try:
+        yield tmp_fn
+        os.replace(tmp_fn, fn)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        _pending_writes.discard(tmp_fn)
+
+@contextlib.contextmanager
+def atomic_write(fn: str, mode: str = 'wb'):
+    """
+    Opens a temporary file next to fn and renames it to fn once it is written,
+    so readers never see a partially written file.
+    """
+    with atomic_path(fn) as tmp_fn:
+        with open(tmp_fn, mode) as f:
+            yield f
+
+def remove_pending_writes():
+    """
+    Removes the temporary files of unfinished writes, before the process exits without unwinding them.
+    """
+    for tmp_fn in list(_pending_writes):
+        try:
+            os.remove(tmp_fn)
+        except OSError:
+            pass
+
+@contextlib.contextmanager
+def single_flight(cache_fn: str, use_cache: bool = True):
+    """
+    Deduplicates concurrent work on the same cached file.
+
+    Yields True if the cached file can be used. Otherwise yields False while holding a lock
+    for the file, so the caller creates it while other processes asking for the same file
+    wait and then use the result instead of creating it again.
+    """
+    if use_cache and os.path.exists(cache_fn):
+        yield True
+        return
+
+    with FileLock(f'{cache_fn}.lock', remove=True):
+        # Another process may have created the file while we were waiting
+        yield use_cache and os.path.exists(cache_fn)
+
+def _try_lock(f):
+    """
+    Locks the open file without waiting, returns False if another process holds the lock.
+    """
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+def acquire(cache_fn: str):
+    """
+    Registers that this process uses the cached file (eg. memory maps it), so it is not evicted
+    until release_all is called. The reference is a locked file in {cache_fn}.refs, the lock is
+    released by the OS even if the process is killed, so references can not leak.
+    """
+    ref_fn = os.path.join(f'{cache_fn}.refs', f'{os.getpid()}.ref')
+    if ref_fn in _references:
+        return
+    while True:
+        os.makedirs(os.path.dirname(ref_fn), exist_ok=True)
+        try:
+            f = open(ref_fn, 'a+b')
+            break
+        except FileNotFoundError:
+            # The empty references folder was removed by eviction in the meantime
+            continue
+    if not _try_lock(f):
+        # Another process holds a reference with the same name (eg. the same pid in another container),
+        # do not take over (and later remove) its reference
+        f.close()
+        logger.warning(f'Could not lock the reference {ref_fn}, the cached file may be evicted while in use.')
+        return
+    _references[ref_fn] = f
+
+def release_all():
+    """
+    Releases the references of this process (not the ones inherited by a forked process).
+    """
+    suffix = f'{os.sep}{os.getpid()}.ref'
+    for ref_fn in [ref_fn for ref_fn in _references if ref_fn.endswith(suffix)]:
+        _references.pop(ref_fn).close()
+        try:
+            os.remove(ref_fn)
+        except OSError:
+            pass
+
+def get_reference_count(cache_fn: str):
+    """
+    Number of processes using the cached file, the references of exited processes are removed.
+    """
+    refs_dir = f'{cache_fn}.refs'
+    if not os.path.exists(refs_dir):
+        return 0
+
+    count = 0
+    for fn in os.listdir(refs_dir):
+        ref_fn = os.path.join(refs_dir, fn)
+        if ref_fn in _references:
+            count += 1
+            continue
+        try:
+            f = open(ref_fn, 'a+b')
+        except OSError:
+            continue
+        with f:
+            if not _try_lock(f):
+                count += 1
+                continue
+        try:
+            os.remove(ref_fn)
+        except OSError:
+            pass
+    return count
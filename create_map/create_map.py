@@ -20,19 +20,44 @@ import hashlib
 import numpy as np
 import logging
 import contextily
-import xyzservices
+import mercantile
+import tile_store
 import dto
 import img2pdf
 import requests
-from progress import ProgressTracker, NoProgress, ProgressError
+from progress import ProgressTracker, NoProgress, ProgressError, ProgressCancelled, CancellationToken
 import matplotlib.pyplot as plt
 import matplotlib
 import itertools
 matplotlib.use('Agg')  # Use non-interactive backend
 import io
 from matplotlib.ticker import MaxNLocator
+import struct
+import zlib
+import zipfile
+import concurrent.futures
+import multiprocessing
+import time
+import signal
 import shutil
-from typing import Optional
+import threading
+import batch
+import scheduler
+import stages
+import prefetch
+import cache
+import estimate
+import resample
+import reproject
+import geotiff
+import png_encoder
+import metrics
+from typing import Callable, Optional
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
 
 ### STATIC CONFIGURATION ###
 
@@ -40,7 +65,27 @@ from typing import Optional
 INPUT_CONTEXT = None # Set path to error json file to reproduce the error
 USE_CACHE = True
 TARGET_DPI = 318
+RENDER_STRIP_MAX_BYTES = 64 * 1024 * 1024 # Working memory of the raster resampling and control point overlay done strip by strip (the map canvas itself is one full image)
 PDF_AUTHOR = 'Topograf - topograf.scuke.si'
+LOG_RESOURCE_ESTIMATE = False # Estimate every request before running it and log the estimate next to the measured resource usage (validate with estimate_check.py)
+PNG_PALETTE = True # Save RGB output images with few colors as 8-bit palette PNG (falls back to RGB)
+PNG_PALETTE_MAX_ERROR = 2.0 # Mean error per channel (0-255) allowed when the image has more than 256 colors and the palette is approximated
+CANCEL_POLL_S = 0.2 # How often the cancellation sentinel file ({OUTPUT_DIR}/cancel/{id}) is checked
+CANCEL_GRACE_S = 0.5 # Time a cancelled request has to stop on its own before the process exits (eg. inside a long native call)
+RASTER_CACHE_MAX_BYTES = 8 * 1024 * 1024 * 1024 # Size of the cached raster mosaics before the least recently used ones (not in use) are evicted
+RASTER_CACHE_EVICT_RATIO = 0.8 # Evict mosaics until the cache is at this fraction of the maximum size
+REAMBULATION_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024 # Size of the cached reambulation layer windows before the least recently used ones are evicted
+REAMBULATION_CACHE_EVICT_RATIO = 0.8 # Evict layer windows until the cache is at this fraction of the maximum size
+RASTER_CACHE_BLOCK_M = { # Cached mosaics are snapped outward to a grid of blocks of this size (meters, a multiple of the source pixels)
+    dto.RasterType.DTK50: 2000,
+    dto.RasterType.DTK25: 1000,
+    dto.RasterType.DTK10: 500,
+    dto.RasterType.DTK5: 250,
+    dto.RasterType.OSM: 1000,
+    dto.RasterType.OTM: 2000,
+}
+RASTER_CACHE_MARGIN = 0.2 # Fraction of the size of the requested area also cached on every side, so the area moved or resized a little is cropped from the same mosaic
+RASTER_CACHE_MARGIN_MAX_M = 2000 # Largest margin on every side (large areas, eg. atlases)
 
 # Map settings
 GRID_MARGIN_M = [0.011, 0.0141, 0.0195, 0.0143] # Margin around the A4 paper in meters [top, right, bottom, left]
@@ -51,6 +96,11 @@ CP_REPORT_PAGE_MARGIN_M = (0.012, 0.017, 0.012, 0.017) # Margin around the A4 pa
 CP_REPORT_GRID_SIZE = (2, 6) # 2x6 grid
 CP_REPORT_PREVIEW_SIZE_RADIUS_M = 300 # Radius of the preview image in meters
 
+# Atlas settings
+ATLAS_MAX_PAGES = 24 # Maximum number of pages in one atlas
+ATLAS_MAX_FILES = 16 # Maximum number of raster files merged for the whole atlas
+ATLAS_MAX_WORKERS = None # Number of processes rendering the pages (None uses all cores)
+
 ### /STATIC CONFIGURATION ###
 
 # Setup logging
@@ -87,41 +137,42 @@ def get_raster_map_bounds(raster_folder: str, pt: ProgressTracker = NoProgress):
     folder_hash = get_cache_index({'raster_folder': os.path.abspath(raster_folder)})
     bounds_cache_fn = os.path.join(get_cache_dir('tile_bounds'), f'{folder_hash}-bounds-cache.json')
 
-    if os.path.exists(bounds_cache_fn) and USE_CACHE:
-        with open(bounds_cache_fn, 'r') as f:
-            pt.step(0.9)
-            bounds = json.load(f)
-            pt.step(1)
-            logger.info(f'Using cached raster bounds. - ({folder_hash})')
-            return bounds
-
-    raster_files = [f for f in os.listdir(raster_folder) if f.endswith(".tif")]
-    bounds = {}
-    for filename in pt.over_range(0.1, 0.9, raster_files):
-        fp = os.path.join(raster_folder, filename)
-        with rasterio.open(fp) as src:
-            bounds[filename] = [*src.bounds]
-
-    with open(bounds_cache_fn, 'w') as f:
-        json.dump(bounds, f)
+    with cache.single_flight(bounds_cache_fn, USE_CACHE) as cached:
+        if cached:
+            with open(bounds_cache_fn, 'r') as f:
+                pt.step(0.9)
+                bounds = json.load(f)
+                pt.step(1)
+                logger.info(f'Using cached raster bounds. - ({folder_hash})')
+                metrics.cache_lookup('raster_bounds', True, os.path.getsize(bounds_cache_fn))
+                return bounds
+
+        raster_files = [f for f in os.listdir(raster_folder) if f.endswith(".tif")]
+        bounds = {}
+        for filename in pt.over_range(0.1, 0.9, raster_files):
+            fp = os.path.join(raster_folder, filename)
+            with rasterio.open(fp) as src:
+                bounds[filename] = [*src.bounds]
+
+        with cache.atomic_write(bounds_cache_fn, 'w') as f:
+            json.dump(bounds, f)
+        metrics.cache_lookup('raster_bounds', False, os.path.getsize(bounds_cache_fn))
 
     pt.step(1)
     logger.info(f'Discovered raster bounds. - ({folder_hash})')
     return bounds
 
-def get_raster_map_tiles(tiles_url: str, zoom_adjust: int, max_zoom: int, bounds: tuple[float], pt: ProgressTracker = NoProgress):
+def get_tiles_max_zoom(raster_type: dto.RasterType):
+    return {
+        'osm': 19,
+        'otm': 15,
+    }.get(raster_type, 19)
+
+def get_tiles_zoom(bounds: tuple[float], zoom_adjust: int, max_zoom: int, target_resolution: Optional[float] = None):
     """
-    Gets the raster map from a tile server.
-    
-    Parameters
-    ----------
-    tiles_url : str
-        The URL of the tile server.
-    bounds : tuple (west, south, east, north)
-        The bounds of the area to be merged. EPSG:3794
+    Returns the zoom level of the tiles for the bounds (EPSG:3794) and the bounds in EPSG:3857 and WGS84.
+    See get_raster_map_tiles.
     """
-    pt.step(0)
-
     crs_from = pyproj.CRS.from_epsg(3794)
     crs_to = pyproj.CRS.from_epsg(3857)
     transformer = pyproj.Transformer.from_crs(crs_from, crs_to)
@@ -140,15 +191,45 @@ def get_raster_map_tiles(tiles_url: str, zoom_adjust: int, max_zoom: int, bounds
         max(c[1] for c in corners)
     ]
 
+    bounds_wgs84 = (*mercantile.lnglat(*bounds_3857[:2]), *mercantile.lnglat(*bounds_3857[2:]))
+    if target_resolution is not None:
+        lat = (bounds_wgs84[1] + bounds_wgs84[3]) / 2
+        zoom = tile_store.get_zoom_for_resolution(target_resolution, lat, zoom_adjust, max_zoom)
+        logger.info(f'Using zoom level {zoom} ({tile_store.get_resolution(zoom, lat):.2f} m/px for {target_resolution:.2f} m/px output, zoom adjustment of {zoom_adjust})')
+    else:
+        zoom = tile_store.get_zoom(bounds_wgs84, zoom_adjust, max_zoom)
+        logger.info(f'Using zoom level {zoom} (zoom adjustment of {zoom_adjust})')
+
+    return zoom, bounds_3857, bounds_wgs84
+
+def get_raster_map_tiles(tiles_url: str, zoom_adjust: int, max_zoom: int, bounds: tuple[float], pt: ProgressTracker = NoProgress, target_resolution: Optional[float] = None, zoom: Optional[int] = None):
+    """
+    Gets the raster map from a tile server.
+    
+    Parameters
+    ----------
+    tiles_url : str
+        The URL of the tile server.
+    bounds : tuple (west, south, east, north)
+        The bounds of the area to be merged. EPSG:3794
+    target_resolution : float, optional
+        Ground resolution of the output in meters per pixel, used to pick the zoom level.
+        Without it the zoom level is picked from the size of the bounds.
+    zoom : int, optional
+        Zoom level of the tiles, instead of picking it.
+    """
+    pt.step(0)
+    tiles_zoom, bounds_3857, bounds_wgs84 = get_tiles_zoom(bounds, zoom_adjust, max_zoom, target_resolution)
+    zoom = tiles_zoom if zoom is None else zoom
+
     # Get the tiles
     logger.info(f'Getting raster map tiles. - ({bounds_3857})')
     try:
-        # Download the tiles
+        # Download the tiles (or take them from the tile store)
         pt.step(0.1)
-        source = xyzservices.TileProvider(url=tiles_url, attribution="", name="url", max_zoom=max_zoom)
-        contextily.set_cache_dir(get_cache_dir('tiles'))
-        logger.info(f'Using zoom adjustment of {zoom_adjust}')
-        mosaic_web, extent_web = contextily.bounds2img(*bounds_3857, source=source, zoom_adjust=zoom_adjust)
+        with tile_store.TileStore.open(tiles_url, get_cache_dir('tiles')) as store:
+            mosaic_web, extent_web = store.get_mosaic(bounds_wgs84, zoom, pt.sub(0.1, 0.6))
+            store.evict()
         # Warp the tiles to EPSG:3794
         pt.step(0.6)
         mosaic_d96, extent_d96 = contextily.warp_tiles(mosaic_web, extent_web, 'EPSG:3794', rasterio.enums.Resampling.lanczos)
@@ -188,12 +269,173 @@ def get_raster_map_tiles(tiles_url: str, zoom_adjust: int, max_zoom: int, bounds
             raise ProgressError(f'Rasterski strežnik ne more pokriti željenega območja') from e
         
         raise ProgressError(f'Napaka pri pridobivanju podatkov iz strežnika: {e}') from e
+    except ProgressError:
+        # Cancellation (and errors that already have a message) pass through unchanged
+        raise
     except Exception as e:
         raise ProgressError(f'Napaka pri pridobivanju podatkov iz strežnika') from e
 
-def get_raster_map(raster_type: dto.RasterType, raster_folder: str, zoom_adjust: int, bounds: tuple[float], pt: ProgressTracker = NoProgress):
+def get_raster_epsg(raster_type: dto.RasterType):
+    """
+    Returns the EPSG code of the coordinate system the local raster files are stored in.
+    """
+    if raster_type == dto.RasterType.DTK25 or \
+       raster_type == dto.RasterType.DTK10 or \
+       raster_type == dto.RasterType.DTK5:
+        return 3912
+    elif raster_type == dto.RasterType.DTK50:
+        return 3794
+    else:
+        raise ProgressError('Neveljaven tip osnove za karto')
+
+def get_raster_source_key(raster_type: dto.RasterType, raster_folder: str, zoom_adjust: int, bounds: tuple[float], target_resolution: Optional[float] = None):
+    """
+    Returns the hash of everything the cached mosaics of the raster depend on except their bounds,
+    and the zoom level of the tiles (None for raster files). See get_raster_mosaic.
+    """
+    zoom = None
+    if raster_folder.startswith('https://'):
+        # Mosaics of a tile server only differ by the zoom level of their tiles
+        zoom, _, _ = get_tiles_zoom(bounds, zoom_adjust, get_tiles_max_zoom(raster_type), target_resolution)
+        cache_key = {'raster_type': raster_type.value, 'raster_folder': raster_folder, 'zoom': zoom}
+    else:
+        # Raster files are always merged at their own resolution
+        cache_key = {'raster_type': raster_type.value, 'raster_folder': os.path.abspath(raster_folder)}
+    return get_cache_index(cache_key), zoom
+
+def get_raster_cache_fn(source_hash: str, cache_bounds: tuple[float]):
+    """
+    Returns the cache file of the mosaic of the source (see get_raster_source_key) covering cache_bounds.
+    The bounds are part of the file name, so find_cached_raster can find mosaics covering other bounds.
+    """
+    return os.path.join(get_cache_dir('raster'), f'{source_hash}_' + '_'.join(f'{b:.2f}' for b in cache_bounds) + '.npy')
+
+def find_cached_raster(source_hash: str, bounds: tuple[float]):
+    """
+    Returns the cache file and the bounds of the smallest cached mosaic of the source that covers the bounds, or None.
+    """
+    found = None
+    prefix = f'{source_hash}_'
+    for fn in os.listdir(get_cache_dir('raster')):
+        if not fn.startswith(prefix) or not fn.endswith('.npy'):
+            continue
+        try:
+            cache_bounds = tuple(float(b) for b in fn[len(prefix):-len('.npy')].split('_'))
+        except ValueError:
+            continue
+        if len(cache_bounds) != 4:
+            continue
+        # The bounds in the file name are rounded to centimeters
+        if cache_bounds[0] > bounds[0] + 0.01 or cache_bounds[1] > bounds[1] + 0.01 or cache_bounds[2] < bounds[2] - 0.01 or cache_bounds[3] < bounds[3] - 0.01:
+            continue
+        area = (cache_bounds[2] - cache_bounds[0]) * (cache_bounds[3] - cache_bounds[1])
+        if found is None or area < found[0]:
+            found = (area, os.path.join(get_cache_dir('raster'), fn), cache_bounds)
+    return found[1:] if found is not None else None
+
+def get_raster_max_files(raster_type: dto.RasterType, max_files: Optional[int] = None):
+    if max_files is not None:
+        return max_files
+    return 4 if raster_type == dto.RasterType.DTK50 else 6
+
+def get_raster_cache_bounds(raster_type: dto.RasterType, raster_folder: str, bounds: tuple[float], max_files: Optional[int] = None):
+    """
+    Returns the bounds of the mosaic to merge and cache for the bounds, expanded by RASTER_CACHE_MARGIN and snapped
+    outward to the blocks of the raster type. When that needs more raster files than allowed, the margin and
+    then the snapping are left out, so the limit applies to the requested area as before.
+    """
+    block = RASTER_CACHE_BLOCK_M.get(raster_type, 1000)
+    margin_x = min((bounds[2] - bounds[0]) * RASTER_CACHE_MARGIN, RASTER_CACHE_MARGIN_MAX_M)
+    margin_y = min((bounds[3] - bounds[1]) * RASTER_CACHE_MARGIN, RASTER_CACHE_MARGIN_MAX_M)
+
+    def snap(bounds: tuple[float], block: float):
+        return (
+            math.floor(bounds[0] / block) * block,
+            math.floor(bounds[1] / block) * block,
+            math.ceil(bounds[2] / block) * block,
+            math.ceil(bounds[3] / block) * block,
+        )
+
+    candidates = [
+        snap((bounds[0] - margin_x, bounds[1] - margin_y, bounds[2] + margin_x, bounds[3] + margin_y), block),
+        snap(bounds, block),
+        snap(bounds, 0.01),
+    ]
+    if raster_folder.startswith('https://'):
+        return candidates[0]
+
+    max_files = get_raster_max_files(raster_type, max_files)
+    for cache_bounds in candidates[:-1]:
+        if len(select_raster_files(raster_type, raster_folder, cache_bounds)[0]) <= max_files:
+            return cache_bounds
+    return candidates[-1]
+
+def get_raster_window(raster_bounds: tuple[float], raster_shape: tuple[int], bounds: tuple[float]):
+    """
+    Returns the window (row_start, row_stop, col_start, col_stop) of the bounds in the raster (bands, rows, cols) covering raster_bounds.
+    """
+    rows, cols = raster_shape[1:]
+    scale_x = cols / (raster_bounds[2] - raster_bounds[0])
+    scale_y = rows / (raster_bounds[3] - raster_bounds[1])
+    # The size is rounded on its own, so it is the same as the size of the bounds merged on their own
+    c0 = round((bounds[0] - raster_bounds[0]) * scale_x)
+    c1 = c0 + round((bounds[2] - bounds[0]) * scale_x)
+    r0 = round((raster_bounds[3] - bounds[3]) * scale_y)
+    r1 = r0 + round((bounds[3] - bounds[1]) * scale_y)
+    return (max(r0, 0), min(r1, rows), max(c0, 0), min(c1, cols))
+
+@metrics.timed('raster')
+def get_raster_mosaic(raster_type: dto.RasterType, raster_folder: str, zoom_adjust: int, bounds: tuple[float], pt: ProgressTracker = NoProgress, max_files: Optional[int] = None, target_resolution: Optional[float] = None):
+    """
+    Returns a cached mosaic (memory mapped) that covers the bounds, its cache file and its bounds.
+
+    Mosaics are merged and cached for a larger area than requested (see get_raster_cache_bounds), and any
+    later request inside a cached mosaic (the map after its preview, the area moved a little, the previews
+    of the control points) is cropped from it instead of merging the rasters again. See get_raster_map.
+    """
+    pt.step(0)
+    source_hash, zoom = get_raster_source_key(raster_type, raster_folder, zoom_adjust, bounds, target_resolution)
+
+    found = find_cached_raster(source_hash, bounds) if USE_CACHE else None
+    if found is not None:
+        raster_cache_fn, cache_bounds = found
+        # The mosaic is not evicted while this request uses it (unless it was evicted since it was found)
+        cache.acquire(raster_cache_fn)
+        try:
+            # Memory map the mosaic, so callers only read in the parts they use and all processes
+            # rendering the same area share one copy through the page cache
+            mosaic = np.load(raster_cache_fn, mmap_mode='r')
+            os.utime(raster_cache_fn)
+            logger.info(f'Using cached raster mosaic. - ({os.path.basename(raster_cache_fn)} - {mosaic.shape})')
+            metrics.cache_lookup('raster', True, mosaic.nbytes)
+            pt.step(1)
+            return mosaic, raster_cache_fn, cache_bounds
+        except FileNotFoundError:
+            pass
+
+    cache_bounds = get_raster_cache_bounds(raster_type, raster_folder, bounds, max_files)
+    raster_cache_fn = get_raster_cache_fn(source_hash, cache_bounds)
+    cache.acquire(raster_cache_fn)
+
+    # Concurrent requests for the same area wait for the first one instead of merging the rasters again
+    with cache.single_flight(raster_cache_fn, USE_CACHE) as cached:
+        if not cached:
+            mosaic = merge_raster_map(raster_type, raster_folder, zoom_adjust, cache_bounds, pt, max_files, target_resolution, zoom)
+            with cache.atomic_write(raster_cache_fn) as f:
+                np.save(f, mosaic)
+            metrics.cache_lookup('raster', False, mosaic.nbytes)
+            # Drop the private copy, the requests waiting for the mosaic map the same file
+            del mosaic
+
+    mosaic = np.load(raster_cache_fn, mmap_mode='r')
+    pt.step(1)
+    logger.info(f'Created raster mosaic. - ({os.path.basename(raster_cache_fn)} - {mosaic.shape})')
+    return mosaic, raster_cache_fn, cache_bounds
+
+def get_raster_map(raster_type: dto.RasterType, raster_folder: str, zoom_adjust: int, bounds: tuple[float], pt: ProgressTracker = NoProgress, max_files: Optional[int] = None, target_resolution: Optional[float] = None):
     """
     Merges all the raster files in the folder that intersect with the given bounds.
+    Returns a view of the bounds in the cached mosaic, see get_raster_mosaic.
 
     Parameters
     ----------
@@ -201,51 +443,110 @@ def get_raster_map(raster_type: dto.RasterType, raster_folder: str, zoom_adjust:
         The folder containing the raster files.
     bounds : tuple (west, south, east, north)
         The bounds of the area to be merged. EPSG:3794
+    max_files : int, optional
+        The maximum number of raster files that can be merged, defaults to a limit based on the raster type.
+    target_resolution : float, optional
+        Ground resolution of the output in meters per pixel, used to pick the zoom level of tile servers.
     """
+    mosaic, _, cache_bounds = get_raster_mosaic(raster_type, raster_folder, zoom_adjust, bounds, pt, max_files, target_resolution)
+    r0, r1, c0, c1 = get_raster_window(cache_bounds, mosaic.shape, bounds)
+    return mosaic[:, r0:r1, c0:c1]
 
-    pt.step(0)
-    bounds_hash = get_cache_index({'raster_folder': os.path.abspath(raster_folder), 'bounds': bounds, 'zoom_adjust': zoom_adjust})
-    raster_cache_fn = os.path.join(get_cache_dir('raster'), f'{bounds_hash}.npy')
+def evict_raster_cache(max_bytes: int = RASTER_CACHE_MAX_BYTES):
+    """
+    Removes the least recently used raster mosaics that no process uses until the cache fits into the configured size,
+    and the references folders of mosaics that were never written.
+    """
+    mosaics = []
+    total_bytes = 0
+    raster_dir = get_cache_dir('raster')
+    for fn in os.listdir(raster_dir):
+        if fn.endswith('.npy.refs') and not os.path.exists(os.path.join(raster_dir, fn[:-len('.refs')])):
+            # References of a mosaic that was never written (the merge failed or was cancelled)
+            # or is still being merged (then the merging process holds a reference)
+            fp = os.path.join(raster_dir, fn[:-len('.refs')])
+            if cache.get_reference_count(fp) == 0:
+                try:
+                    os.rmdir(f'{fp}.refs')
+                except OSError:
+                    pass
+            continue
+        if not fn.endswith('.npy'):
+            continue
+        fp = os.path.join(raster_dir, fn)
+        try:
+            st = os.stat(fp)
+        except FileNotFoundError:
+            continue
+        mosaics.append((st.st_mtime, st.st_size, fp))
+        total_bytes += st.st_size
 
-    if os.path.exists(raster_cache_fn) and USE_CACHE:
-        pt.step(0.9)
-        mosaic = np.load(raster_cache_fn)
-        logger.info(f'Using cached raster mosaic. - ({bounds_hash} - {mosaic.shape})')
-        pt.step(1)
-        return mosaic
+    if total_bytes <= max_bytes:
+        return
 
-    if raster_folder.startswith('https://'):
-        max_zoom = {
-            'osm': 19,
-            'otm': 15,
-        }.get(raster_type, 19)
+    evicted = 0
+    for _, size, fp in sorted(mosaics):
+        if total_bytes <= max_bytes * RASTER_CACHE_EVICT_RATIO:
+            break
+        if cache.get_reference_count(fp) > 0:
+            continue
+        try:
+            os.remove(fp)
+        except OSError:
+            # Removed by another process, or still mapped (Windows)
+            continue
+        try:
+            os.rmdir(f'{fp}.refs')
+        except OSError:
+            pass
+        total_bytes -= size
+        evicted += 1
 
-        mosaic = get_raster_map_tiles(raster_folder, zoom_adjust, max_zoom, bounds, pt.sub(0.1, 0.9))
-        np.save(raster_cache_fn, mosaic)
-        pt.step(1)
-        logger.info(f'Created raster mosaic. - ({bounds_hash} - {mosaic.shape})')
-        return mosaic
-    
-    pt.step(0)
-    crs_from = pyproj.CRS.from_epsg(3794)
+    logger.info(f'Evicted {evicted} mosaics from the raster cache.')
 
-    if raster_type == dto.RasterType.DTK25 or \
-       raster_type == dto.RasterType.DTK10 or \
-       raster_type == dto.RasterType.DTK5:
-        crs_to = pyproj.CRS.from_epsg(3912)
-        max_files = 6
-    elif raster_type == dto.RasterType.DTK50:
-        crs_to = pyproj.CRS.from_epsg(3794)
-        max_files = 4
-    else:
-        raise ProgressError('Neveljaven tip osnove za karto')
-    
-    transformer = pyproj.Transformer.from_crs(crs_from, crs_to)
-    west, south = transformer.transform(bounds[0], bounds[1])
-    east, north = transformer.transform(bounds[2], bounds[3])
-    bounds = (west, south, east, north)
+def evict_reambulation_cache(max_bytes: int = REAMBULATION_CACHE_MAX_BYTES):
+    """
+    Removes the least recently used reambulation layer windows until the cache fits into the configured size.
+    """
+    layers = []
+    total_bytes = 0
+    layer_dir = get_cache_dir('reambulation_layers')
+    for fn in os.listdir(layer_dir):
+        if not fn.endswith('.npz'):
+            continue
+        fp = os.path.join(layer_dir, fn)
+        try:
+            st = os.stat(fp)
+        except FileNotFoundError:
+            continue
+        layers.append((st.st_mtime, st.st_size, fp))
+        total_bytes += st.st_size
+
+    if total_bytes <= max_bytes:
+        return
+
+    evicted = 0
+    for _, size, fp in sorted(layers):
+        if total_bytes <= max_bytes * REAMBULATION_CACHE_EVICT_RATIO:
+            break
+        try:
+            # Layers are read into memory, so a layer in use can be removed
+            os.remove(fp)
+        except OSError:
+            continue
+        total_bytes -= size
+        evicted += 1
 
-    raster_bounds = get_raster_map_bounds(raster_folder, pt.sub(0.01, 0.1))
+    logger.info(f'Evicted {evicted} layers from the reambulation layer cache.')
+
+def select_raster_files(raster_type: dto.RasterType, raster_folder: str, bounds: tuple[float], pt: ProgressTracker = NoProgress):
+    """
+    Returns the raster files in the folder that intersect with the bounds (EPSG:3794)
+    and the bounds in the coordinate system of the raster files.
+    """
+    bounds = reproject.transform_bounds(bounds, 3794, get_raster_epsg(raster_type))
+
+    raster_bounds = get_raster_map_bounds(raster_folder, pt)
     selected_files = []
     bbox = shapely.geometry.box(*bounds)
     for filename, file_bounds in raster_bounds.items():
@@ -253,6 +554,21 @@ def get_raster_map(raster_type: dto.RasterType, raster_folder: str, zoom_adjust:
         if bbox.intersects(file_bbox):
             selected_files.append(os.path.join(raster_folder, filename))
 
+    return selected_files, bounds
+
+def merge_raster_map(raster_type: dto.RasterType, raster_folder: str, zoom_adjust: int, bounds: tuple[float], pt: ProgressTracker = NoProgress, max_files: Optional[int] = None, target_resolution: Optional[float] = None, zoom: Optional[int] = None):
+    """
+    Uncached part of get_raster_mosaic.
+    """
+    if raster_folder.startswith('https://'):
+        max_zoom = get_tiles_max_zoom(raster_type)
+        return get_raster_map_tiles(raster_folder, zoom_adjust, max_zoom, bounds, pt.sub(0.1, 0.9), target_resolution, zoom)
+
+    pt.step(0)
+    max_files = get_raster_max_files(raster_type, max_files)
+
+    selected_files, src_bounds = select_raster_files(raster_type, raster_folder, bounds, pt.sub(0.01, 0.1))
+
     if len(selected_files) == 0:
         raise ProgressError('Izbrano območje ne vsebuje nobenih podatkov za ta rasterski sloj')
     
@@ -264,12 +580,23 @@ def get_raster_map(raster_type: dto.RasterType, raster_folder: str, zoom_adjust:
         src = rasterio.open(fp)
         src_files_to_mosaic.append(src)
     
-    mosaic, _ = rasterio.merge.merge(src_files_to_mosaic, bounds=bounds, nodata=255)
-    pt.step(0.9)
-    np.save(raster_cache_fn, mosaic)
-    pt.step(1)
+    pt.check()
+    src_epsg = get_raster_epsg(raster_type)
+    if src_epsg == 3794:
+        mosaic, _ = rasterio.merge.merge(src_files_to_mosaic, bounds=src_bounds, nodata=255)
+        pt.step(0.9)
+        return mosaic
 
-    logger.info(f'Created raster mosaic. - ({bounds_hash} - {mosaic.shape})')
+    # Merge the files in their own coordinate system around the area (with a margin for the
+    # interpolation) and reproject the mosaic into the D96/TM grid of the bounds
+    res = src_files_to_mosaic[0].res
+    src_bounds = (src_bounds[0] - 2 * res[0], src_bounds[1] - 2 * res[1], src_bounds[2] + 2 * res[0], src_bounds[3] + 2 * res[1])
+    mosaic, mosaic_transform = rasterio.merge.merge(src_files_to_mosaic, bounds=src_bounds, nodata=255)
+    pt.step(0.6)
+    dst_shape = (max(round((bounds[3] - bounds[1]) / res[1]), 1), max(round((bounds[2] - bounds[0]) / res[0]), 1))
+    mosaic = reproject.reproject(mosaic, mosaic_transform, src_epsg, bounds, dst_shape, 3794, 255, pt.sub(0.6, 0.9))
+    logger.info(f'Reprojected raster mosaic from EPSG:{src_epsg}. - ({dst_shape})')
+    pt.step(0.9)
     return mosaic
 
 # Convert decimal degrees to DD°MM'SS" format
@@ -323,10 +650,10 @@ def get_transform_for_image(filename: str, world_file: Optional[str], width: int
     else:
         raise ProgressError(f'Sloj "{layer_name}" brez podanih mej')
 
-def reambulate_raster(raster: Image.Image, bounds: tuple[float], layer_files: list[str], pt: ProgressTracker = NoProgress):
-    pt.step(0)
-    raster = raster.convert('RGBA')
-
+def get_reambulation_layers(layer_files: list[str]):
+    """
+    Groups the uploaded layer files into a list of tuples (png_file, world_file or None).
+    """
     # Strip ">MD5[32]-<Filename" from the filename
     layer_files = [(l, os.path.basename(l)[32 + 1:]) for l in layer_files]
     layer_files = sorted(layer_files, key=lambda x: x[1])
@@ -349,42 +676,165 @@ def reambulate_raster(raster: Image.Image, bounds: tuple[float], layer_files: li
         
         layers.append((png_file[0], world_file[0]))
 
+    return layers
 
-    base_transform = rasterio.transform.from_bounds(*bounds, *raster.size)
-    logger.info(f'Overlaying {len(layers)} layers. - ({bounds})')
-
-    for png_file, world_file in pt.over_range(0.1, 1, layers):
-        # Load overlay and transform
-        oimg = Image.open(png_file).convert('RGBA')
-        otransform = get_transform_for_image(png_file, world_file, *oimg.size)
-        obounds = rasterio.transform.array_bounds(*oimg.size[::-1], otransform)
+def prepare_reambulation_layer(png_file: str, world_file: Optional[str], base_transform: rasterio.transform.Affine, base_size: tuple[int]):
+    """
+    Resamples the layer to the pixel grid of the base raster, but only inside the part that overlaps the base raster.
 
-        # Calculate overlay bounds in the base image
-        oy_min, ox_min = rasterio.transform.rowcol(base_transform, obounds[0], obounds[3])
-        oy_max, ox_max = rasterio.transform.rowcol(base_transform, obounds[2], obounds[1])
-        owidth = ox_max - ox_min
-        oheight = oy_max - oy_min
-        if oimg.size[0] != owidth or oimg.size[1] != oheight:
-            oimg = oimg.resize((owidth, oheight), resample=Image.Resampling.LANCZOS)
+    Returns a tuple (x, y, rgba) with the position of the window in the base raster and the RGBA window
+    as a (height, width, 4) array, or None if the layer does not overlap the base raster.
+    """
+    oimg = Image.open(png_file)
+    otransform = get_transform_for_image(png_file, world_file, *oimg.size)
+    obounds = rasterio.transform.array_bounds(*oimg.size[::-1], otransform)
+
+    # Calculate overlay bounds in the base image
+    oy_min, ox_min = rasterio.transform.rowcol(base_transform, obounds[0], obounds[3])
+    oy_max, ox_max = rasterio.transform.rowcol(base_transform, obounds[2], obounds[1])
+    owidth = ox_max - ox_min
+    oheight = oy_max - oy_min
+
+    # Clip the overlay to the base image
+    x0, y0 = max(ox_min, 0), max(oy_min, 0)
+    x1, y1 = min(ox_max, base_size[0]), min(oy_max, base_size[1])
+    if owidth <= 0 or oheight <= 0 or x0 >= x1 or y0 >= y1:
+        return None
+
+    # Resample only the part of the overlay that ends up inside the base image
+    scale_x = oimg.size[0] / owidth
+    scale_y = oimg.size[1] / oheight
+    box = ((x0 - ox_min) * scale_x, (y0 - oy_min) * scale_y, (x1 - ox_min) * scale_x, (y1 - oy_min) * scale_y)
+    oimg = oimg.convert('RGBA')
+    if oimg.size == (owidth, oheight):
+        window = oimg.crop(tuple(int(c) for c in box))
+    else:
+        window = resample.resize(oimg, (x1 - x0, y1 - y0), Image.Resampling.LANCZOS, box=box)
 
-        raster.paste(oimg, (ox_min, oy_min, ox_max, oy_max), oimg)
+    return x0, y0, np.asarray(window)
 
-    return raster.convert('RGB')
+def get_reambulation_layer(png_file: str, world_file: Optional[str], base_transform: rasterio.transform.Affine, base_size: tuple[int]):
+    """
+    Cached version of prepare_reambulation_layer.
 
-def get_grid_and_map(map_size_m: tuple[float], map_bounds: tuple[float], raster_type: dto.RasterType, raster_folder: str, reamulation_layers: list[str], zoom_adjust: int, pt: ProgressTracker = NoProgress):
+    Uploaded layer files are prefixed with the MD5 of their content, so the resampled window
+    is cached by the MD5 (and name) of the layer files and the pixel grid of the base raster.
+    """
+    cache_index = get_cache_index({
+        'png_file': os.path.basename(png_file),
+        'world_file': os.path.basename(world_file) if world_file is not None else None,
+        'base_transform': list(base_transform)[:6],
+        'base_size': list(base_size),
+    })
+    layer_cache_fn = os.path.join(get_cache_dir('reambulation_layers'), f'{cache_index}.npz')
+
+    with cache.single_flight(layer_cache_fn, USE_CACHE) as cached:
+        if cached:
+            with np.load(layer_cache_fn) as cached_layer:
+                x, y = cached_layer['xy']
+                rgba = cached_layer['rgba']
+            # Touch the layer so that eviction keeps recently used layers
+            os.utime(layer_cache_fn)
+            logger.info(f'Using cached reambulation layer. - ({cache_index} - {rgba.shape})')
+            metrics.cache_lookup('reambulation_layer', True, rgba.nbytes)
+            return int(x), int(y), rgba
+
+        layer = prepare_reambulation_layer(png_file, world_file, base_transform, base_size)
+        if layer is None:
+            return None
+
+        x, y, rgba = layer
+        with cache.atomic_write(layer_cache_fn) as f:
+            # The windows are mostly transparent
+            np.savez_compressed(f, xy=np.array([x, y]), rgba=rgba)
+        metrics.cache_lookup('reambulation_layer', False, rgba.nbytes)
+    logger.info(f'Created reambulation layer. - ({cache_index} - {rgba.shape})')
+    return layer
+
+def composite_reambulation_layers(raster: np.ndarray, layers: list[tuple], row_offset: int = 0):
     """
-    Returns the map image, the grid image, and the transformers for converting between the map and the world.
+    Alpha blends the prepared layer windows (see prepare_reambulation_layer) onto the raster in place.
 
     Parameters
     ----------
-    map_size_m : tuple (width, height)
-        The size of the map in meters.
-    map_bounds : tuple (west, south, east, north)
-        The bounds of the map in EPSG:3794.
-    raster_folder : str
-        The folder containing the raster files.
+    raster : np.ndarray
+        The (height, width, 3) RGB raster.
+    row_offset : int
+        Row of the base raster that the first row of the raster corresponds to.
+    """
+    for x, y, rgba in layers:
+        y0 = max(y, row_offset)
+        y1 = min(y + rgba.shape[0], row_offset + raster.shape[0])
+        if y0 >= y1:
+            continue
+
+        src = rgba[y0 - y:y1 - y]
+        dst = raster[y0 - row_offset:y1 - row_offset, x:x + rgba.shape[1]]
+        alpha = src[..., 3:4].astype(np.uint16)
+        dst[...] = ((src[..., :3] * alpha + dst * (255 - alpha) + 127) // 255).astype(np.uint8)
+
+def prepare_reambulation_layers(bounds: tuple[float], base_size: tuple[int], layer_files: list[str], pt: ProgressTracker = NoProgress):
+    """
+    Prepares the reambulation layers for compositing onto a raster of base_size pixels covering bounds.
+    Returns the list of layer windows for composite_reambulation_layers.
     """
     pt.step(0)
+    layers = get_reambulation_layers(layer_files)
+
+    base_transform = rasterio.transform.from_bounds(*bounds, *base_size)
+    logger.info(f'Overlaying {len(layers)} layers. - ({bounds})')
+
+    windows = []
+    for png_file, world_file in pt.over_range(0.1, 1, layers):
+        layer = get_reambulation_layer(png_file, world_file, base_transform, base_size)
+        if layer is None:
+            logger.info(f'Layer does not overlap the map. - ({os.path.basename(png_file)})')
+            continue
+        windows.append(layer)
+
+    return windows
+
+def get_strip_height(row_bytes: int):
+    """
+    Returns the number of rows that can be processed at once if every row needs row_bytes of working memory.
+    """
+    return max(1, RENDER_STRIP_MAX_BYTES // max(1, row_bytes))
+
+def paste_raster(map_img: Image.Image, offset: tuple[int], size: tuple[int], raster: np.ndarray, layers: list[tuple], pt: ProgressTracker = NoProgress):
+    """
+    Resamples the raster (bands, rows, cols) to size, composites the reambulation layers onto it
+    and pastes it into the map image at offset.
+
+    This is done one horizontal strip at a time, so only a strip of the raster is ever copied and
+    resampled. Each strip reads enough extra source rows to cover the support of the filter and
+    starts on the grid of the box reduction, so the result is the same as resampling the whole raster at once.
+    """
+    src_h, src_w = raster.shape[1:]
+    scale_y = src_h / size[1]
+    factor = resample.get_reduce_factor((src_w, src_h), size)
+    margin = (math.ceil(3 * max(scale_y / factor, 1)) + 1) * factor # Support of the LANCZOS filter
+    strip_h = get_strip_height(size[0] * 3 + math.ceil(scale_y) * src_w * 3 * 2)
+
+    for r0 in pt.over_range(0, 1, range(0, size[1], strip_h)):
+        r1 = min(r0 + strip_h, size[1])
+        s0 = max(int(r0 * scale_y) - margin, 0) // factor * factor
+        s1 = min(math.ceil((math.ceil(r1 * scale_y) + margin) / factor) * factor, src_h)
+
+        strip = np.ascontiguousarray(rasterio.plot.reshape_as_image(raster[:, s0:s1]))
+        composite_reambulation_layers(strip, layers, row_offset=s0)
+        strip_img = resample.resize(
+            strip,
+            (size[0], r1 - r0),
+            Image.Resampling.LANCZOS,
+            box=(0, r0 * scale_y - s0, src_w, r1 * scale_y - s0),
+            factor=factor)
+        map_img.paste(strip_img, (offset[0], offset[1] + r0))
+
+def get_map_layout(map_size_m: tuple[float]):
+    """
+    Returns the transformer from meters on the paper to map pixels, the size of the map in pixels,
+    the grid margins in pixels [top, right, bottom, left] and the size of the grid in pixels.
+    """
     # Convert from meters to pixels
     target_pxpm = TARGET_DPI / 0.0254
     real_to_map_tr = rasterio.transform.AffineTransformer(
@@ -395,36 +845,67 @@ def get_grid_and_map(map_size_m: tuple[float], map_bounds: tuple[float], raster_
             int(map_size_m[1] * target_pxpm))
             )
 
-    # Calculate the size of the map in pixels and create a blank image
+    # Calculate the size of the map in pixels
     map_size_px = [p + 1 for p in real_to_map_tr.rowcol(*map_size_m)[::-1]]
-    map_img = Image.new('RGB', map_size_px, 0xFFFFFF)
 
     # Calculate the size of the grid in pixels
     grid_margin_px = [int(m * target_pxpm) for m in GRID_MARGIN_M]
-    grid_size_px = [map_size_px[0] - grid_margin_px[1] - grid_margin_px[3], map_size_px[1] - grid_margin_px[0] - grid_margin_px[2]]
+    grid_size_px = (map_size_px[0] - grid_margin_px[1] - grid_margin_px[3], map_size_px[1] - grid_margin_px[0] - grid_margin_px[2])
+    return real_to_map_tr, map_size_px, grid_margin_px, grid_size_px
 
-    # Get the raster map
+def get_map_transform(map_bounds: tuple[float], map_size_px: tuple[int], grid_margin_px: list[int], grid_size_px: tuple[int]):
+    """
+    Returns the affine transform of the map pixels (with the margins) to EPSG:3794, see get_map_layout.
+    """
+    grid_to_world_tr = rasterio.transform.AffineTransformer(rasterio.transform.from_bounds(*map_bounds, *grid_size_px))
+    map_sw = grid_to_world_tr.xy(grid_size_px[1] + grid_margin_px[2], -grid_margin_px[3])
+    map_ne = grid_to_world_tr.xy(-grid_margin_px[0], grid_size_px[0] + grid_margin_px[1])
+    return rasterio.transform.from_bounds(*map_sw, *map_ne, *map_size_px)
+
+def get_grid_and_map(map_size_m: tuple[float], map_bounds: tuple[float], raster_type: dto.RasterType, raster_folder: str, reamulation_layers: list[str], zoom_adjust: int, pt: ProgressTracker = NoProgress, raster: Optional[np.ndarray] = None):
+    """
+    Returns the map image with the raster already drawn inside the grid, the size of the grid in pixels,
+    and the transformers for converting between the map and the world.
+
+    The map image is allocated in full (the grid, control points and markings are drawn on it as a whole),
+    so memory grows with the map size, which is limited by MAP_SIZE_MAX_M. Only the resampling of
+    the raster into it is done in strips, see paste_raster.
+
+    Parameters
+    ----------
+    map_size_m : tuple (width, height)
+        The size of the map in meters.
+    map_bounds : tuple (west, south, east, north)
+        The bounds of the map in EPSG:3794.
+    raster_folder : str
+        The folder containing the raster files.
+    raster : np.ndarray, optional
+        Already fetched raster (bands, rows, cols) covering map_bounds, used instead of reading the raster folder.
+    """
+    pt.step(0)
+    real_to_map_tr, map_size_px, grid_margin_px, grid_size_px = get_map_layout(map_size_m)
+    map_img = Image.new('RGB', map_size_px, 0xFFFFFF)
+
+    # Draw the raster map into the grid
     if raster_folder != '':
-        grid_raster = get_raster_map(raster_type, raster_folder, zoom_adjust, map_bounds, pt.sub(0.1, 0.8))
-        grid_img = Image.fromarray(rasterio.plot.reshape_as_image(grid_raster), 'RGB')
+        if raster is None:
+            target_resolution = (map_bounds[2] - map_bounds[0]) / grid_size_px[0]
+            raster = get_raster_map(raster_type, raster_folder, zoom_adjust, map_bounds, pt.sub(0.1, 0.5), target_resolution=target_resolution)
+        grid_raster = raster
+        layers = []
         if len(reamulation_layers) > 0:
             pt.msg('Reambulacija karte')
-            grid_img = reambulate_raster(grid_img, map_bounds, reamulation_layers, pt.sub(0.5, 0.85))
-
-        grid_img = grid_img.resize(grid_size_px, resample=Image.Resampling.LANCZOS)
+            layers = prepare_reambulation_layers(map_bounds, grid_raster.shape[:0:-1], reamulation_layers, pt.sub(0.5, 0.6))
+        grid_offset = real_to_map_tr.rowcol(GRID_MARGIN_M[3], GRID_MARGIN_M[0])[::-1]
+        paste_raster(map_img, grid_offset, grid_size_px, grid_raster, layers, pt.sub(0.6, 0.9))
         pt.step(0.9)
     else:
         logger.info('Skipping raster map.')
-        grid_img = Image.new('RGB', grid_size_px, 0xFFFFFF)
         pt.step(0.9)
 
-    # Create a transformer for converting between the grid and the world
-    grid_to_world_tr = rasterio.transform.AffineTransformer(rasterio.transform.from_bounds(*map_bounds, *grid_img.size))
-
-    # Create a transformer for converting between the map and the world
-    map_sw = grid_to_world_tr.xy(grid_size_px[1] + grid_margin_px[2], -grid_margin_px[3])
-    map_ne = grid_to_world_tr.xy(-grid_margin_px[0], grid_size_px[0] + grid_margin_px[1])
-    map_to_world_tr = rasterio.transform.AffineTransformer(rasterio.transform.from_bounds(*map_sw, *map_ne, *map_img.size))
+    # Create transformers for converting between the grid and the world and between the map and the world
+    grid_to_world_tr = rasterio.transform.AffineTransformer(rasterio.transform.from_bounds(*map_bounds, *grid_size_px))
+    map_to_world_tr = rasterio.transform.AffineTransformer(get_map_transform(map_bounds, map_size_px, grid_margin_px, grid_size_px))
 
     # Add a helper function that swaps returned columns and rows
     def add_colrow_to_transformer(tr):
@@ -438,28 +919,46 @@ def get_grid_and_map(map_size_m: tuple[float], map_bounds: tuple[float], raster_
     logger.info(f'Created map and grid images. ({map_size_px} - {map_bounds})')
     
     pt.step(1)
-    return map_img, grid_img, add_colrow_to_transformer(map_to_world_tr), add_colrow_to_transformer(grid_to_world_tr), add_colrow_to_transformer(real_to_map_tr), map_to_grid
+    return map_img, grid_size_px, add_colrow_to_transformer(map_to_world_tr), add_colrow_to_transformer(grid_to_world_tr), add_colrow_to_transformer(real_to_map_tr), map_to_grid
+
+
+def get_grid_line_colors(band: np.ndarray, line_px: np.ndarray, center: int, auto_darken: bool):
+    """
+    Returns the colors of the grid line pixels.
 
+    Parameters
+    ----------
+    band : np.ndarray
+        The (length, width, 3) grid pixels around the line, taken before anything is drawn over the grid.
+        The first axis runs along the line.
+    line_px : np.ndarray
+        Positions along the line (first axis of band) for which to return the colors.
+    center : int
+        Index of the line inside the band (second axis of band).
+    """
+    colors = np.zeros((len(line_px), 3), dtype=np.uint8)
+    if not auto_darken:
+        return colors
 
-def draw_grid(map_img, grid_img, map_to_world_tr, grid_to_world_tr, real_to_map_tr, raster_type, epsg, edge_wgs84, map_to_grid, skip_grid_lines, pt: ProgressTracker = NoProgress):
+    # Do not draw grid lines near black pixels in the map (20 pixels along the line), darken the map instead
+    dark = (band < 20).all(axis=2).any(axis=1)
+    dark_sum = np.concatenate([[0], np.cumsum(dark)])
+    near_dark = dark_sum[np.clip(line_px + 10, 0, len(dark))] - dark_sum[np.clip(line_px - 10, 0, len(dark))] > 0
+
+    pixels = band[np.clip(line_px, 0, len(band) - 1), center].astype(np.int16)
+    colors[near_dark] = np.maximum(pixels[near_dark] - 90, 0)
+    return colors
+
+def draw_grid(map_img, grid_size_px, map_to_world_tr, grid_to_world_tr, real_to_map_tr, raster_type, epsg, edge_wgs84, map_to_grid, skip_grid_lines, pt: ProgressTracker = NoProgress):
     map_draw = ImageDraw.Draw(map_img)
     pt.step(0)
-    # Draw grid on the map
     logger.info('Drawing grid.')
-    map_img.paste(grid_img, real_to_map_tr.colrow(GRID_MARGIN_M[3], GRID_MARGIN_M[0]))
-    pt.step(0.3)
-
-    # Draw grid border
-    logger.info('Drawing grid border.')
-    border0 = map_to_world_tr.colrow(*grid_to_world_tr.xy(-1, -1))
-    grid_border = (border0[0], border0[1], border0[0] + grid_img.size[0] + 1, border0[1] + grid_img.size[1] + 1)
-    map_draw.rectangle(grid_border, outline='black', width=2)
-    pt.step(0.4)
-
-    grid_font = ImageFont.truetype('timesi.ttf', 48)
-    border_bottom_px = 0
+    grid_w, grid_h = grid_size_px
+    grid_offset = real_to_map_tr.colrow(GRID_MARGIN_M[3], GRID_MARGIN_M[0])
 
-    # Draw coordinate system
+    # Calculate the grid lines of the coordinate system
+    x_lines = [] # List of tuples (label, north point, south point)
+    y_lines = [] # List of tuples (label, west point, east point)
     if epsg != 'Brez':
         cs_from = pyproj.CRS.from_epsg(3794)
         cs_to = pyproj.CRS.from_epsg(int(epsg.split(':')[1]))
@@ -471,75 +970,11 @@ def draw_grid(map_img, grid_img, map_to_world_tr, grid_to_world_tr, real_to_map_
         if not cs_to.is_projected:
             raise ProgressError('Želeni koordinatni sistem mora biti projeciran.')
 
-        # Do not draw grid lines near black pixels in the map
-        def should_draw_grid_line(x0, y0, line_dir):
-            (x0, y0) = map_to_grid(x0, y0)
-            
-            # check 3 wide area += 10 dir around the point for dark pixels (black or near black)
-            if line_dir == 'x':
-                for x in range(x0 - 2, x0 + 3):
-                    if x < 0 or x >= grid_img.size[0]:
-                        continue
-                    for y in range(y0 - 10, y0 + 10):
-                        if y < 0 or y >= grid_img.size[1]:
-                            continue
-                        col = grid_img.getpixel((x, y))
-                        if col[0] < 20 and col[1] < 20 and col[2] < 20:
-                            return False
-            else:
-                for x in range(x0 - 10, x0 + 10):
-                    if x < 0 or x >= grid_img.size[0]:
-                        continue
-                    for y in range(y0 - 2, y0 + 3):
-                        if y < 0 or y >= grid_img.size[1]:
-                            continue
-                        col = grid_img.getpixel((x, y))
-                        if col[0] < 20 and col[1] < 20 and col[2] < 20:
-                            return False
-
-            return True
-
-        auto_darken = True
-        # DTK25 has baked in grid lines, so we just repaint them
-        if raster_type == dto.RasterType.DTK25:
-            auto_darken = False
-
-        # Draw grid lines on the map
-        def draw_grid_line(x0, y0, x1, y1, line_dir):
-            x0, y0, x1, y1 = int(x0), int(y0), int(x1), int(y1)
-            gx0, gy0 = map_to_grid(x0, y0)
-            gx1, gy1 = map_to_grid(x1, y1)
-            if line_dir == 'x':
-                assert(abs(gx0 - gx1) <= 1)
-                if max(gx0, gx1) >= grid_img.size[0] or min(gx0, gx1) < 0:
-                    return # skip line if it is outside the grid
-                for y in range(int(y0), int(y1)):
-                    if not auto_darken or should_draw_grid_line(x0, y, line_dir):
-                        map_draw.line((x0, y, x0 + 1, y), fill='black')
-                    else:
-                        # Darken the pixel
-                        col = grid_img.getpixel(map_to_grid(x0, y))
-                        col = (max(0, col[0] - 90), max(0, col[1] - 90), max(0, col[2] - 90))              
-                        map_draw.line((x0, y, x0 + 1, y), fill=col)
-
-            elif line_dir == 'y':
-                assert(abs(gy0 - gy1) <= 1)
-                if max(gy0, gy1) >= grid_img.size[1] or min(gy0, gy1) < 0:
-                    return # skip line if it is outside the grid
-                for x in range(int(x0), int(x1)):
-                    if not auto_darken or should_draw_grid_line(x, y0, line_dir):
-                        map_draw.line((x, y0, x, y0 + 1), fill='black')
-                    else:
-                        # Darken the pixel
-                        col = grid_img.getpixel(map_to_grid(x, y0))
-                        col = (max(0, col[0] - 90), max(0, col[1] - 90), max(0, col[2] - 90))
-                        map_draw.line((x, y0, x, y0 + 1), fill=col)
-
         superscript_map = {
             "0": "", "1": "¹", "2": "²", "3": "³", "4": "⁴", "5": "⁵", "6": "⁶", "7": "⁷", "8": "⁸", "9": "⁹"}
 
-        grid_edge_ws = grid_to_world_tr.xy(grid_img.size[1], 0)
-        grid_edge_en = grid_to_world_tr.xy(0, grid_img.size[0])
+        grid_edge_ws = grid_to_world_tr.xy(grid_h, 0)
+        grid_edge_en = grid_to_world_tr.xy(0, grid_w)
 
         # Convert to target coordinate system
         grid_edge_ws = cs_from_to_tr.transform(grid_edge_ws[0], grid_edge_ws[1])
@@ -548,31 +983,80 @@ def draw_grid(map_img, grid_img, map_to_world_tr, grid_to_world_tr, real_to_map_
         grid_edge_ws_grid = (math.ceil(grid_edge_ws[0] / 1000) * 1000, math.ceil(grid_edge_ws[1] / 1000) * 1000)
         grid_edge_en_grid = (math.floor(grid_edge_en[0] / 1000 + 1) * 1000, math.floor(grid_edge_en[1] / 1000 + 1) * 1000)
 
-        pt.step(0.5)
+        def grid_line_label(c, first, last):
+            cord = f'{int(c):06}'
+            if c == first or c == last:
+                return f'{superscript_map[cord[-6]]}{cord[-5:-3]}'
+            return f'{cord[-5:-3]}'
+
         for x in range(int(grid_edge_ws_grid[0]), int(grid_edge_en_grid[0]), 1000):
             xline_s = map_to_world_tr.colrow(*cs_to_from_tr.transform(x, grid_edge_ws[1]))
             xline_n = map_to_world_tr.colrow(*cs_to_from_tr.transform(x, grid_edge_en[1]))
-            if not skip_grid_lines:
-                draw_grid_line(xline_n[0], xline_n[1], xline_s[0], xline_s[1] - 1, 'x')
-            cord = f'{int(x):06}'
-            if x == grid_edge_ws_grid[0] or x == grid_edge_en_grid[0] - 1000:
-                txt = f'{superscript_map[cord[-6]]}{cord[-5:-3]}'
-            else:
-                txt = f'{cord[-5:-3]}'
-            map_draw.text((xline_s[0], xline_s[1] + 5), txt, fill='black', align='center', anchor='mt', font=grid_font)
-            map_draw.text((xline_n[0], xline_n[1] - 5), txt, fill='black', align='center', anchor='ms', font=grid_font)
+            x_lines.append((grid_line_label(x, grid_edge_ws_grid[0], grid_edge_en_grid[0] - 1000), xline_n, xline_s))
 
-        pt.step(0.6)
         for y in range(int(grid_edge_ws_grid[1]), int(grid_edge_en_grid[1]), 1000):
             yline_w = map_to_world_tr.colrow(*cs_to_from_tr.transform(grid_edge_ws[0], y))
             yline_e = map_to_world_tr.colrow(*cs_to_from_tr.transform(grid_edge_en[0], y))
-            if not skip_grid_lines:
-                draw_grid_line(yline_w[0], yline_w[1], yline_e[0] - 1, yline_e[1], 'y')
-            cord = f'{int(y):06}'
-            if y == grid_edge_ws_grid[1] or y == grid_edge_en_grid[1] - 1000:
-                txt = f'{superscript_map[cord[-6]]}{cord[-5:-3]}'
-            else:
-                txt = f'{cord[-5:-3]}'
+            y_lines.append((grid_line_label(y, grid_edge_ws_grid[1], grid_edge_en_grid[1] - 1000), yline_w, yline_e))
+
+    auto_darken = True
+    # DTK25 has baked in grid lines, so we just repaint them
+    if raster_type == dto.RasterType.DTK25:
+        auto_darken = False
+
+    # Calculate the colors of the grid lines from the raster under them, before anything is drawn over it
+    grid_line_pixels = [] # List of tuples (position, size, pixels)
+    for _, p0, p1 in x_lines if not skip_grid_lines else []:
+        pt.check()
+        x0, y0, x1, y1 = int(p0[0]), int(p0[1]), int(p1[0]), int(p1[1]) - 1
+        gx0, gy0 = map_to_grid(x0, y0)
+        gx1, _ = map_to_grid(x1, y1)
+        assert(abs(gx0 - gx1) <= 1)
+        if max(gx0, gx1) >= grid_w or min(gx0, gx1) < 0 or y1 <= y0:
+            continue # skip line if it is outside the grid
+        c0, c1 = max(gx0 - 2, 0), min(gx0 + 3, grid_w)
+        band = np.asarray(map_img.crop((grid_offset[0] + c0, grid_offset[1], grid_offset[0] + c1, grid_offset[1] + grid_h)))
+        colors = get_grid_line_colors(band, np.arange(gy0, gy0 + y1 - y0), gx0 - c0, auto_darken)
+        # Lines are 2 pixels wide
+        grid_line_pixels.append(((x0, y0), np.repeat(colors[:, None], 2, axis=1)))
+
+    for _, p0, p1 in y_lines if not skip_grid_lines else []:
+        pt.check()
+        x0, y0, x1, y1 = int(p0[0]), int(p0[1]), int(p1[0]) - 1, int(p1[1])
+        gx0, gy0 = map_to_grid(x0, y0)
+        _, gy1 = map_to_grid(x1, y1)
+        assert(abs(gy0 - gy1) <= 1)
+        if max(gy0, gy1) >= grid_h or min(gy0, gy1) < 0 or x1 <= x0:
+            continue # skip line if it is outside the grid
+        r0, r1 = max(gy0 - 2, 0), min(gy0 + 3, grid_h)
+        band = np.asarray(map_img.crop((grid_offset[0], grid_offset[1] + r0, grid_offset[0] + grid_w, grid_offset[1] + r1)))
+        colors = get_grid_line_colors(band.transpose(1, 0, 2), np.arange(gx0, gx0 + x1 - x0), gy0 - r0, auto_darken)
+        # Lines are 2 pixels wide
+        grid_line_pixels.append(((x0, y0), np.repeat(colors[None, :], 2, axis=0)))
+    pt.step(0.3)
+
+    # Draw grid border
+    logger.info('Drawing grid border.')
+    border0 = map_to_world_tr.colrow(*grid_to_world_tr.xy(-1, -1))
+    grid_border = (border0[0], border0[1], border0[0] + grid_w + 1, border0[1] + grid_h + 1)
+    map_draw.rectangle(grid_border, outline='black', width=2)
+    pt.step(0.4)
+
+    grid_font = ImageFont.truetype('timesi.ttf', 48)
+    border_bottom_px = 0
+
+    # Draw coordinate system
+    if epsg != 'Brez':
+        pt.step(0.5)
+        for position, pixels in grid_line_pixels:
+            map_img.paste(Image.fromarray(pixels, 'RGB'), position)
+
+        pt.step(0.6)
+        for txt, xline_n, xline_s in x_lines:
+            map_draw.text((xline_s[0], xline_s[1] + 5), txt, fill='black', align='center', anchor='mt', font=grid_font)
+            map_draw.text((xline_n[0], xline_n[1] - 5), txt, fill='black', align='center', anchor='ms', font=grid_font)
+
+        for txt, yline_w, yline_e in y_lines:
             map_draw.text((yline_w[0] - 5, yline_w[1]), txt, fill='black', align='center', anchor='rm', font=grid_font)
             map_draw.text((yline_e[0] + 5, yline_e[1]), txt, fill='black', align='center', anchor='lm', font=grid_font)
 
@@ -619,17 +1103,17 @@ def draw_grid(map_img, grid_img, map_to_world_tr, grid_to_world_tr, real_to_map_
         map_draw.text((grid_border[0], wgs_border[1] - 5), txt_lon(wgs_nw[1]), fill='black', align='center', anchor='lb', font=grid_font)
 
         # Show NE corner
-        wgs_ne = wgs_tr.transform(*grid_to_world_tr.xy(0, grid_img.size[0]))
+        wgs_ne = wgs_tr.transform(*grid_to_world_tr.xy(0, grid_w))
         a4_draw_text_rotate((wgs_border[2] + 5, grid_border[1]), 0, 0, txt_lat(wgs_ne[0]), -90, grid_font)
         map_draw.text((grid_border[2], wgs_border[1] - 5), txt_lon(wgs_ne[1]), fill='black', align='center', anchor='rb', font=grid_font)
 
         # Show SE corner
-        wgs_se = wgs_tr.transform(*grid_to_world_tr.xy(grid_img.size[1], grid_img.size[0]))
+        wgs_se = wgs_tr.transform(*grid_to_world_tr.xy(grid_h, grid_w))
         a4_draw_text_rotate((wgs_border[2] + 5, grid_border[3]), 0, -1, txt_lat(wgs_se[0]), -90, grid_font)
         map_draw.text((grid_border[2], wgs_border[3] + 5), txt_lon(wgs_se[1]), fill='black', align='center', anchor='rt', font=grid_font)
 
         # Show SW corner
-        wgs_sw = wgs_tr.transform(*grid_to_world_tr.xy(grid_img.size[1], 0))
+        wgs_sw = wgs_tr.transform(*grid_to_world_tr.xy(grid_h, 0))
         a4_draw_text_rotate((wgs_border[0] - 5, grid_border[3]), -1, -1, txt_lat(wgs_sw[0]), 90, grid_font)
         map_draw.text((grid_border[0], wgs_border[3] + 5), txt_lon(wgs_sw[1]), fill='black', align='center', anchor='lt', font=grid_font)
 
@@ -690,8 +1174,6 @@ def draw_control_points(map_img, map_to_world_tr, control_point_settings: dto.Co
     logger.info(f'Drawing control points. ({len(control_points)} points)')
 
     map_supersample = 2
-    cp_img = Image.new('RGBA', [int(p * map_supersample) for p in map_img.size], (0, 0, 0, 0))
-    cp_draw = ImageDraw.Draw(cp_img)
 
     if control_point_settings.cp_font == dto.ControlPointFont.SERIF:
       cp_font = ImageFont.truetype('times.ttf', 60 * map_supersample)
@@ -823,6 +1305,7 @@ def draw_control_points(map_img, map_to_world_tr, control_point_settings: dto.Co
         return int(label_x), int(label_y), anchor
     
     def draw_triangle_cp(x, y, col):
+        y -= strip_oy
         cp_draw.polygon([
             (x, y - cp_size_px),
             (x + cp_size_px * math.cos(math.radians(30)), y + cp_size_px * math.sin(math.radians(30))),
@@ -831,6 +1314,7 @@ def draw_control_points(map_img, map_to_world_tr, control_point_settings: dto.Co
 
     
     def draw_circle_cp(x, y, col):
+        y -= strip_oy
         cp_draw.ellipse(
             (x - cp_size_px, y - cp_size_px,
              x + cp_size_px, y + cp_size_px),
@@ -856,61 +1340,108 @@ def draw_control_points(map_img, map_to_world_tr, control_point_settings: dto.Co
         to_x = to_cp.x - to_radius * math.cos(theta)
         to_y = to_cp.y - to_radius * math.sin(theta)
 
-        cp_draw.line((from_x, from_y, to_x, to_y), fill=from_cp.color_line, width=cp_lines_width_px)
+        cp_draw.line((from_x, from_y - strip_oy, to_x, to_y - strip_oy), fill=from_cp.color_line, width=cp_lines_width_px)
 
-    def draw_name(x, y, anchor, name, color):
-        if control_point_settings.cp_name_shadow:
+    blur_radius = 30
+    shadows = {} # Blurred name shadows, shared between strips
+
+    def get_name_shadow(name):
+        if name not in shadows:
             # Create a blurred shadow of the text
             text_size = cp_font.getbbox(name, anchor='lt')
-            blur_radius = 30
             img_blur = Image.new('L', (text_size[2] + blur_radius * 2, text_size[3] + blur_radius * 2))
             draw_blur = ImageDraw.Draw(img_blur)
             draw_blur.text((blur_radius, blur_radius), name, fill='white', font=cp_font, anchor='lt')
-            img_blur = img_blur.filter(ImageFilter.GaussianBlur(blur_radius/2))
-            dst_box = cp_font.getbbox(name, anchor=anchor)
+            shadows[name] = img_blur.filter(ImageFilter.GaussianBlur(blur_radius/2))
+        return shadows[name]
+
+    def draw_name(x, y, anchor, name, color):
+        dst_box = cp_font.getbbox(name, anchor=anchor)
+        # Skip names that do not reach into the current strip
+        if y + dst_box[3] + blur_radius < strip_oy or y + dst_box[1] - blur_radius > strip_oy + cp_img.size[1]:
+            return
+
+        y -= strip_oy
+        if control_point_settings.cp_name_shadow:
+            img_blur = get_name_shadow(name)
             img_shadow = Image.new('L', img_blur.size, 128)
             cp_img.paste(img_shadow, (int(x - blur_radius + dst_box[0]), int(y - blur_radius + dst_box[1])), mask=img_blur)
 
         # Draw the text
         cp_draw.text((x, y), name, fill=color, align='center', anchor=anchor, font=cp_font)
 
-    for i, cp in pt.over_range(0, 0.5, enumerate(control_points)):
-        if cp.kind == dto.ControlPointKind.SKIP:
-            continue
+    labels = [calculate_label_position(i, cp) for i, cp in enumerate(control_points)]
 
-        x, y = cp.x, cp.y
+    # The supersampled layer is drawn and downsampled one horizontal strip at a time, with a
+    # margin of rows around the strip so that the downsampling filter sees the same pixels
+    strip_margin = 4
+    strip_h = get_strip_height(map_img.size[0] * map_supersample ** 2 * 4 * 2)
+    strips = range(0, map_img.size[1], strip_h)
 
-        # middle dot
-        if cp.kind != dto.ControlPointKind.POINT:
-          cp_draw.ellipse(
-              (x - cp_dot_size_px, y - cp_dot_size_px, x + cp_dot_size_px, y + cp_dot_size_px),
-              fill=cp.color)
-        
-        if cp.connect_next and cp_count > 1:
-            draw_line(cp, next_cp(i))
+    for r0 in pt.over_range(0, 1, strips):
+        r1 = min(r0 + strip_h, map_img.size[1])
+        s0 = max(r0 - strip_margin, 0)
+        s1 = min(r1 + strip_margin, map_img.size[1])
+        strip_oy = s0 * map_supersample
 
-        if cp.kind == dto.ControlPointKind.TRIANGLE:
-            draw_triangle_cp(x, y, cp.color)
-        elif cp.kind == dto.ControlPointKind.CIRCLE:
-            draw_circle_cp(x, y, cp.color)
-        elif cp.kind == dto.ControlPointKind.DOT:
-            pass
-        else:
-            logger.warning(f'Unknown control point kind: {cp.kind}')
+        cp_img = Image.new('RGBA', (map_img.size[0] * map_supersample, (s1 - s0) * map_supersample), (0, 0, 0, 0))
+        cp_draw = ImageDraw.Draw(cp_img)
 
-        label_x, label_y, anchor = calculate_label_position(i, cp)
-        draw_name(label_x, label_y, anchor, cp.name, cp.color)
+        for i, cp in enumerate(control_points):
+            if cp.kind == dto.ControlPointKind.SKIP:
+                continue
 
-    # Downsample the control points image
-    cp_img = cp_img.resize(map_img.size)
-    pt.step(0.75)
+            x, y = cp.x, cp.y
 
-    # Draw the control points on the map
-    map_img.paste(cp_img, (0, 0), cp_img)
+            # middle dot
+            if cp.kind != dto.ControlPointKind.POINT:
+              cp_draw.ellipse(
+                  (x - cp_dot_size_px, y - cp_dot_size_px - strip_oy, x + cp_dot_size_px, y + cp_dot_size_px - strip_oy),
+                  fill=cp.color)
+            
+            if cp.connect_next and cp_count > 1:
+                draw_line(cp, next_cp(i))
+
+            if cp.kind == dto.ControlPointKind.TRIANGLE:
+                draw_triangle_cp(x, y, cp.color)
+            elif cp.kind == dto.ControlPointKind.CIRCLE:
+                draw_circle_cp(x, y, cp.color)
+            elif cp.kind == dto.ControlPointKind.DOT:
+                pass
+            elif r0 == 0:
+                logger.warning(f'Unknown control point kind: {cp.kind}')
+
+            label_x, label_y, anchor = labels[i]
+            draw_name(label_x, label_y, anchor, cp.name, cp.color)
+
+        # Downsample the strip and draw it on the map
+        cp_strip = resample.resize(
+            cp_img,
+            (map_img.size[0], r1 - r0),
+            Image.Resampling.BICUBIC,
+            box=(0, (r0 - s0) * map_supersample, cp_img.size[0], (r1 - s0) * map_supersample))
+        map_img.paste(cp_strip, (0, r0), cp_strip)
 
     pt.step(1)
 
-def draw_markings(map_img, bbox, naslov1, naslov2, dodatno, slikal, slikad, epsg, edge_wgs84, target_scale, raster_source, real_to_map_tr, pt: ProgressTracker = NoProgress):
+def load_logos(slikal: str, slikad: str):
+    """
+    Opens and decodes the left and right logo (None if not set).
+    """
+    logos = []
+    for fn, error in ((slikal, 'Leva slika ni v podprtem formatu.'), (slikad, 'Desna slika ni v podprtem formatu.')):
+        if not fn:
+            logos.append(None)
+            continue
+        try:
+            logo = Image.open(fn)
+            logo.load()
+        except Image.UnidentifiedImageError as e:
+            raise ProgressError(error) from e
+        logos.append(logo)
+    return tuple(logos)
+
+def draw_markings(map_img, bbox, naslov1, naslov2, dodatno, logo_l, logo_d, epsg, edge_wgs84, target_scale, raster_source, real_to_map_tr, pt: ProgressTracker = NoProgress):
     map_draw = ImageDraw.Draw(map_img)
     
     title_font = ImageFont.truetype('times.ttf', 60)
@@ -947,13 +1478,10 @@ def draw_markings(map_img, bbox, naslov1, naslov2, dodatno, slikal, slikad, epsg
     logo_scale = 0.8
     bbox_size = real_to_map_tr.colrow(bbox[2] - bbox[0], bbox[3] - bbox[1])
 
-    if slikal:
-        logger.info(f'Drawing left logo: {slikal}')
-        try:
-            logo_l = Image.open(slikal)
-        except Image.UnidentifiedImageError as e:
-            raise ProgressError(f'Leva slika ni v podprtem formatu.') from e
-
+    if logo_l is not None:
+        logger.info(f'Drawing left logo: {logo_l.filename}')
+        # The logos can be shared between maps, resize a copy
+        logo_l = logo_l.copy()
         logo_l.thumbnail((bbox_size[1] * logo_scale, bbox_size[1] * logo_scale))
         logo_p0 = (
             int(title_p0[0] - title_w / 2 - logo_l.size[0] - logo_margin),
@@ -964,12 +1492,9 @@ def draw_markings(map_img, bbox, naslov1, naslov2, dodatno, slikal, slikad, epsg
         else:
             map_img.paste(logo_l, logo_p0)
 
-    if slikad:
-        logger.info(f'Drawing right logo: {slikad}')
-        try:
-            logo_d = Image.open(slikad)
-        except Image.UnidentifiedImageError as e:
-            raise ProgressError(f'Desna slika ni v podprtem formatu.') from e
+    if logo_d is not None:
+        logger.info(f'Drawing right logo: {logo_d.filename}')
+        logo_d = logo_d.copy()
         logo_d.thumbnail((bbox_size[1] * logo_scale, bbox_size[1] * logo_scale))
         logo_p0 = (
             int(title_p0[0] + title_w / 2 + logo_margin),
@@ -1160,9 +1685,9 @@ def get_preview_image(bounds, epsg, raster_type, raster_source, zoom_adjust, pre
     )
     pt.msg('Pridobivanje podatkov')
     if raster_source != '':
-        grid_raster = get_raster_map(raster_type, raster_source, zoom_adjust, bounds, pt.sub(0, 0.7))
-        grid_img = Image.fromarray(rasterio.plot.reshape_as_image(grid_raster), 'RGB')
-        grid_img = grid_img.resize(target_size, Image.Resampling.LANCZOS)
+        target_resolution = (bounds[2] - bounds[0]) / target_size[0]
+        grid_raster = get_raster_map(raster_type, raster_source, zoom_adjust, bounds, pt.sub(0, 0.7), target_resolution=target_resolution)
+        grid_img = resample.resize(np.ascontiguousarray(rasterio.plot.reshape_as_image(grid_raster)), target_size, Image.Resampling.LANCZOS)
     else:
         grid_img = Image.new('RGB', target_size, 0xFFFFFF)
         logger.info(f'Created blank raster map. ({target_size})')
@@ -1209,11 +1734,13 @@ def dmv_tile_bounds(filename):
 def dmv_get_bounds(dmv125_folder):
     if DMV.loaded_bounds is not None:
         if DMV.loaded_bounds[0] == dmv125_folder:
+            metrics.cache_lookup('dmv_bounds', True)
             return DMV.loaded_bounds[1]
 
     cache_index = get_cache_index({'dmv125_folder': dmv125_folder})
     cache_file = os.path.join(get_cache_dir('tile_bounds'), f'{cache_index}-bounds-cache.json')
     if os.path.exists(cache_file) and USE_CACHE:
+        metrics.cache_lookup('dmv_bounds', True, os.path.getsize(cache_file))
         with open(cache_file, 'r') as f:
             return json.load(f)
 
@@ -1225,12 +1752,13 @@ def dmv_get_bounds(dmv125_folder):
 
     # Save the bounds to the cache
     if USE_CACHE:
-        with open(cache_file, 'w') as f:
+        with cache.atomic_write(cache_file, 'w') as f:
             json.dump(bounds, f)
 
     DMV.loaded_bounds = (dmv125_folder, bounds)
 
     logger.info('DMV tile bounds calculated.')
+    metrics.cache_lookup('dmv_bounds', False, os.path.getsize(cache_file) if USE_CACHE else 0)
     return bounds
 
 def dmv_coord_to_tile(e, n):
@@ -1310,18 +1838,21 @@ def get_world_height(dmv125_folder, e, n):
     """
     if DMV.loaded_file is not None:
         if dmv_is_inside_tile(e, n, DMV.loaded_file[0]):
+            metrics.cache_lookup('dmv_file', True)
             return dmv_get_height(DMV.loaded_file[1], DMV.loaded_file[0], e, n)
         
     tile_fn, tile_bounds = dmv_coord_to_tile_checked(e, n, dmv125_folder)
     if tile_fn is None:
         return 0
     
+    metrics.cache_lookup('dmv_file', False, os.path.getsize(os.path.join(dmv125_folder, tile_fn)))
     with open(os.path.join(dmv125_folder, tile_fn), 'r') as f:
         lines = f.readlines()
         DMV.loaded_file = (tile_bounds, lines)
 
         return dmv_get_height(lines, tile_bounds, e, n)
 
+@metrics.timed('report')
 def create_control_point_report(control_point_settings: dto.ControlPointsConfig, raster_type, raster_folder, title, dmv125_folder, output_file, pt: ProgressTracker = NoProgress):
     cps = control_point_settings.cps
     cp_count = len(cps)
@@ -1410,8 +1941,7 @@ def create_control_point_report(control_point_settings: dto.ControlPointsConfig,
             cp.n + CP_REPORT_PREVIEW_SIZE_RADIUS_M
         )
         cp_preview_raster = get_raster_map(raster_type, raster_folder, 1, cp_preview_bounds)
-        cp_preview_img = Image.fromarray(rasterio.plot.reshape_as_image(cp_preview_raster), 'RGB')
-        cp_preview_img = cp_preview_img.resize(cp_preview_size_px)
+        cp_preview_img = resample.resize(np.ascontiguousarray(rasterio.plot.reshape_as_image(cp_preview_raster)), cp_preview_size_px, Image.Resampling.BICUBIC)
 
         # Draw centering cross
         cp_draw = ImageDraw.Draw(cp_preview_img, 'RGBA')
@@ -1433,17 +1963,19 @@ def create_control_point_report(control_point_settings: dto.ControlPointsConfig,
     # Create timeline page if we have multiple points
     if cp_count > 1:
         pt.msg('Ustvarjanje časovnice')
-        timeline_page = create_timeline_page(cps, title, dmv125_folder, cp_report_page_size_px)
+        timeline_page = create_timeline_page(cps, title, dmv125_folder, cp_report_page_size_px, pt)
         pages.insert(0, timeline_page)
 
-    pages[0].save(output_file, save_all=True, append_images=pages[1:], dpi=(TARGET_DPI, TARGET_DPI), author=PDF_AUTHOR)
+    pt.check()
+    with cache.atomic_write(output_file) as f:
+        pages[0].save(f, format='pdf', save_all=True, append_images=pages[1:], dpi=(TARGET_DPI, TARGET_DPI), author=PDF_AUTHOR)
     pt.step(1)
 
 def calculate_distance(cp1, cp2):
     """Calculate the direct distance between two control points in meters."""
     return math.sqrt((cp2.e - cp1.e) ** 2 + (cp2.n - cp1.n) ** 2)
 
-def create_timeline_page(cps, title, dmv125_folder, page_size_px):
+def create_timeline_page(cps, title, dmv125_folder, page_size_px, pt: ProgressTracker = NoProgress):
     logger.info('Creating timeline report page')
     timeline_page = Image.new('RGB', page_size_px, 'white')
     draw = ImageDraw.Draw(timeline_page)
@@ -1495,6 +2027,7 @@ def create_timeline_page(cps, title, dmv125_folder, page_size_px):
         for _ in range(int(dist / height_sample_step) + 1):
             if dist == 0:
                 break
+            pt.check()
             ratio = current_leg_dist / dist
             sample_e = cp.e + ratio * (next_cp.e - cp.e)
             sample_n = cp.n + ratio * (next_cp.n - cp.n)
@@ -1687,35 +2220,44 @@ def create_timeline_page(cps, title, dmv125_folder, page_size_px):
     
     return timeline_page
 
-def create_map(r: dto.MapCreateRequest, pt: ProgressTracker = NoProgress):
-    # Temp folder
-    output_file = os.path.join(get_cache_dir(f'maps/{r.id}'), 'map.pdf')
-    output_conf = os.path.join(get_cache_dir(f'maps/{r.id}'), 'conf.json')
-    output_cp_report = os.path.join(get_cache_dir(f'maps/{r.id}'), 'cp_report.pdf')
-    output_thumbnail = os.path.join(get_cache_dir(f'maps/{r.id}'), 'thumbnail.webp')
-
-    logger.info(f'Creating map: {r.id} - {r.naslov1} {r.naslov2}')
-
-    if os.path.exists(output_file) and USE_CACHE:
-        pt.step(1)
-        logger.info(f'Map exists (nothing to do). - ({output_file})')
-        return
-    
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+@metrics.timed('draw')
+def render_base(r: dto.MapCreateRequest, raster: Optional[np.ndarray] = None, pt: ProgressTracker = NoProgress):
+    """
+    Draws the parts of the map shared by all its variants, the raster and the grid.
+    Returns the map image and the values draw_variant needs to draw over it.
 
+    Parameters
+    ----------
+    raster : np.ndarray, optional
+        Already fetched raster covering the map bounds, see get_grid_and_map.
+    """
     pt.msg('Pridobivanje podatkov')
-    map_img, grid_img, map_to_world_tr, grid_to_world_tr, real_to_map_tr, map_to_grid = get_grid_and_map((r.map_size_w_m, r.map_size_h_m), (r.map_w, r.map_s, r.map_e, r.map_n), r.raster_type, r.raster_source, r.reamulation_layers, r.zoom_adjust, pt.sub(0, 0.3))
+    map_img, grid_size_px, map_to_world_tr, grid_to_world_tr, real_to_map_tr, map_to_grid = get_grid_and_map((r.map_size_w_m, r.map_size_h_m), (r.map_w, r.map_s, r.map_e, r.map_n), r.raster_type, r.raster_source, r.reamulation_layers, r.zoom_adjust, pt.sub(0, 0.6), raster=raster)
 
     pt.msg('Risanje mreže')
     skip_grid_lines = r.raster_type == dto.RasterType.DTK25
-    border_bottom = draw_grid(map_img, grid_img, map_to_world_tr, grid_to_world_tr, real_to_map_tr, r.raster_type, r.epsg, r.edge_wgs84, map_to_grid, skip_grid_lines, pt.sub(0.3, 0.5))
+    border_bottom = draw_grid(map_img, grid_size_px, map_to_world_tr, grid_to_world_tr, real_to_map_tr, r.raster_type, r.epsg, r.edge_wgs84, map_to_grid, skip_grid_lines, pt.sub(0.6, 1))
+    return map_img, map_to_world_tr, real_to_map_tr, border_bottom
+
+@metrics.timed('draw_variant')
+def draw_variant(r: dto.MapCreateRequest, base: tuple, logos: tuple, pt: ProgressTracker = NoProgress, copy: bool = True):
+    """
+    Draws the control points and markings of the request over the base map (see render_base) and returns the map image.
+
+    Parameters
+    ----------
+    logos : tuple (left, right)
+        Decoded logos, see load_logos.
+    copy : bool
+        Draw over a copy of the base map, so other variants can be drawn over the same base.
+    """
+    map_img, map_to_world_tr, real_to_map_tr, border_bottom = base
+    if copy:
+        map_img = map_img.copy()
 
     if len(r.control_points.cps) > 0:
         pt.msg('Risanje KT')
-        draw_control_points(map_img, map_to_world_tr, r.control_points, pt.sub(0.5, 0.7))
-        cp_title = f'{r.naslov1} {r.naslov2}'
-        pt.msg('Izdelava poročila KT')
-        create_control_point_report(r.control_points, r.raster_type, r.raster_source, cp_title, r.dmv125_folder, output_cp_report, pt.sub(0.7, 0.8))
+        draw_control_points(map_img, map_to_world_tr, r.control_points, pt.sub(0, 0.55))
 
     markings_bbox = (
         GRID_MARGIN_M[3],
@@ -1725,30 +2267,46 @@ def create_map(r: dto.MapCreateRequest, pt: ProgressTracker = NoProgress):
     )
 
     pt.msg('Risanje oznak')
-    draw_markings(map_img, markings_bbox, r.naslov1, r.naslov2, r.dodatno, r.slikal, r.slikad, r.epsg, r.edge_wgs84, r.target_scale, r.raster_type, real_to_map_tr, pt.sub(0.8, 0.9))
+    draw_markings(map_img, markings_bbox, r.naslov1, r.naslov2, r.dodatno, *logos, r.epsg, r.edge_wgs84, r.target_scale, r.raster_type, real_to_map_tr, pt.sub(0.55, 1))
+    return map_img
 
-    logger.info(f'Saving map to: {output_file}')
-    pt.msg('Izdelava predogleda karte')
-    thumbnail = map_img.copy()
-    thumbnail.thumbnail((1024, 1024))
-    thumbnail.save(output_thumbnail)
-    
-    # Save the map using img2pdf (PIL uses JPEG compression for PDFs)
-    with tempfile.TemporaryFile() as tf:
-        pt.msg('Optimizacija karte')
-        map_img.save(tf, format='png', dpi=(TARGET_DPI, TARGET_DPI), optimize=True)
-        pt.step(0.95)
-        tf.seek(0)
-        pt.msg('Shranjevanje karte')
-        with open(output_file, 'wb') as f:
-            f.write(img2pdf.convert(
-                tf,
-                title=r.naslov1,
-                subject=r.naslov2,
-                author=PDF_AUTHOR,
-                producer=f'Topograf {r.id}'
-            ))
-    
+def render_map(r: dto.MapCreateRequest, raster: Optional[np.ndarray] = None, pt: ProgressTracker = NoProgress, logos: Optional[tuple] = None):
+    """
+    Draws the map with the raster, grid, control points and markings and returns the map image.
+
+    Parameters
+    ----------
+    raster : np.ndarray, optional
+        Already fetched raster covering the map bounds, see get_grid_and_map.
+    logos : tuple (left, right), optional
+        Already decoded logos, see load_logos.
+    """
+    if logos is None:
+        logos = load_logos(r.slikal, r.slikad)
+    base = render_base(r, raster, pt.sub(0, 0.65))
+    return draw_variant(r, base, logos, pt.sub(0.65, 1), copy=False)
+
+def save_thumbnail(map_img: Image.Image, output_thumbnail: str):
+    """
+    Saves a thumbnail of the map (at most 1024 px) as WebP.
+
+    The map is resized one horizontal strip at a time (see paste_raster), so it is never copied as a whole.
+    """
+    thumbnail_scale = min(1024 / map_img.size[0], 1024 / map_img.size[1], 1)
+    thumbnail_size = (max(1, round(map_img.size[0] * thumbnail_scale)), max(1, round(map_img.size[1] * thumbnail_scale)))
+    scale_y = map_img.size[1] / thumbnail_size[1]
+    factor = resample.get_reduce_factor(map_img.size, thumbnail_size)
+    strip_h = get_strip_height(math.ceil(scale_y) * map_img.size[0] * len(map_img.getbands()) * 2)
+
+    thumbnail = Image.new(map_img.mode, thumbnail_size)
+    for r0 in range(0, thumbnail_size[1], strip_h):
+        r1 = min(r0 + strip_h, thumbnail_size[1])
+        strip = resample.resize(map_img, (thumbnail_size[0], r1 - r0), Image.Resampling.BICUBIC, box=(0, r0 * scale_y, map_img.size[0], r1 * scale_y), factor=factor)
+        thumbnail.paste(strip, (0, r0))
+    with cache.atomic_write(output_thumbnail) as f:
+        thumbnail.save(f, format='webp')
+
+def save_map_conf(r: dto.MapCreateRequest, output_conf: str):
     # Save the configuration (remove full paths)
     r.output_folder = os.path.basename(r.output_folder)
     r.raster_source = os.path.basename(r.raster_source)
@@ -1756,8 +2314,360 @@ def create_map(r: dto.MapCreateRequest, pt: ProgressTracker = NoProgress):
         r.raster_source = os.path.basename(r.raster_source)
     r.slikal = os.path.basename(r.slikal)
     r.slikad = os.path.basename(r.slikad)
-    with open(output_conf, 'w') as f:
+    with cache.atomic_write(output_conf, 'w') as f:
         f.write(r.model_dump_json())
+
+def get_map_raster(r: dto.MapCreateRequest, pt: ProgressTracker = NoProgress):
+    """
+    Fetches the raster of the map at the resolution of its grid (the same as get_grid_and_map), None without a raster.
+    """
+    if r.raster_source == '':
+        return None
+    _, _, _, grid_size_px = get_map_layout((r.map_size_w_m, r.map_size_h_m))
+    bounds = (r.map_w, r.map_s, r.map_e, r.map_n)
+    pt.msg('Pridobivanje podatkov')
+    return get_raster_map(r.raster_type, r.raster_source, r.zoom_adjust, bounds, pt, target_resolution=(bounds[2] - bounds[0]) / grid_size_px[0])
+
+def save_map_pdf(r: dto.MapCreateRequest, map_png: bytes, output_file: str, pt: ProgressTracker = NoProgress):
+    # Save the map using img2pdf (PIL uses JPEG compression for PDFs), it embeds the PNG data as it is
+    pt.msg('Shranjevanje karte')
+    with metrics.stage_timer('pdf'), cache.atomic_write(output_file) as f:
+        f.write(img2pdf.convert(
+            map_png,
+            title=r.naslov1,
+            subject=r.naslov2,
+            author=PDF_AUTHOR,
+            producer=f'Topograf {r.id}'
+        ))
+    pt.step(1)
+
+def get_variant_requests(r: dto.MapCreateRequest):
+    """
+    Returns the request itself followed by a copy of it for every variant, with the control points and titles of the variant.
+    """
+    return [r] + [
+        r.model_copy(deep=True, update={
+            'naslov1': variant.naslov1,
+            'naslov2': variant.naslov2,
+            'dodatno': variant.dodatno,
+            'control_points': variant.control_points,
+            'variants': [],
+        })
+        for variant in r.variants
+    ]
+
+def get_variant_output_files(r: dto.MapCreateRequest, variant: int):
+    """
+    Returns the map, control point report, thumbnail and GeoTIFF files of the variant, variant 0 is the map of the request itself.
+    """
+    map_dir = get_cache_dir(f'maps/{r.id}')
+    suffix = f'-{variant}' if variant > 0 else ''
+    return (
+        os.path.join(map_dir, f'map{suffix}.pdf'),
+        os.path.join(map_dir, f'cp_report{suffix}.pdf'),
+        os.path.join(map_dir, f'thumbnail{suffix}.webp'),
+        os.path.join(map_dir, f'map{suffix}.tif'),
+    )
+
+def create_map(r: dto.MapCreateRequest, pt: ProgressTracker = NoProgress):
+    # Temp folder
+    output_conf = os.path.join(get_cache_dir(f'maps/{r.id}'), 'conf.json')
+    variant_requests = get_variant_requests(r)
+    output_files = [get_variant_output_files(r, i) for i in range(len(variant_requests))]
+    # The maps (and their GeoTIFFs) are saved last, once they exist the map is complete
+    required_files = [output_file for output_file, _, _, _ in output_files] + ([output_geotiff for _, _, _, output_geotiff in output_files] if r.geotiff else [])
+
+    logger.info(f'Creating map: {r.id} - {r.naslov1} {r.naslov2}')
+
+    if all(os.path.exists(fn) for fn in required_files) and USE_CACHE:
+        pt.step(1)
+        logger.info(f'Map exists (nothing to do). - ({output_files[0][0]})')
+        metrics.cache_lookup('map', True, sum(os.path.getsize(fn) for fn in required_files))
+        return
+    
+    os.makedirs(os.path.dirname(output_conf), exist_ok=True)
+    logger.info(f'Saving map to: {output_files[0][0]}')
+
+    # The raster and the grid are drawn once, the control points and markings of every variant over a copy of them
+    count = len(variant_requests)
+    has_report = [len(v.control_points.cps) > 0 for v in variant_requests]
+    report_count = sum(has_report)
+
+    def get_range(min_value, max_value, i, n):
+        return (min_value + (max_value - min_value) * i / n, min_value + (max_value - min_value) * (i + 1) / n)
+
+    # The GeoTIFF is georeferenced with the same transform the map is drawn with (see get_grid_and_map)
+    _, map_size_px, grid_margin_px, grid_size_px = get_map_layout((r.map_size_w_m, r.map_size_h_m))
+    map_transform = get_map_transform((r.map_w, r.map_s, r.map_e, r.map_n), map_size_px, grid_margin_px, grid_size_px)
+    encode_range = (0.9 if report_count > 0 else 0.8, 0.95)
+
+    map_stages = [
+        stages.Stage('raster', lambda pt: get_map_raster(r, pt), progress=(0, 0.16)),
+        stages.Stage('logos', lambda pt: load_logos(r.slikal, r.slikad)),
+        stages.Stage('base', lambda pt, raster: render_base(r, raster, pt), ['raster'], progress=(0.16, 0.58)),
+    ]
+    for i, v in enumerate(variant_requests):
+        output_file, output_cp_report, output_thumbnail, output_geotiff = output_files[i]
+
+        # The report only needs the request, it is created while the map is drawn. Drawing the map
+        # names the control points and stores their positions on them, the report gets its own copy.
+        report_control_points = v.control_points.model_copy(deep=True)
+        cp_title = f'{v.naslov1} {v.naslov2}'
+
+        def create_report(pt, *previous_report, report_control_points=report_control_points, cp_title=cp_title, output_cp_report=output_cp_report):
+            pt.msg('Izdelava poročila KT')
+            create_control_point_report(report_control_points, r.raster_type, r.raster_source, cp_title, r.dmv125_folder, output_cp_report, pt)
+
+        def create_thumbnail(pt, map_img, output_thumbnail=output_thumbnail):
+            pt.msg('Izdelava predogleda karte')
+            save_thumbnail(map_img, output_thumbnail)
+
+        def encode_map(pt, map_img):
+            pt.msg('Optimizacija karte')
+            return encode_png(map_img, dpi=(TARGET_DPI, TARGET_DPI), pt=pt)
+
+        def save_map_geotiff(pt, map_img, output_geotiff=output_geotiff):
+            pt.msg('Shranjevanje GeoTIFF')
+            with metrics.stage_timer('geotiff'), cache.atomic_path(output_geotiff) as tmp_fn:
+                geotiff.save_geotiff(map_img, map_transform, tmp_fn, pt=pt)
+
+        if has_report[i]:
+            # The reports run one after another, the height profile is drawn through the global pyplot
+            # state and the heights are read through the shared DMV tile cache
+            previous_reports = [f'report_{j}' for j in range(i) if has_report[j]][-1:]
+            map_stages.append(stages.Stage(f'report_{i}', create_report, previous_reports, progress=get_range(0.8, 0.9, sum(has_report[:i]), report_count)))
+        map_stages += [
+            stages.Stage(f'map_{i}', lambda pt, base, logos, v=v: draw_variant(v, base, logos, pt, copy=count > 1), ['base', 'logos'], progress=get_range(0.58, 0.8, i, count)),
+            stages.Stage(f'thumbnail_{i}', create_thumbnail, [f'map_{i}']),
+            stages.Stage(f'png_{i}', encode_map, [f'map_{i}'], progress=get_range(*encode_range, 2 * i, 2 * count) if r.geotiff else get_range(*encode_range, i, count)),
+            stages.Stage(f'pdf_{i}', lambda pt, map_png, v=v, output_file=output_file: save_map_pdf(v, map_png, output_file, pt), [f'png_{i}'], progress=get_range(0.95, 1, i, count)),
+        ]
+        if r.geotiff:
+            map_stages.append(stages.Stage(f'geotiff_{i}', save_map_geotiff, [f'map_{i}'], progress=get_range(*encode_range, 2 * i + 1, 2 * count)))
+
+    stages.run_stages(map_stages, pt)
+
+    save_map_conf(r, output_conf)
+    metrics.cache_lookup('map', False, sum(os.path.getsize(fn) for fn in required_files))
+    pt.step(1)
+    pt.msg('Končano')
+
+def get_atlas_pages(r: dto.MapAtlasRequest):
+    """
+    Splits the atlas area into pages of the requested paper size at the target scale.
+
+    Neighbouring pages overlap by atlas_overlap (fraction of the page) and the pages are centered
+    over the requested area. Returns the bounds of all pages together and a list of (label, bounds)
+    tuples in reading order. EPSG:3794
+    """
+    page_w = (r.map_size_w_m - GRID_MARGIN_M[1] - GRID_MARGIN_M[3]) * r.target_scale
+    page_h = (r.map_size_h_m - GRID_MARGIN_M[0] - GRID_MARGIN_M[2]) * r.target_scale
+    step_w = page_w * (1 - r.atlas_overlap)
+    step_h = page_h * (1 - r.atlas_overlap)
+
+    cols = max(1, math.ceil((r.map_e - r.map_w - page_w) / step_w) + 1)
+    rows = max(1, math.ceil((r.map_n - r.map_s - page_h) / step_h) + 1)
+    if cols * rows > ATLAS_MAX_PAGES:
+        raise ProgressError(f'Atlas ima preveč listov ({cols * rows}, max {ATLAS_MAX_PAGES})')
+
+    atlas_w = page_w + (cols - 1) * step_w
+    atlas_h = page_h + (rows - 1) * step_h
+    west = (r.map_w + r.map_e - atlas_w) / 2
+    north = (r.map_s + r.map_n + atlas_h) / 2
+
+    pages = []
+    for row in range(rows):
+        for col in range(cols):
+            page_west = west + col * step_w
+            page_north = north - row * step_h
+            pages.append((f'{chr(ord("A") + row)}{col + 1}', (page_west, page_north - page_h, page_west + page_w, page_north)))
+
+    return (west, north - atlas_h, west + atlas_w, north), pages
+
+# Process ids of the atlas page workers (0 for a free slot), filled in by the workers, so a cancelled request can stop them
+atlas_worker_pids = None
+
+def init_atlas_worker(output_dir: str, worker_pids):
+    global OUTPUT_DIR
+    OUTPUT_DIR = output_dir
+    with worker_pids.get_lock():
+        for i in range(len(worker_pids)):
+            if worker_pids[i] == 0:
+                worker_pids[i] = os.getpid()
+                break
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    # The cancellation handler of the main process is inherited, workers are stopped with kill_atlas_workers()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # The metrics of the main process are inherited as well, they are flushed by the main process
+    metrics.reset()
+
+def kill_atlas_workers(sig: int):
+    """
+    Sends the signal to the atlas page workers of the running request, if any.
+    """
+    worker_pids = atlas_worker_pids
+    if worker_pids is None:
+        return
+    for pid in worker_pids[:]:
+        if pid == 0:
+            continue
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            pass
+
+def render_atlas_page(r: dto.MapCreateRequest, raster_cache_fn: Optional[str], window: Optional[tuple[int]]):
+    """
+    Renders one atlas page in a worker process and returns it encoded as PNG.
+
+    The raster of the whole atlas is memory mapped from the cache, so the workers share it
+    through the page cache and only read the window of their page.
+    """
+    raster = None
+    if raster_cache_fn is not None:
+        r0, r1, c0, c1 = window
+        raster = np.load(raster_cache_fn, mmap_mode='r')[:, r0:r1, c0:c1]
+
+    map_img = render_map(r, raster)
+    logger.info(f'Rendered atlas page. - ({r.map_w}, {r.map_s}, {r.map_e}, {r.map_n})')
+    page_png = encode_png(map_img, dpi=(TARGET_DPI, TARGET_DPI))
+    flush_metrics()
+    return page_png
+
+def draw_atlas_index(r: dto.MapAtlasRequest, atlas_bounds: tuple[float], pages: list[tuple], raster_cache_fn: Optional[str], raster_window: Optional[tuple[int]]):
+    """
+    Draws the index sheet of the atlas, an overview of the whole area with the outlines and labels of the pages.
+    raster_window is the window of the atlas area in the cached raster.
+    """
+    target_pxpm = TARGET_DPI / 0.0254
+    index_img = Image.new('RGB', (int(r.map_size_w_m * target_pxpm), int(r.map_size_h_m * target_pxpm)), 0xFFFFFF)
+    index_draw = ImageDraw.Draw(index_img)
+    margin_px = [int(m * target_pxpm) for m in GRID_MARGIN_M]
+
+    title_font = ImageFont.truetype('times.ttf', 60)
+    info_font = ImageFont.truetype('timesi.ttf', 28)
+    label_font = ImageFont.truetype('timesbi.ttf', 96)
+
+    index_draw.text((index_img.size[0] // 2, margin_px[0]), f'{r.naslov1} {r.naslov2}'.strip(), fill=0, font=title_font, anchor='mt')
+    index_draw.text((index_img.size[0] // 2, margin_px[0] + 80), f'Pregled listov - {len(pages)} listov v merilu 1:{r.target_scale}', fill=0, font=info_font, anchor='mt')
+
+    # Fit the atlas area into the sheet below the title
+    area = (margin_px[3], margin_px[0] + 140, index_img.size[0] - margin_px[1], index_img.size[1] - margin_px[2])
+    atlas_w = atlas_bounds[2] - atlas_bounds[0]
+    atlas_h = atlas_bounds[3] - atlas_bounds[1]
+    scale = min((area[2] - area[0]) / atlas_w, (area[3] - area[1]) / atlas_h)
+    size = (max(1, round(atlas_w * scale)), max(1, round(atlas_h * scale)))
+    offset = (area[0] + (area[2] - area[0] - size[0]) // 2, area[1] + (area[3] - area[1] - size[1]) // 2)
+
+    if raster_cache_fn is not None:
+        r0, r1, c0, c1 = raster_window
+        raster = np.load(raster_cache_fn, mmap_mode='r')[:, r0:r1, c0:c1]
+        # Only read every n-th pixel of the raster, the overview is much smaller anyway
+        stride = max(1, min(raster.shape[1] // size[1], raster.shape[2] // size[0]))
+        overview = np.ascontiguousarray(rasterio.plot.reshape_as_image(raster[:, ::stride, ::stride]))
+        index_img.paste(resample.resize(overview, size, Image.Resampling.LANCZOS), offset)
+
+    def world_to_index(x, y):
+        return (offset[0] + (x - atlas_bounds[0]) * scale, offset[1] + (atlas_bounds[3] - y) * scale)
+
+    for label, bounds in pages:
+        x0, y0 = world_to_index(bounds[0], bounds[3])
+        x1, y1 = world_to_index(bounds[2], bounds[1])
+        index_draw.rectangle((x0, y0, x1, y1), outline=(255, 0, 0), width=4)
+        index_draw.text(((x0 + x1) / 2, (y0 + y1) / 2), label, fill=(255, 0, 0), font=label_font, anchor='mm', stroke_width=4, stroke_fill=(255, 255, 255))
+
+    index_draw.rectangle((offset[0], offset[1], offset[0] + size[0], offset[1] + size[1]), outline=0, width=2)
+    return index_img
+
+def map_atlas(r: dto.MapAtlasRequest, pt: ProgressTracker = NoProgress):
+    global atlas_worker_pids
+    output_file = os.path.join(get_cache_dir(f'maps/{r.id}'), 'map.pdf')
+    output_conf = os.path.join(get_cache_dir(f'maps/{r.id}'), 'conf.json')
+    output_cp_report = os.path.join(get_cache_dir(f'maps/{r.id}'), 'cp_report.pdf')
+    output_thumbnail = os.path.join(get_cache_dir(f'maps/{r.id}'), 'thumbnail.webp')
+
+    logger.info(f'Creating atlas: {r.id} - {r.naslov1} {r.naslov2}')
+
+    if os.path.exists(output_file) and USE_CACHE:
+        pt.step(1)
+        logger.info(f'Atlas exists (nothing to do). - ({output_file})')
+        metrics.cache_lookup('map', True, os.path.getsize(output_file))
+        return
+
+    atlas_bounds, pages = get_atlas_pages(r)
+    logger.info(f'Atlas has {len(pages)} pages. - ({atlas_bounds})')
+
+    # Fetch the raster for the whole atlas once, every page only reads its window of it
+    raster_cache_fn = None
+    atlas_window = None
+    windows = [None] * len(pages)
+    if r.raster_source != '':
+        pt.msg('Pridobivanje podatkov')
+        # Every page is printed at the target scale
+        target_resolution = r.target_scale / (TARGET_DPI / 0.0254)
+        atlas_raster, raster_cache_fn, cache_bounds = get_raster_mosaic(r.raster_type, r.raster_source, r.zoom_adjust, atlas_bounds, pt.sub(0, 0.2), max_files=ATLAS_MAX_FILES, target_resolution=target_resolution)
+        atlas_window = get_raster_window(cache_bounds, atlas_raster.shape, atlas_bounds)
+        windows = [get_raster_window(cache_bounds, atlas_raster.shape, bounds) for _, bounds in pages]
+        del atlas_raster
+    pt.step(0.2)
+
+    # Deep copies, the control points are modified while drawing and by the report
+    page_requests = [
+        r.model_copy(deep=True, update={
+            'map_w': bounds[0], 'map_s': bounds[1], 'map_e': bounds[2], 'map_n': bounds[3],
+            'dodatno': ' - '.join(filter(None, [r.dodatno, f'List {label}'])),
+        })
+        for label, bounds in pages
+    ]
+
+    workers = min(ATLAS_MAX_WORKERS or os.cpu_count() or 1, len(pages))
+    page_pngs = [None] * len(pages)
+    atlas_worker_pids = multiprocessing.Array('i', workers)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_atlas_worker, initargs=(OUTPUT_DIR, atlas_worker_pids)) as executor:
+            futures = {
+                executor.submit(render_atlas_page, page_request, raster_cache_fn, window): i
+                for i, (page_request, window) in enumerate(zip(page_requests, windows))
+            }
+
+            # The report and the index sheet do not depend on the pages, create them while the pages render
+            if len(r.control_points.cps) > 0:
+                pt.msg('Izdelava poročila KT')
+                create_control_point_report(r.control_points, r.raster_type, r.raster_source, f'{r.naslov1} {r.naslov2}', r.dmv125_folder, output_cp_report, pt.sub(0.2, 0.3))
+
+            index_img = draw_atlas_index(r, atlas_bounds, pages, raster_cache_fn, atlas_window)
+            save_thumbnail(index_img, output_thumbnail)
+            index_png = encode_png(index_img, dpi=(TARGET_DPI, TARGET_DPI))
+            del index_img
+
+            pt.msg(f'Izdelava listov ({workers} procesov)')
+            pending = set(futures)
+            try:
+                while len(pending) > 0:
+                    done, pending = concurrent.futures.wait(pending, timeout=CANCEL_POLL_S, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        page_pngs[futures[future]] = future.result()
+                    pt.step(0.3 + 0.6 * (len(pages) - len(pending)) / len(pages))
+            except ProgressCancelled:
+                # Stop the pages that are still rendering instead of waiting for them
+                executor.shutdown(wait=False, cancel_futures=True)
+                kill_atlas_workers(signal.SIGTERM)
+                raise
+    finally:
+        atlas_worker_pids = None
+
+    pt.msg('Shranjevanje karte')
+    with metrics.stage_timer('pdf'), cache.atomic_write(output_file) as f:
+        f.write(img2pdf.convert(
+            [index_png] + page_pngs,
+            title=r.naslov1,
+            subject=r.naslov2,
+            author=PDF_AUTHOR,
+            producer=f'Topograf {r.id}'
+        ))
+
+    save_map_conf(r, output_conf)
+    metrics.cache_lookup('map', False, os.path.getsize(output_file))
     pt.step(1)
     pt.msg('Končano')
 
@@ -1775,10 +2685,106 @@ def map_preview(r: dto.MapPreviewRequest, pt: ProgressTracker = NoProgress):
     output_file = os.path.join(get_cache_dir('map_previews'), f'{r.id}.png')
 
     pt.msg('Shranjevanje predogleda')
-    grid_img.save(output_file, dpi=(TARGET_DPI, TARGET_DPI))
+    with cache.atomic_write(output_file) as f:
+        save_png(grid_img, f, dpi=(TARGET_DPI, TARGET_DPI))
+    pt.step(1)
+    pt.msg('Končano')
+
+def map_prefetch(r: dto.MapPrefetchRequest, pt: ProgressTracker = NoProgress):
+    """
+    Only fetches the raster of the area into the cache (downloading the tiles or merging the raster
+    files), so the preview and the map of the area are cache hits once they are requested.
+    """
+    logger.info(f'Prefetching raster. ({r.map_w}, {r.map_s}, {r.map_e}, {r.map_n}, {r.raster_source})')
+    if r.raster_source == '':
+        pt.step(1)
+        return
+
+    # The resolution of the preview, the mosaics of tile servers depend on it
+    preview_width_px = int((r.map_size_w_m - GRID_MARGIN_M[1] - GRID_MARGIN_M[3]) * TARGET_DPI / 0.0254)
+    target_resolution = (r.map_e - r.map_w) / preview_width_px
+
+    pt.msg('Pridobivanje podatkov')
+    get_raster_map(r.raster_type, r.raster_source, r.zoom_adjust, (r.map_w, r.map_s, r.map_e, r.map_n), pt.sub(0, 1), target_resolution=target_resolution)
     pt.step(1)
     pt.msg('Končano')
 
+def get_palette_image(img: Image.Image):
+    """
+    Returns the RGB image converted to an 8-bit palette image, or None if it has too many colors.
+
+    Images with at most 256 colors are converted exactly. Otherwise an adaptive palette is used
+    if the mean error (sampled on every 4th row) stays below PNG_PALETTE_MAX_ERROR.
+    The adaptive palette is computed on a reduced copy and every pixel gets the nearest palette color,
+    which is faster and keeps the dominant (raster) colors closer than quantizing the whole image.
+    """
+    if not PNG_PALETTE or img.mode != 'RGB':
+        return None
+
+    colors = img.getcolors(256)
+    if colors is not None:
+        # Exact indices by looking up the packed colors (quantize maps to the palette through a reduced precision cache)
+        palette = np.array(sorted(color for _, color in colors), dtype=np.uint32)
+        packed_palette = (palette[:, 0] << 16) | (palette[:, 1] << 8) | palette[:, 2]
+        exact = Image.new('P', img.size)
+        exact.putpalette(palette.astype(np.uint8).ravel().tolist())
+        for y0 in range(0, img.size[1], 256):
+            box = (0, y0, img.size[0], min(y0 + 256, img.size[1]))
+            strip = np.asarray(img.crop(box)).astype(np.uint32)
+            indices = np.searchsorted(packed_palette, (strip[..., 0] << 16) | (strip[..., 1] << 8) | strip[..., 2]).astype(np.uint8)
+            exact.paste(Image.frombytes('P', (box[2] - box[0], box[3] - box[1]), indices.tobytes()), box[:2])
+        return exact
+
+    palette = img.reduce(4).quantize(256, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+    quantized = img.quantize(palette=palette, dither=Image.Dither.NONE)
+    lut = np.array(quantized.getpalette()[:256 * 3], dtype=np.int16).reshape(-1, 3)
+    error = 0
+    samples = 0
+    for y0 in range(0, img.size[1], 256):
+        box = (0, y0, img.size[0], min(y0 + 256, img.size[1]))
+        original = np.asarray(img.crop(box))[::4].astype(np.int16)
+        approximated = lut[np.asarray(quantized.crop(box))[::4]]
+        error += np.abs(original - approximated).sum()
+        samples += original.size
+
+    mean_error = error / max(samples, 1)
+    if mean_error > PNG_PALETTE_MAX_ERROR:
+        logger.info(f'Saving as RGB, palette error too large. ({mean_error:.2f})')
+        return None
+    return quantized
+
+@metrics.timed('encode')
+def encode_png(img: Image.Image, dpi: Optional[tuple[int]] = None, pt: ProgressTracker = NoProgress):
+    """
+    Encodes the image as PNG, as a palette PNG if possible (see get_palette_image), and returns the encoded bytes.
+    The image is compressed in strips on several threads, see png_encoder.encode_png.
+    """
+    palette_img = get_palette_image(img)
+    return png_encoder.encode_png(palette_img if palette_img is not None else img, dpi, pt)
+
+def save_png(img: Image.Image, f, dpi: Optional[tuple[int]] = None):
+    """
+    Saves the image as PNG, see encode_png.
+    """
+    f.write(encode_png(img, dpi))
+
+def encode_empty_png(width: int, height: int):
+    """
+    Encodes a fully transparent RGBA PNG without allocating the image in memory.
+    """
+    # Every scanline is a filter byte (none) followed by transparent pixels
+    row = bytes(width * 4 + 1)
+    compressor = zlib.compressobj(9)
+    idat = [compressor.compress(row) for _ in range(height)]
+    idat.append(compressor.flush())
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        png_encoder.png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+        png_encoder.png_chunk(b'IDAT', b''.join(idat)),
+        png_encoder.png_chunk(b'IEND', b''),
+    ])
+
 def map_reambulation(r: dto.MapReambulationRequest, pt: ProgressTracker = NoProgress):
     pt.step(0)
     logger.info(f'Creating map reambulation. ({r.map_w}, {r.map_s}, {r.map_e}, {r.map_n}, {r.epsg}, {r.raster_source})')
@@ -1787,9 +2793,6 @@ def map_reambulation(r: dto.MapReambulationRequest, pt: ProgressTracker = NoProg
     pt.msg('Pridobivanje rasterskih podatkov')
     raster_layer = get_raster_map(r.raster_type, r.raster_source, r.zoom_adjust, bounds, pt.sub(0.3, 0.4))
     raster_img = Image.fromarray(rasterio.plot.reshape_as_image(raster_layer), 'RGB')
-
-    pt.msg('Ustvarjanje reambulacijskega sloja')
-    reambulation_img = Image.new('RGBA', raster_img.size, (0, 0, 0, 0))
     pt.step(0.4)
 
     pt.msg('Risanje mreže')
@@ -1798,43 +2801,42 @@ def map_reambulation(r: dto.MapReambulationRequest, pt: ProgressTracker = NoProg
 
     file_bounds = f'{r.map_w}_{r.map_s}_{r.map_e}_{int(r.map_n)}'
 
-    work_dir = get_cache_dir('create_reambulation')
-    this_work_dir = os.path.join(work_dir, r.id)
-    os.makedirs(this_work_dir, exist_ok=True)
-
-    pt.msg('Shranjevanje slojev')
-    reambulation_img.save(os.path.join(this_work_dir, f'reambulacija-{file_bounds}.png'))
-    pt.step(0.6)
-    grid_img.save(os.path.join(this_work_dir, f'koordinate-{file_bounds}.png'))
-    pt.step(0.7)
-    raster_img.save(os.path.join(this_work_dir, f'osnova-{file_bounds}.png'))
-    pt.step(0.8)
-
     transform = rasterio.transform.from_bounds(r.map_w, r.map_s, r.map_e, r.map_n, *raster_img.size)
-    world_file = [
+    world_file = ''.join([
         f'{transform.a}\n',
         f'{transform.d}\n',
         f'{transform.b}\n',
         f'{transform.e}\n',
         f'{transform.c}\n',
         f'{transform.f}\n',
-    ]
-    for name in ['osnova', 'koordinate', 'reambulacija']:
-        with open(os.path.join(this_work_dir, f'{name}-{file_bounds}.pgw'), 'w') as f:
-            f.writelines(world_file)
+    ])
+
+    dst_file = os.path.join(get_cache_dir('reambulations'), f'{r.id}.zip')
 
-    pt.msg('Arhiviranje slojev')
-    dst_dir = get_cache_dir('reambulations')
-    shutil.make_archive(os.path.join(dst_dir, r.id), 'zip', this_work_dir)
+    # Encode the layers in parallel and stream them into the archive as they finish.
+    # PNG data is already compressed, so it is stored without recompression.
+    pt.msg('Shranjevanje slojev')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        layers = {
+            executor.submit(encode_empty_png, *raster_img.size): 'reambulacija',
+            executor.submit(encode_png, grid_img): 'koordinate',
+            executor.submit(encode_png, raster_img): 'osnova',
+        }
+        with cache.atomic_write(dst_file) as f, zipfile.ZipFile(f, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            for name in layers.values():
+                zf.writestr(f'{name}-{file_bounds}.pgw', world_file)
+
+            for i, future in enumerate(concurrent.futures.as_completed(layers)):
+                zf.writestr(f'{layers[future]}-{file_bounds}.png', future.result(), compress_type=zipfile.ZIP_STORED)
+                pt.step(0.5 + 0.5 * (i + 1) / len(layers))
 
-    shutil.rmtree(this_work_dir, ignore_errors=True)
     pt.step(1)
     pt.msg('Končano')
 
 def store_error(request: dto.MapBaseRequest, e: Exception, argv: list[str]):
     error_file = os.path.join(get_cache_dir('errors'), f'{request.id}.json')
 
-    with open(error_file, 'w') as f:
+    with cache.atomic_write(error_file, 'w') as f:
         f.write(json.dumps({
             'timestamp': datetime.datetime.now().isoformat(),
             'type': type(e).__name__,
@@ -1843,9 +2845,289 @@ def store_error(request: dto.MapBaseRequest, e: Exception, argv: list[str]):
             'traceback': traceback.format_exc().splitlines(),
           }, indent=2))
 
+def flush_metrics():
+    """
+    Merges the metrics of this process into the snapshot in the output folder, see metrics.flush.
+    """
+    try:
+        metrics.flush(get_cache_dir('metrics'))
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        # Metrics must not fail the request
+        logger.warning(f'Could not write the metrics: {e}')
+
+def get_cancel_fn(r: dto.MapBaseRequest):
+    """
+    Sentinel file that cancels the request once it is created.
+    """
+    return os.path.join(r.output_folder, 'cancel', r.id)
+
+def create_cancellation_token(r: dto.MapBaseRequest, cancelled: Optional[Callable[[], bool]] = None):
+    """
+    Returns a token that is cancelled when the sentinel file of the request exists or cancelled returns True.
+    """
+    cancel_fn = get_cancel_fn(r)
+    def poll():
+        return os.path.exists(cancel_fn) or (cancelled is not None and cancelled())
+    return CancellationToken(poll, CANCEL_POLL_S)
+
+def remove_partial_outputs(r: dto.MapBaseRequest):
+    """
+    Removes the outputs of a cancelled request. Caches and single files are written atomically,
+    only the map folder can be left with some of its files.
+    """
+    if r.request_type in (dto.RequestType.CREATE_MAP, dto.RequestType.MAP_ATLAS):
+        map_dir = os.path.join(r.output_folder, 'maps', r.id)
+        if not os.path.exists(os.path.join(map_dir, 'map.pdf')):
+            shutil.rmtree(map_dir, ignore_errors=True)
+
+def watch_cancellation(r: dto.MapBaseRequest, token: CancellationToken, emit_progress: bool):
+    """
+    Exits the process if the request does not stop within CANCEL_GRACE_S after it was cancelled.
+    The cancellation is only checked between the steps of the request, not inside long native calls
+    (eg. encoding a large image).
+    """
+    while not token.is_cancelled():
+        time.sleep(CANCEL_POLL_S)
+    time.sleep(CANCEL_GRACE_S)
+
+    logger.warning(f'Request did not stop in {CANCEL_GRACE_S}s after it was cancelled, exiting.')
+    if emit_progress:
+        print(f'ERROR: {ProgressCancelled()}', file=sys.stderr, flush=True)
+    # The atlas page workers would otherwise keep running and hold the output pipes open
+    kill_atlas_workers(signal.SIGKILL)
+    cache.remove_pending_writes()
+    remove_partial_outputs(r)
+    if os.path.exists(get_cancel_fn(r)):
+        os.remove(get_cancel_fn(r))
+    os._exit(1)
+
+def run_request(request: dto.MapBaseRequest, pt: ProgressTracker = NoProgress):
+    global OUTPUT_DIR
+    OUTPUT_DIR = request.output_folder
+
+    metrics.set_default_labels(request_type=request.request_type.value)
+    start = time.monotonic()
+    status = 'error'
+    try:
+        if request.request_type == dto.RequestType.CREATE_MAP:
+            create_map(request, pt)
+        elif request.request_type == dto.RequestType.MAP_PREVIEW:
+            map_preview(request, pt)
+        elif request.request_type == dto.RequestType.MAP_REAMBULATION:
+            map_reambulation(request, pt)
+        elif request.request_type == dto.RequestType.MAP_ATLAS:
+            map_atlas(request, pt)
+        elif request.request_type == dto.RequestType.MAP_PREFETCH:
+            map_prefetch(request, pt)
+        else:
+            raise ValueError(f'Unknown request type: {request.request_type}')
+        status = 'ok'
+    except ProgressCancelled:
+        status = 'cancelled'
+        logger.warning(f'Request cancelled: {request.id}')
+        remove_partial_outputs(request)
+        raise
+    finally:
+        cancel_fn = get_cancel_fn(request)
+        if os.path.exists(cancel_fn):
+            os.remove(cancel_fn)
+        metrics.inc('topograf_requests_total', status=status)
+        metrics.observe('topograf_request_duration_seconds', time.monotonic() - start)
+        flush_metrics()
+        cache.release_all()
+        evict_raster_cache()
+        evict_reambulation_cache()
+
+def run_batch_request(argv: list[str], on_progress: Callable[[float], None] = lambda x: None, on_message: Callable[[str], None] = lambda x: None, cancelled: Optional[Callable[[], bool]] = None):
+    """
+    Runs a single request of a batch in a worker process and returns its result.
+    """
+    start = time.monotonic()
+    result = {'id': None, 'request_type': None, 'status': 'ok', 'worker': os.getpid()}
+    request = None
+    pt = None
+    try:
+        logger.info(f'Arguments: {argv}')
+        request = dto.create_request_from_args(dto.parse_command_line_args(argv))
+        result['id'] = request.id
+        result['request_type'] = request.request_type.value
+        pt = ProgressTracker(0, 100, on_progress, on_message, create_cancellation_token(request, cancelled))
+        run_request(request, pt)
+    except ProgressCancelled as e:
+        result['status'] = 'cancelled'
+        result['error'] = str(e)
+        result['message'] = str(e)
+    except SystemExit:
+        # argparse exits on invalid arguments
+        result['status'] = 'error'
+        result['error'] = 'Invalid arguments'
+        result['message'] = 'Interna napaka'
+    except Exception as e:
+        logger.error(e)
+        logger.error(traceback.format_exc())
+        result['status'] = 'error'
+        result['error'] = str(e) if isinstance(e, ProgressError) else f'{type(e).__name__}: {e}'
+        # The message for the user, the same as the ERROR line of a single request
+        result['message'] = str(e) if isinstance(e, ProgressError) else f'Interna napaka ({pt.last_msg()})' if pt is not None else 'Interna napaka'
+        if request is not None:
+            store_error(request, e, argv)
+
+    result['latency_s'] = round(time.monotonic() - start, 3)
+    return result
+
+def run_daemon_request(argv: list[str], job_id: str, progress_queue, cancelled_jobs):
+    """
+    Runs a single request of the daemon in a worker process, progress is sent back through the queue
+    and the request is cancelled once its job id is added to cancelled_jobs.
+    """
+    def on_progress(progress: float):
+        progress_queue.put(('PROGRESS', {'id': job_id, 'progress': round(progress, 2)}))
+    def on_message(message: str):
+        progress_queue.put(('MESSAGE', {'id': job_id, 'message': message}))
+    return run_batch_request(argv, on_progress, on_message, lambda: job_id in cancelled_jobs)
+
+def estimate_daemon_request(argv: list[str]):
+    """
+    Estimates a request of the daemon before it is queued, so the scheduler can admit it by its peak memory.
+    Returns None when the request can not be estimated, it then fails (or runs) like without the estimate.
+    """
+    try:
+        return estimate_request(dto.create_request_from_args(dto.parse_command_line_args(argv)))
+    except (Exception, SystemExit) as e:
+        # argparse exits on invalid arguments
+        logger.warning(f'Could not estimate the request: {e}')
+        return None
+
+def get_raster_info(raster_type: dto.RasterType, raster_folder: str, zoom_adjust: int, bounds: tuple[float], target_resolution: Optional[float] = None):
+    """
+    Returns the size of the raster mosaic in pixels and if it is already cached, without reading any raster data.
+    See get_raster_map.
+    """
+    if raster_folder == '':
+        return 0, True
+
+    source_hash, zoom = get_raster_source_key(raster_type, raster_folder, zoom_adjust, bounds, target_resolution)
+    found = find_cached_raster(source_hash, bounds) if USE_CACHE else None
+    if found is not None:
+        raster_cache_fn, cache_bounds = found
+        try:
+            r0, r1, c0, c1 = get_raster_window(cache_bounds, np.load(raster_cache_fn, mmap_mode='r').shape, bounds)
+            return (r1 - r0) * (c1 - c0), True
+        except FileNotFoundError:
+            # Evicted since it was found
+            pass
+
+    cache_bounds = get_raster_cache_bounds(raster_type, raster_folder, bounds)
+    if raster_folder.startswith('https://'):
+        _, _, bounds_wgs84 = get_tiles_zoom(cache_bounds, zoom_adjust, get_tiles_max_zoom(raster_type), target_resolution)
+        tile_count = sum(1 for _ in mercantile.tiles(*bounds_wgs84, [zoom]))
+        return tile_count * tile_store.TILE_SIZE ** 2, False
+
+    selected_files, raster_bounds = select_raster_files(raster_type, raster_folder, cache_bounds)
+    if len(selected_files) == 0:
+        return 0, False
+
+    with rasterio.open(selected_files[0]) as src:
+        res_x, res_y = src.res
+    return int((raster_bounds[2] - raster_bounds[0]) / res_x) * int((raster_bounds[3] - raster_bounds[1]) / res_y), False
+
+def estimate_request(r: dto.MapBaseRequest):
+    """
+    Predicts the peak memory, CPU time and output size of the request without rendering it.
+    """
+    global OUTPUT_DIR
+    OUTPUT_DIR = r.output_folder
+    metrics.set_default_labels(request_type=r.request_type.value)
+
+    target_pxpm = TARGET_DPI / 0.0254
+    bounds = (r.map_w, r.map_s, r.map_e, r.map_n)
+    map_size_px = (int(r.map_size_w_m * target_pxpm), int(r.map_size_h_m * target_pxpm))
+    grid_size_px = (
+        int((r.map_size_w_m - GRID_MARGIN_M[1] - GRID_MARGIN_M[3]) * target_pxpm),
+        int((r.map_size_h_m - GRID_MARGIN_M[0] - GRID_MARGIN_M[2]) * target_pxpm)
+    )
+    target_resolution = (r.map_e - r.map_w) / grid_size_px[0]
+
+    if r.request_type == dto.RequestType.MAP_PREVIEW:
+        mosaic_px, mosaic_cached = get_raster_info(r.raster_type, r.raster_source, r.zoom_adjust, bounds, target_resolution)
+        return estimate.estimate_map(grid_size_px[0] * grid_size_px[1], mosaic_px, mosaic_cached)
+
+    if r.request_type == dto.RequestType.MAP_PREFETCH:
+        mosaic_px, mosaic_cached = get_raster_info(r.raster_type, r.raster_source, r.zoom_adjust, bounds, target_resolution)
+        return estimate.estimate_map(0, mosaic_px, mosaic_cached)
+
+    if r.request_type == dto.RequestType.MAP_REAMBULATION:
+        mosaic_px, mosaic_cached = get_raster_info(r.raster_type, r.raster_source, r.zoom_adjust, bounds)
+        return estimate.estimate_reambulation(mosaic_px, mosaic_cached)
+
+    cp_count = len(r.control_points.cps)
+    report_pages = estimate.get_report_pages(cp_count, CP_REPORT_GRID_SIZE[0] * CP_REPORT_GRID_SIZE[1])
+    report_page_px = int(CP_REPORT_PAGE_SIZE_M[0] * target_pxpm) * int(CP_REPORT_PAGE_SIZE_M[1] * target_pxpm)
+
+    if r.request_type == dto.RequestType.MAP_ATLAS:
+        atlas_bounds, pages = get_atlas_pages(r)
+        target_resolution = r.target_scale / target_pxpm
+        mosaic_px, mosaic_cached = get_raster_info(r.raster_type, r.raster_source, r.zoom_adjust, atlas_bounds, target_resolution)
+        page_mosaic_px = mosaic_px * (pages[0][1][2] - pages[0][1][0]) * (pages[0][1][3] - pages[0][1][1]) / ((atlas_bounds[2] - atlas_bounds[0]) * (atlas_bounds[3] - atlas_bounds[1]))
+        workers = ATLAS_MAX_WORKERS or os.cpu_count() or 1
+        return estimate.estimate_atlas(map_size_px[0] * map_size_px[1], int(page_mosaic_px), mosaic_px, mosaic_cached, len(pages), workers, cp_count, report_pages, report_page_px)
+
+    mosaic_px, mosaic_cached = get_raster_info(r.raster_type, r.raster_source, r.zoom_adjust, bounds, target_resolution)
+    variants = [
+        (len(v.control_points.cps), estimate.get_report_pages(len(v.control_points.cps), CP_REPORT_GRID_SIZE[0] * CP_REPORT_GRID_SIZE[1]))
+        for v in get_variant_requests(r)
+    ]
+    return estimate.estimate_map_variants(map_size_px[0] * map_size_px[1], mosaic_px, mosaic_cached, len(r.reamulation_layers), variants, report_page_px, stages.STAGE_MAX_WORKERS, r.geotiff)
+
+def get_output_files(r: dto.MapBaseRequest):
+    if r.request_type == dto.RequestType.MAP_PREVIEW:
+        return [os.path.join(get_cache_dir('map_previews'), f'{r.id}.png')]
+    if r.request_type == dto.RequestType.MAP_REAMBULATION:
+        return [os.path.join(get_cache_dir('reambulations'), f'{r.id}.zip')]
+    if r.request_type == dto.RequestType.MAP_PREFETCH:
+        return []
+    map_dir = get_cache_dir(f'maps/{r.id}')
+    return [os.path.join(map_dir, fn) for fn in os.listdir(map_dir)]
+
+def log_resource_usage(r: dto.MapBaseRequest, predicted: Optional[dict]):
+    """
+    Logs the measured peak memory, CPU time and output size next to the estimate, to validate the cost model.
+    """
+    if resource is None:
+        return
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes (bytes on macOS)
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    measured = {
+        'peak_memory_bytes': usage.ru_maxrss * rss_unit,
+        'children_peak_memory_bytes': children_usage.ru_maxrss * rss_unit,
+        'cpu_s': round(usage.ru_utime + usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime, 2),
+        'output_bytes': sum(os.path.getsize(fn) for fn in get_output_files(r) if os.path.exists(fn)),
+    }
+    logger.info(f'Resource usage: {json.dumps({"request_type": r.request_type.value, "measured": measured, "estimated": predicted})}')
+
 def main():
+    if '--daemon' in sys.argv:
+        # stdout carries the protocol
+        logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+        daemon_args = scheduler.parse_daemon_args()
+        scheduler.run_daemon(run_daemon_request, daemon_args.workers, daemon_args.reserved_preview_slots, estimate_daemon_request)
+        exit(0)
+
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 
+    if '--batch' in sys.argv:
+        batch_args = batch.parse_batch_args()
+        summary = batch.run_batch(run_batch_request, batch_args.batch, batch_args.workers)
+        exit(1 if summary['failed'] > 0 else 0)
+
+    if '--prefetch_history' in sys.argv:
+        prefetch_args = prefetch.parse_prefetch_args()
+        summary = prefetch.run_prefetch(run_batch_request, prefetch_args.prefetch_history, prefetch_args.output_folder, prefetch_args.data_folder, prefetch_args.top)
+        exit(1 if summary['failed'] > 0 else 0)
+
     if len(sys.argv) == 1 and INPUT_CONTEXT is not None:
         with open(INPUT_CONTEXT, 'r') as f:
             error = json.load(f)
@@ -1859,29 +3141,49 @@ def main():
     cm_args = dto.parse_command_line_args()
     request = dto.create_request_from_args(cm_args)
 
-    global OUTPUT_DIR
-    OUTPUT_DIR = request.output_folder
-    print(f'Output dir: {OUTPUT_DIR}')
+    print(f'Output dir: {request.output_folder}')
 
+    token = create_cancellation_token(request)
     if cm_args.get('emit_progress'):
         logger.info('Progress tracking enabled.')
         def on_progress(progress: float):
             print(f'PROGRESS: {progress:02.2f}', file=sys.stderr)
         def on_message(message: str):
             print(f'MESSAGE: {message}', file=sys.stderr)
-        pt = ProgressTracker(0, 100, on_progress, on_message)
+        pt = ProgressTracker(0, 100, on_progress, on_message, token)
     else:
-        pt = NoProgress
+        pt = ProgressTracker(0, 100, lambda x: None, lambda x: None, token)
+
+    def on_signal(signum, frame):
+        logger.warning(f'Received signal {signum}, cancelling the request.')
+        token.cancel()
+    signal.signal(signal.SIGTERM, on_signal)
+    threading.Thread(target=watch_cancellation, args=(request, token, cm_args.get('emit_progress')), daemon=True).start()
+
+    if cm_args.get('estimate'):
+        try:
+            print(f'ESTIMATE: {json.dumps(estimate_request(request))}')
+        except ProgressError as e:
+            logger.error(e)
+            print(f'ERROR: {str(e)}', file=sys.stderr)
+            exit(1)
+        exit(0)
+
+    predicted = None
+    if LOG_RESOURCE_ESTIMATE:
+        try:
+            predicted = estimate_request(request)
+        except Exception as e:
+            # The estimate is only logged for comparison, it must not fail the request
+            logger.warning(f'Could not estimate the request: {e}')
 
     try:
-        if request.request_type == dto.RequestType.CREATE_MAP:
-            create_map(request, pt)
-        elif request.request_type == dto.RequestType.MAP_PREVIEW:
-            map_preview(request, pt)
-        elif request.request_type == dto.RequestType.MAP_REAMBULATION:
-            map_reambulation(request, pt)
-        else:
-            raise ValueError(f'Unknown request type: {request.request_type}')
+        run_request(request, pt)
+        log_resource_usage(request, predicted)
+    except ProgressCancelled as e:
+        if cm_args.get('emit_progress'):
+            print(f'ERROR: {str(e)}', file=sys.stderr)
+        exit(1)
     except ProgressError as e:
         logger.error(e)
         logger.error(traceback.format_exc())
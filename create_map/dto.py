@@ -6,6 +6,13 @@ from pathlib import Path
 import argparse
 import sys
 
+# Limits shared with the web app (src/lib/api/validation.ts)
+LIMITS = json.loads((Path(__file__).parent / 'limits.json').read_text())
+
+MAP_SIZE_MAX_M = LIMITS['map_size_max_m'] # Maximum size of the map in meters (the map canvas is a single image in memory)
+MAP_SIZE_MIN_M = LIMITS['map_size_min_m'] # Minimum size of the map in meters
+MAP_VARIANTS_MAX = 10 # Maximum number of variants of one map
+
 
 class RasterType(str, Enum):
     DTK50 = "dtk50"
@@ -49,10 +56,40 @@ class ControlPointsConfig(BaseModel):
     bounds: Optional[Tuple[float, float, float, float]] = None
 
 
+class MapVariant(BaseModel):
+    naslov1: str
+    naslov2: str
+    dodatno: str
+    control_points: ControlPointsConfig
+
+    @field_validator('naslov1')
+    @classmethod
+    def validate_naslov1(cls, v: str) -> str:
+        if len(v) > 30:
+            raise ValueError('Naslov (1) je predolg (max 30 znakov)')
+        return v
+
+    @field_validator('naslov2')
+    @classmethod
+    def validate_naslov2(cls, v: str) -> str:
+        if len(v) > 30:
+            raise ValueError('Naslov (2) je predolg (max 30 znakov)')
+        return v
+
+    @field_validator('dodatno')
+    @classmethod
+    def validate_dodatno(cls, v: str) -> str:
+        if len(v) > 70:
+            raise ValueError('Dodatna vrstica je predolgo (max 70 znakov)')
+        return v
+
+
 class RequestType(str, Enum):
     MAP_PREVIEW = "map_preview"
     CREATE_MAP = "create_map"
     MAP_REAMBULATION = "map_reambulation"
+    MAP_ATLAS = "map_atlas"
+    MAP_PREFETCH = "map_prefetch"
 
 
 class MapBaseRequest(BaseModel):
@@ -89,15 +126,19 @@ class MapBaseRequest(BaseModel):
     @field_validator('map_size_w_m')
     @classmethod
     def validate_map_size_w(cls, v: float) -> float:
-        if v > 1:
-            raise ValueError('Velikost karte je prevelika (širina) (max 1m)')
+        if v > MAP_SIZE_MAX_M:
+            raise ValueError(f'Velikost karte je prevelika (širina) (max {MAP_SIZE_MAX_M}m)')
+        if v < MAP_SIZE_MIN_M:
+            raise ValueError(f'Velikost karte je premajhna (širina) (min {MAP_SIZE_MIN_M}m)')
         return v
 
     @field_validator('map_size_h_m')
     @classmethod
     def validate_map_size_h(cls, v: float) -> float:
-        if v > 1:
-            raise ValueError('Velikost karte je prevelika (višina) (max 1m)')
+        if v > MAP_SIZE_MAX_M:
+            raise ValueError(f'Velikost karte je prevelika (višina) (max {MAP_SIZE_MAX_M}m)')
+        if v < MAP_SIZE_MIN_M:
+            raise ValueError(f'Velikost karte je premajhna (višina) (min {MAP_SIZE_MIN_M}m)')
         return v
 
     @field_validator('zoom_adjust')
@@ -174,6 +215,27 @@ class MapReambulationRequest(MapBaseRequest):
             output_folder=base.output_folder
         )
 
+class MapPrefetchRequest(MapBaseRequest):
+    @classmethod
+    def from_args(cls, args: Dict[str, Any]):
+        """Create instance from command line arguments dictionary"""
+        base = MapBaseRequest.from_args(args)
+        return cls(
+            id=base.id,
+            request_type=base.request_type,
+            map_w=base.map_w,
+            map_s=base.map_s,
+            map_e=base.map_e,
+            map_n=base.map_n,
+            epsg=base.epsg,
+            raster_type=base.raster_type,
+            raster_source=base.raster_source,
+            zoom_adjust=base.zoom_adjust,
+            map_size_w_m=base.map_size_w_m,
+            map_size_h_m=base.map_size_h_m,
+            output_folder=base.output_folder
+        )
+
 class MapCreateRequest(MapBaseRequest):
     target_scale: int
     edge_wgs84: bool
@@ -185,6 +247,15 @@ class MapCreateRequest(MapBaseRequest):
     reamulation_layers: list[str]
     control_points: ControlPointsConfig
     dmv125_folder: str
+    variants: list[MapVariant] = []  # further variants of the map (other control points and titles), rendered over the same base
+    geotiff: bool = False  # also save the maps as tiled GeoTIFFs with overviews (map.tif)
+
+    @field_validator('variants')
+    @classmethod
+    def validate_variants(cls, v: list[MapVariant]) -> list[MapVariant]:
+        if len(v) > MAP_VARIANTS_MAX:
+            raise ValueError(f'Preveč različic karte (max {MAP_VARIANTS_MAX})')
+        return v
 
     @field_validator('target_scale')
     @classmethod
@@ -236,6 +307,12 @@ class MapCreateRequest(MapBaseRequest):
         else:
             reamulation_layers = []
 
+        # Parse variants JSON string into a list of MapVariant
+        variants_data = json.loads(args.get("variants") or "[]")
+        if not isinstance(variants_data, list):
+            raise ValueError('Variants must be a list')
+        variants = [MapVariant(**variant) for variant in variants_data]
+
         return cls(
             id=base.id,
             request_type=base.request_type,
@@ -259,9 +336,44 @@ class MapCreateRequest(MapBaseRequest):
             reamulation_layers=reamulation_layers,
             control_points=control_points_config,
             dmv125_folder=args.get("dmv125_folder"),
+            variants=variants,
+            geotiff=(args.get("geotiff") or "false").lower() == "true",
             output_folder=base.output_folder
         )
 
+class MapAtlasRequest(MapCreateRequest):
+    atlas_overlap: float = 0.1  # overlap of neighbouring pages (fraction of the page)
+
+    @field_validator('atlas_overlap')
+    @classmethod
+    def validate_atlas_overlap(cls, v: float) -> float:
+        if v < 0 or v > 0.5:
+            raise ValueError('Prekrivanje listov je napačno (0 - 0.5)')
+        return v
+
+    @field_validator('variants')
+    @classmethod
+    def validate_atlas_variants(cls, v: list[MapVariant]) -> list[MapVariant]:
+        if len(v) > 0:
+            raise ValueError('Atlas ne podpira različic karte')
+        return v
+
+    @field_validator('geotiff')
+    @classmethod
+    def validate_atlas_geotiff(cls, v: bool) -> bool:
+        if v:
+            raise ValueError('Atlas ne podpira izvoza GeoTIFF')
+        return v
+
+    @classmethod
+    def from_args(cls, args: Dict[str, Any]):
+        """Create instance from command line arguments dictionary"""
+        base = MapCreateRequest.from_args(args)
+        return cls(
+            **base.model_dump(),
+            atlas_overlap=0.1 if args.get("atlas_overlap") is None else float(args["atlas_overlap"])
+        )
+
 
 def parse_command_line_args(args=None):
     """
@@ -271,8 +383,8 @@ def parse_command_line_args(args=None):
     
     # Required arguments
     parser.add_argument("--id", type=str, help="Request ID", default="", required=True)
-    parser.add_argument("--request_type", type=str, choices=["map_preview", "create_map", "map_reambulation"], 
-                        help="Type of request (map_preview, create_map or map_reambulation)", required=True)
+    parser.add_argument("--request_type", type=str, choices=["map_preview", "create_map", "map_reambulation", "map_atlas", "map_prefetch"], 
+                        help="Type of request (map_preview, create_map, map_reambulation, map_atlas or map_prefetch)", required=True)
     parser.add_argument("--map_w", type=float, help="West bound", required=True)
     parser.add_argument("--map_s", type=float, help="South bound", required=True)
     parser.add_argument("--map_e", type=float, help="East bound", required=True)
@@ -296,9 +408,15 @@ def parse_command_line_args(args=None):
     parser.add_argument("--reambulation_layers", type=str, help="Reambulation layers as JSON string", default="[]")
     parser.add_argument("--control_points", type=str, help="Control points as JSON string")
     parser.add_argument("--dmv125_folder", type=str, help="DMV125 folder path")
+    parser.add_argument("--variants", type=str, help="Further variants of the map (control points and titles) as JSON string", default="[]")
+    parser.add_argument("--geotiff", type=str, help="Also save the map as a tiled GeoTIFF with overviews", default="false")
+
+    # Atlas specific arguments
+    parser.add_argument("--atlas_overlap", type=float, help="Overlap of neighbouring atlas pages (fraction of the page)", default=0.1)
 
     # Utility arguments
     parser.add_argument("--emit-progress", action="store_true", help="Emit progress events", default=False)
+    parser.add_argument("--estimate", action="store_true", help="Only estimate the peak memory, CPU time and output size", default=False)
     
     if args is None:
         args = sys.argv[1:]
@@ -319,5 +437,9 @@ def create_request_from_args(args_dict):
         return MapCreateRequest.from_args(args_dict)
     elif request_type == "map_reambulation":
         return MapReambulationRequest.from_args(args_dict)
+    elif request_type == "map_atlas":
+        return MapAtlasRequest.from_args(args_dict)
+    elif request_type == "map_prefetch":
+        return MapPrefetchRequest.from_args(args_dict)
     else:
         raise ValueError(f"Unknown request type: {request_type}")
@@ -0,0 +1,136 @@
+import math
+
+### STATIC CONFIGURATION ###
+
+# Coefficients of the cost model, fitted on measured runs (check them with estimate_check.py on the 'Resource usage' log lines).
+# Memory and CPU were fitted on 42 runs (maps of 0.1-1 m, previews, control point reports, reambulation layers, GeoTIFFs,
+# atlases and reambulations), mean absolute error 6.5% for memory and 12.6% for CPU time. The output sizes are not fitted,
+# the test rasters compress far better than real maps.
+BASE_MEMORY_BYTES = 205 * 1024 * 1024 # Interpreter with the imported libraries
+BASE_CPU_S = 1.8 # Imports and setup
+CANVAS_MEMORY_PER_PX = 6.0 # Map canvas (RGB) with the encoded PNG and PDF
+CANVAS_CPU_PER_PX = 65e-9 # Drawing and optimized PNG encoding of the map
+RASTER_CANVAS_CPU_PER_PX = 0.0 # Resampling the raster into the canvas and encoding the detail it adds (not measurable on the test rasters)
+MOSAIC_MEMORY_PER_PX = 7.4 # Merged mosaic and the source blocks read for it
+MOSAIC_CPU_PER_PX = 50e-9 # Merging (or warping the tiles)
+MOSAIC_CACHED_MEMORY_PER_PX = 2.7 # Pages of the memory mapped mosaic touched while resampling
+MOSAIC_CACHED_CPU_PER_PX = 0.0
+LAYER_CPU_PER_CANVAS_PX = 250e-9 # Compositing one reambulation layer into the canvas, strip by strip (no full size copy)
+CONTROL_POINT_CPU_S = 0.02 # Drawing one control point
+REPORT_CONTROL_POINT_CPU_S = 0.2 # Preview and heights of one control point in the report
+REPORT_PAGE_MEMORY_PER_PX = 8.0 # Report pages are kept in memory until the PDF is saved
+OUTPUT_BYTES_PER_CANVAS_PX = 0.8 # Compressed map (PNG inside the PDF), depends a lot on the raster
+OUTPUT_BYTES_PER_BLANK_PX = 0.005 # Compressed map without a raster
+OUTPUT_BYTES_PER_REPORT_PX = 0.3
+GEOTIFF_MEMORY_PER_PX = 3.5 # Copy of the map GDAL keeps until the GeoTIFF is written
+GEOTIFF_CPU_PER_PX = 75e-9 # Tiles and overviews compressed with DEFLATE
+GEOTIFF_BYTES_PER_CANVAS_PX = 2.4 # Compressed tiles and overviews, about 3x the PNG inside the PDF
+GEOTIFF_BYTES_PER_BLANK_PX = 0.02
+ATLAS_PAGE_CPU_S = 0.25 # Sending a page to its worker, the encoded page back and embedding it in the PDF
+REAMBULATION_MEMORY_PER_PX = 1.0 # Grid (RGBA) drawn over the mosaic, with the encoded PNGs
+REAMBULATION_CPU_PER_PX = 55e-9
+
+### /STATIC CONFIGURATION ###
+
+def estimate_map(canvas_px: int, mosaic_px: int, mosaic_cached: bool, layer_count: int = 0, cp_count: int = 0, report_pages: int = 0, report_page_px: int = 0):
+    """
+    Estimates the cost of rendering one map (or preview).
+
+    Parameters
+    ----------
+    canvas_px : int
+        Pixels of the rendered map.
+    mosaic_px : int
+        Pixels of the raster mosaic read for the map.
+    mosaic_cached : bool
+        The mosaic is already cached and only has to be resampled.
+    layer_count : int
+        Number of reambulation layers composited into the map.
+    cp_count : int
+        Number of control points.
+    report_pages, report_page_px : int
+        Pages of the control point report and pixels of one page.
+
+    Returns a dict with the peak memory in bytes, CPU time in seconds and size of the output in bytes.
+    """
+    mosaic_memory = mosaic_px * (MOSAIC_CACHED_MEMORY_PER_PX if mosaic_cached else MOSAIC_MEMORY_PER_PX)
+    mosaic_cpu = mosaic_px * (MOSAIC_CACHED_CPU_PER_PX if mosaic_cached else MOSAIC_CPU_PER_PX)
+
+    # The report is created after the map is drawn, only the larger of the two counts towards the peak
+    map_memory = canvas_px * CANVAS_MEMORY_PER_PX + mosaic_memory
+    report_memory = canvas_px * CANVAS_MEMORY_PER_PX + report_pages * report_page_px * REPORT_PAGE_MEMORY_PER_PX
+
+    has_raster = mosaic_px > 0
+
+    return {
+        'peak_memory_bytes': int(BASE_MEMORY_BYTES + max(map_memory, report_memory)),
+        'cpu_s': round(
+            BASE_CPU_S
+            + canvas_px * (CANVAS_CPU_PER_PX + (RASTER_CANVAS_CPU_PER_PX if has_raster else 0))
+            + mosaic_cpu
+            + layer_count * canvas_px * LAYER_CPU_PER_CANVAS_PX
+            + cp_count * CONTROL_POINT_CPU_S
+            + (cp_count * REPORT_CONTROL_POINT_CPU_S if report_pages > 0 else 0), 2),
+        'output_bytes': int(canvas_px * (OUTPUT_BYTES_PER_CANVAS_PX if has_raster else OUTPUT_BYTES_PER_BLANK_PX) + report_pages * report_page_px * OUTPUT_BYTES_PER_REPORT_PX),
+    }
+
+def estimate_map_variants(canvas_px: int, mosaic_px: int, mosaic_cached: bool, layer_count: int, variants: list[tuple[int]], report_page_px: int, workers: int, geotiff: bool = False):
+    """
+    Estimates the cost of a map with variants, (cp_count, report_pages) of every variant, the first is the map of the request.
+
+    The mosaic is merged and the base drawn once, every further variant adds drawing its control points and
+    markings on a copy of the map, encoding it and its report. Up to workers variants are held at the same time.
+    With geotiff every variant is also saved as a GeoTIFF.
+    """
+    cp_count, report_pages = variants[0]
+    result = estimate_map(canvas_px, mosaic_px, mosaic_cached, layer_count, cp_count, report_pages, report_page_px)
+
+    has_raster = mosaic_px > 0
+    for cp_count, report_pages in variants[1:]:
+        result['cpu_s'] += (
+            canvas_px * (CANVAS_CPU_PER_PX + (RASTER_CANVAS_CPU_PER_PX if has_raster else 0))
+            + cp_count * CONTROL_POINT_CPU_S
+            + (cp_count * REPORT_CONTROL_POINT_CPU_S if report_pages > 0 else 0))
+        result['output_bytes'] += int(canvas_px * (OUTPUT_BYTES_PER_CANVAS_PX if has_raster else OUTPUT_BYTES_PER_BLANK_PX) + report_pages * report_page_px * OUTPUT_BYTES_PER_REPORT_PX)
+    result['peak_memory_bytes'] += int((min(workers, len(variants)) - 1) * canvas_px * CANVAS_MEMORY_PER_PX)
+    if geotiff:
+        result['peak_memory_bytes'] += int(min(workers, len(variants)) * canvas_px * GEOTIFF_MEMORY_PER_PX)
+        result['cpu_s'] += len(variants) * canvas_px * GEOTIFF_CPU_PER_PX
+        result['output_bytes'] += int(len(variants) * canvas_px * (GEOTIFF_BYTES_PER_CANVAS_PX if has_raster else GEOTIFF_BYTES_PER_BLANK_PX))
+    result['cpu_s'] = round(result['cpu_s'], 2)
+    return result
+
+def estimate_atlas(page_canvas_px: int, page_mosaic_px: int, mosaic_px: int, mosaic_cached: bool, pages: int, workers: int, cp_count: int = 0, report_pages: int = 0, report_page_px: int = 0):
+    """
+    Estimates the cost of an atlas, the pages are rendered by worker processes in parallel.
+
+    Peak memory counts all workers, each rendering a page from its window of the shared mosaic.
+    The workers are forked, so the pages do not pay the imports and setup again.
+    """
+    # Fetching the whole mosaic and creating the report in the main process
+    main = estimate_map(page_canvas_px, mosaic_px, mosaic_cached, 0, cp_count, report_pages, report_page_px)
+    page = estimate_map(page_canvas_px, page_mosaic_px, True, 0, cp_count)
+
+    return {
+        'peak_memory_bytes': int(main['peak_memory_bytes'] + min(workers, pages) * page['peak_memory_bytes']),
+        'cpu_s': round(main['cpu_s'] + pages * (page['cpu_s'] - BASE_CPU_S + ATLAS_PAGE_CPU_S), 2),
+        'output_bytes': int(main['output_bytes'] + pages * page['output_bytes']),
+    }
+
+def estimate_reambulation(mosaic_px: int, mosaic_cached: bool):
+    """
+    Estimates the cost of exporting the reambulation layers, which are all of the size of the mosaic.
+    """
+    result = estimate_map(0, mosaic_px, mosaic_cached)
+    result['peak_memory_bytes'] += int(mosaic_px * REAMBULATION_MEMORY_PER_PX)
+    result['cpu_s'] = round(result['cpu_s'] + mosaic_px * REAMBULATION_CPU_PER_PX, 2)
+    result['output_bytes'] = int(mosaic_px * OUTPUT_BYTES_PER_CANVAS_PX)
+    return result
+
+def get_report_pages(cp_count: int, cells_per_page: int):
+    """
+    Pages of the control point report, the timeline page and the pages with the control point previews.
+    """
+    if cp_count == 0:
+        return 0
+    return 1 + math.ceil(cp_count / cells_per_page)
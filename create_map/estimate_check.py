@@ -0,0 +1,90 @@
+import argparse
+import collections
+import json
+import logging
+import re
+import sys
+from batch import percentile, print_line
+
+### STATIC CONFIGURATION ###
+
+ESTIMATE_METRICS = ['peak_memory_bytes', 'cpu_s', 'output_bytes'] # Measured values compared with the estimate
+
+### /STATIC CONFIGURATION ###
+
+logger = logging.getLogger('create_map.estimate_check')
+
+RESOURCE_USAGE_RE = re.compile(r'Resource usage: (\{.*\})\s*$')
+
+def load_resource_usage(log_files: list[str]):
+    """
+    Returns the 'Resource usage' records (with an estimate) from the logs of create_map.py
+    (requests run with LOG_RESOURCE_ESTIMATE enabled).
+    """
+    records = []
+    for fn in log_files:
+        with open(fn, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                m = RESOURCE_USAGE_RE.search(line)
+                if m is None:
+                    continue
+                try:
+                    record = json.loads(m.group(1))
+                except ValueError:
+                    logger.warning(f'Invalid resource usage line in {fn}: {line.strip()}')
+                    continue
+                if record.get('estimated') is not None:
+                    records.append(record)
+    return records
+
+def check_estimates(records: list[dict]):
+    """
+    Relative error of the estimate ((estimated - measured) / measured) of every metric, per request type.
+
+    Returns a dict {request_type: {metric: {count, median, p10, p90, mean_abs}}}. A positive
+    error means the model overestimates. The peak memory of a request with worker processes counts
+    one worker, so it is exact only with a single worker. Output size depends on how well the
+    raster compresses, so it only validates on real rasters.
+    """
+    errors = collections.defaultdict(lambda: collections.defaultdict(list))
+    for record in records:
+        for metric in ESTIMATE_METRICS:
+            measured = record['measured'].get(metric)
+            if metric == 'peak_memory_bytes' and measured:
+                # The estimate includes the worker processes (atlas pages), the log has the peak of the largest one
+                measured += record['measured'].get('children_peak_memory_bytes', 0)
+            estimated = record['estimated'].get(metric)
+            if not measured or estimated is None:
+                continue
+            errors[record['request_type']][metric].append((estimated - measured) / measured)
+
+    result = {}
+    for request_type, metrics in sorted(errors.items()):
+        result[request_type] = {
+            metric: {
+                'count': len(values),
+                'median': round(percentile(values, 50), 3),
+                'p10': round(percentile(values, 10), 3),
+                'p90': round(percentile(values, 90), 3),
+                'mean_abs': round(sum(abs(v) for v in values) / len(values), 3),
+            }
+            for metric, values in metrics.items()
+        }
+    return result
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    parser = argparse.ArgumentParser(description="Compare the estimated and measured resource usage of requests from the create_map.py logs")
+    parser.add_argument("logs", type=str, nargs='+', help="Log files with 'Resource usage' lines")
+    args = parser.parse_args()
+
+    records = load_resource_usage(args.logs)
+    logger.info(f'Found {len(records)} requests with an estimate.')
+    for request_type, metrics in check_estimates(records).items():
+        for metric, stats in metrics.items():
+            print_line('RESULT', {'request_type': request_type, 'metric': metric, **stats})
+    exit(0 if len(records) > 0 else 1)
+
+if __name__ == '__main__':
+    main()
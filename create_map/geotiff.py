@@ -0,0 +1,64 @@
+import numpy as np
+import rasterio
+import rasterio.transform
+import rasterio.windows
+from PIL import Image
+from progress import ProgressTracker, NoProgress
+
+### STATIC CONFIGURATION ###
+
+GEOTIFF_BLOCK_SIZE = 512 # Size of the square tiles (and of the strips of the image handed to GDAL at once)
+GEOTIFF_COMPRESS = 'DEFLATE' # Compression of the tiles (DEFLATE, LZW, ZSTD or JPEG)
+GEOTIFF_LEVEL = 6 # Compression level of DEFLATE and ZSTD
+GEOTIFF_QUALITY = 90 # Quality of JPEG compression
+GEOTIFF_OVERVIEW_RESAMPLING = 'AVERAGE' # Resampling of the overviews
+GEOTIFF_THREADS = 'ALL_CPUS' # Threads compressing the tiles (GDAL NUM_THREADS)
+
+### /STATIC CONFIGURATION ###
+
+def save_geotiff(img: Image.Image, transform: rasterio.transform.Affine, output_file: str, epsg: int = 3794, pt: ProgressTracker = NoProgress):
+    """
+    Saves the image as a Cloud Optimized GeoTIFF, tiled and with internal overviews, so tiles and
+    zoomed out views can be read with range requests and GIS tools open it directly.
+
+    GDAL only writes the COG layout as a copy of a complete dataset, the image is handed over in strips
+    of GEOTIFF_BLOCK_SIZE rows, so the only full copy is the one GDAL keeps until the file is written.
+
+    Parameters
+    ----------
+    img : Image
+        RGB image, other modes are converted strip by strip.
+    transform : Affine
+        Transform of the image pixels to coordinates in epsg.
+    """
+    width, height = img.size
+    profile = {
+        'driver': 'COG',
+        'width': width,
+        'height': height,
+        'count': 3,
+        'dtype': 'uint8',
+        'crs': f'EPSG:{epsg}',
+        'transform': transform,
+        'blocksize': GEOTIFF_BLOCK_SIZE,
+        'compress': GEOTIFF_COMPRESS,
+        'overview_resampling': GEOTIFF_OVERVIEW_RESAMPLING,
+        'num_threads': GEOTIFF_THREADS,
+        'bigtiff': 'IF_SAFER',
+    }
+    if GEOTIFF_COMPRESS == 'JPEG':
+        profile['quality'] = GEOTIFF_QUALITY
+    else:
+        profile['level'] = GEOTIFF_LEVEL
+        profile['predictor'] = 'YES'
+
+    with rasterio.open(output_file, 'w', **profile) as dst:
+        for row in range(0, height, GEOTIFF_BLOCK_SIZE):
+            strip = img.crop((0, row, width, min(row + GEOTIFF_BLOCK_SIZE, height)))
+            if strip.mode != 'RGB':
+                strip = strip.convert('RGB')
+            window = rasterio.windows.Window(0, row, width, strip.size[1])
+            dst.write(np.moveaxis(np.asarray(strip), -1, 0), window=window)
+            pt.step(0.5 * min(row + GEOTIFF_BLOCK_SIZE, height) / height)
+        # The tiles and overviews are compressed and written when the dataset is closed
+    pt.step(1)
@@ -0,0 +1,210 @@
+import contextlib
+import datetime
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import cache
+
+### STATIC CONFIGURATION ###
+
+METRICS_ENABLED = True # Collect the metrics and merge them into the snapshot in the output folder after every request
+METRICS_DURATION_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300] # Upper bounds of the duration histograms in seconds
+
+### /STATIC CONFIGURATION ###
+
+logger = logging.getLogger('create_map.metrics')
+
+# Name: (type, help) of the exported metrics
+METRICS = {
+    'topograf_cache_lookups_total': ('counter', 'Cache lookups by cache, request type and result (hit or miss).'),
+    'topograf_cache_bytes_total': ('counter', 'Bytes read from the cache on hits and written to it on misses.'),
+    'topograf_requests_total': ('counter', 'Finished requests by request type and status.'),
+    'topograf_request_duration_seconds': ('histogram', 'Duration of the requests.'),
+    'topograf_stage_duration_seconds': ('histogram', 'Duration of the stages of the requests.'),
+}
+
+_lock = threading.Lock()
+_counters = {} # (name, labels) -> value
+_histograms = {} # (name, labels) -> [bucket counts..., sum, count]
+_default_labels = {}
+
+def set_default_labels(**labels):
+    """
+    Labels added to all metrics recorded from now on in this process (eg. the request type).
+    """
+    with _lock:
+        _default_labels.clear()
+        _default_labels.update(labels)
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted({**_default_labels, **labels}.items()))
+
+def inc(name: str, value: float = 1, **labels):
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name: str, value: float, **labels):
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        key = _key(name, labels)
+        histogram = _histograms.setdefault(key, [0] * (len(METRICS_DURATION_BUCKETS) + 3))
+        for i, bound in enumerate(METRICS_DURATION_BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[len(METRICS_DURATION_BUCKETS)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+def cache_lookup(cache_name: str, hit: bool, nbytes: int = 0, count: int = 1):
+    """
+    Counts lookups of a cache. nbytes is the size read from the cache on a hit or written to it on a miss.
+    """
+    result = 'hit' if hit else 'miss'
+    inc('topograf_cache_lookups_total', count, cache=cache_name, result=result)
+    if nbytes > 0:
+        inc('topograf_cache_bytes_total', nbytes, cache=cache_name, result=result)
+
+@contextlib.contextmanager
+def stage_timer(stage: str):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe('topograf_stage_duration_seconds', time.monotonic() - start, stage=stage)
+
+def timed(stage: str):
+    """
+    Decorator that records the duration of every call of the function as a stage.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def reset():
+    """
+    Drops the metrics recorded in this process (eg. the ones inherited by a forked worker).
+    """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+def get_entries(snapshot: dict, key: str):
+    entries = snapshot.get(key, [])
+    return entries if isinstance(entries, list) else []
+
+def is_entry(entry, keys: tuple[str]):
+    """
+    Whether the entry of a loaded snapshot is a dict with all the keys (and dict labels).
+    """
+    return isinstance(entry, dict) and all(key in entry for key in keys) and isinstance(entry['labels'], dict)
+
+def _merge(snapshot: dict):
+    """
+    Adds the metrics of this process to the snapshot and resets them.
+    """
+    with _lock:
+        counters = {(c['name'], json.dumps(c['labels'], sort_keys=True)): c for c in snapshot.get('counters', [])}
+        for (name, labels), value in _counters.items():
+            c = counters.setdefault((name, json.dumps(dict(labels), sort_keys=True)), {'name': name, 'labels': dict(labels), 'value': 0})
+            c['value'] += value
+
+        histograms = {(h['name'], json.dumps(h['labels'], sort_keys=True)): h for h in snapshot.get('histograms', [])}
+        for (name, labels), values in _histograms.items():
+            h = histograms.setdefault((name, json.dumps(dict(labels), sort_keys=True)), {
+                'name': name,
+                'labels': dict(labels),
+                'buckets': [0] * (len(values) - 2),
+                'sum': 0,
+                'count': 0,
+            })
+            h['buckets'] = [a + b for a, b in zip(h['buckets'], values[:-2])]
+            h['sum'] += values[-2]
+            h['count'] += values[-1]
+
+        _counters.clear()
+        _histograms.clear()
+
+    snapshot['counters'] = list(counters.values())
+    snapshot['histograms'] = list(histograms.values())
+    snapshot['updated'] = datetime.datetime.now().isoformat()
+    return snapshot
+
+def format_labels(labels: dict, **extra):
+    labels = {**labels, **extra}
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(f'{k}="{str(v)}"' for k, v in labels.items()) + '}'
+
+def to_prometheus(snapshot: dict):
+    """
+    Formats the snapshot in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        counters = [c for c in snapshot['counters'] if c['name'] == name]
+        histograms = [h for h in snapshot['histograms'] if h['name'] == name]
+        if len(counters) == 0 and len(histograms) == 0:
+            continue
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for c in counters:
+            lines.append(f'{name}{format_labels(c["labels"])} {c["value"]}')
+        for h in histograms:
+            cumulative = 0
+            for bound, count in zip(METRICS_DURATION_BUCKETS + ['+Inf'], h['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(h["labels"], le=bound)} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(h["labels"])} {round(h["sum"], 6)}')
+            lines.append(f'{name}_count{format_labels(h["labels"])} {h["count"]}')
+    return '\n'.join(lines) + '\n'
+
+def flush(metrics_dir: str):
+    """
+    Merges the metrics of this process into the snapshot shared by all processes, metrics.json
+    (JSON) and metrics.prom (Prometheus text format, eg. for the textfile collector of node_exporter)
+    in metrics_dir.
+    """
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        if len(_counters) == 0 and len(_histograms) == 0:
+            return
+
+    snapshot_fn = os.path.join(metrics_dir, 'metrics.json')
+    with cache.FileLock(f'{snapshot_fn}.lock', remove=True):
+        snapshot = {'counters': [], 'histograms': []}
+        if os.path.exists(snapshot_fn):
+            try:
+                with open(snapshot_fn, 'r') as f:
+                    snapshot = json.load(f)
+            except ValueError:
+                logger.warning(f'Invalid metrics snapshot, starting a new one. - ({snapshot_fn})')
+            if not isinstance(snapshot, dict):
+                logger.warning(f'Invalid metrics snapshot, starting a new one. - ({snapshot_fn})')
+                snapshot = {}
+            # Entries that can not be merged are dropped (written by another version, or edited),
+            # also the histograms with other buckets
+            snapshot['counters'] = [c for c in get_entries(snapshot, 'counters') if is_entry(c, ('name', 'labels', 'value'))]
+            snapshot['histograms'] = [
+                h for h in get_entries(snapshot, 'histograms')
+                if is_entry(h, ('name', 'labels', 'buckets', 'sum', 'count')) and len(h['buckets']) == len(METRICS_DURATION_BUCKETS) + 1
+            ]
+
+        snapshot = _merge(snapshot)
+        with cache.atomic_write(snapshot_fn, 'w') as f:
+            json.dump(snapshot, f)
+        with cache.atomic_write(os.path.join(metrics_dir, 'metrics.prom'), 'w') as f:
+            f.write(to_prometheus(snapshot))
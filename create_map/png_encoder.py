@@ -0,0 +1,178 @@
+import concurrent.futures
+import io
+import os
+import struct
+import zlib
+from typing import Optional
+import numpy as np
+from PIL import Image
+from progress import ProgressTracker, NoProgress
+
+### STATIC CONFIGURATION ###
+
+PNG_COMPRESS_LEVEL = 9 # zlib compression level (0-9)
+PNG_COMPRESS_STRATEGY = zlib.Z_DEFAULT_STRATEGY # zlib strategy (Z_DEFAULT_STRATEGY, Z_FILTERED, Z_RLE, Z_HUFFMAN_ONLY or Z_FIXED)
+PNG_STRIP_ROWS = 256 # Rows compressed by one thread at once, strips are compressed independently (more strips compress a little worse)
+PNG_THREADS = None # Threads compressing the strips (None uses all cores available to the process), with a single thread Pillow's encoder is used
+
+### /STATIC CONFIGURATION ###
+
+# PNG color type and bytes per pixel of the supported image modes
+PNG_MODES = {
+    'L': (0, 1),
+    'RGB': (2, 3),
+    'P': (3, 1),
+    'RGBA': (6, 4),
+}
+
+ADLER_BASE = 65521
+
+def png_chunk(tag: bytes, data: bytes):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+def adler32_combine(adler1: int, adler2: int, len2: int):
+    """
+    Adler-32 of two buffers from the checksums of each (adler32_combine of zlib, which Python does not expose).
+    """
+    rem = len2 % ADLER_BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % ADLER_BASE
+    sum1 = (sum1 + (adler2 & 0xffff) + ADLER_BASE - 1) % ADLER_BASE
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + ADLER_BASE - rem) % ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+def get_threads():
+    """
+    Number of threads compressing the strips, see PNG_THREADS.
+    """
+    if PNG_THREADS is not None:
+        return PNG_THREADS
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def filter_rows(rows: np.ndarray, prev: np.ndarray, bpp: int, adaptive: bool):
+    """
+    Returns the filtered scanlines (a filter type byte followed by the row) of the rows (rows, row bytes),
+    prev is the row above the first one (zeros for the first row of the image).
+
+    Palette images are not filtered. Otherwise every row gets the filter with the smallest sum of absolute
+    (signed) differences, the heuristic of libpng.
+    """
+    if not adaptive:
+        return np.hstack([np.zeros((rows.shape[0], 1), dtype=np.uint8), rows]).tobytes()
+
+    up = np.vstack([prev[np.newaxis], rows[:-1]])
+    left = np.zeros_like(rows)
+    left[:, bpp:] = rows[:, :-bpp]
+    up_left = np.zeros_like(rows)
+    up_left[:, bpp:] = up[:, :-bpp]
+
+    # Paeth predictor
+    a, b, c = left.astype(np.int16), up.astype(np.int16), up_left.astype(np.int16)
+    p = a + b - c
+    pa, pb, pc = np.abs(p - a), np.abs(p - b), np.abs(p - c)
+    paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+    average = ((a + b) >> 1).astype(np.uint8)
+
+    # Keep the best filter of every row so far instead of all five filtered copies
+    selected = rows
+    types = np.zeros(rows.shape[0], dtype=np.uint8)
+    costs = np.abs(rows.view(np.int8).astype(np.int16)).sum(axis=1)
+    for filter_type, predicted in enumerate([left, up, average, paeth], 1):
+        filtered = rows - predicted
+        filter_costs = np.abs(filtered.view(np.int8).astype(np.int16)).sum(axis=1)
+        better = filter_costs < costs
+        selected = np.where(better[:, np.newaxis], filtered, selected)
+        types[better] = filter_type
+        costs = np.minimum(costs, filter_costs)
+    return np.hstack([types[:, np.newaxis], selected]).tobytes()
+
+def compress_strip(img: Image.Image, y0: int, y1: int, bpp: int, adaptive: bool, last: bool):
+    """
+    Filters and compresses the rows [y0, y1) of the image into a raw deflate stream that ends on a byte
+    boundary (or is the end of the image). Returns the compressed bytes, the Adler-32 and the length of the scanlines.
+    """
+    # Only the strip (and the row above it) is copied out of the image
+    top = max(y0 - 1, 0)
+    strip = np.asarray(img.crop((0, top, img.size[0], y1))).reshape(y1 - top, -1)
+    prev = strip[0] if y0 > 0 else np.zeros(strip.shape[1], dtype=np.uint8)
+    scanlines = filter_rows(strip[y0 - top:], prev, bpp, adaptive)
+
+    compressor = zlib.compressobj(PNG_COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, 9, PNG_COMPRESS_STRATEGY)
+    data = compressor.compress(scanlines) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH)
+    return data, zlib.adler32(scanlines), len(scanlines)
+
+def encode_png(img: Image.Image, dpi: Optional[tuple[int]] = None, pt: ProgressTracker = NoProgress):
+    """
+    Encodes the image as PNG and returns the encoded bytes.
+
+    The image is split into strips of PNG_STRIP_ROWS rows that are filtered and compressed on a thread
+    pool (zlib releases the GIL), straight from the image without copying it. Every strip is a separate
+    deflate stream and the IDAT data is their concatenation, which any PNG reader decodes as one stream.
+    With a single thread (or a single strip) the image is encoded by Pillow, which filters faster.
+
+    Parameters
+    ----------
+    img : Image
+        Image in L, RGB, RGBA or P mode.
+    dpi : tuple (x, y), optional
+        Resolution stored in the pHYs chunk.
+    """
+    if img.mode not in PNG_MODES:
+        raise ValueError(f'Unsupported image mode for PNG: {img.mode}')
+    color_type, bpp = PNG_MODES[img.mode]
+    width, height = img.size
+
+    strips = [(y0, min(y0 + PNG_STRIP_ROWS, height)) for y0 in range(0, height, PNG_STRIP_ROWS)]
+    workers = min(get_threads(), len(strips))
+    if workers < 2:
+        # On a single thread Pillow's encoder (filtering in C) is faster than the strips
+        pt.step(0)
+        options = {'compress_level': PNG_COMPRESS_LEVEL}
+        if PNG_COMPRESS_STRATEGY != zlib.Z_DEFAULT_STRATEGY:
+            # Otherwise Pillow picks the strategy itself (Z_FILTERED for filtered images, which compresses better)
+            options['compress_type'] = PNG_COMPRESS_STRATEGY
+        if dpi is not None:
+            options['dpi'] = dpi
+        buf = io.BytesIO()
+        img.save(buf, format='png', **options)
+        pt.step(1)
+        return buf.getvalue()
+
+    chunks = [
+        b'\x89PNG\r\n\x1a\n',
+        png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)),
+    ]
+    if img.mode == 'P':
+        palette = img.getpalette() or []
+        chunks.append(png_chunk(b'PLTE', bytes(palette[:256 * 3])))
+    if dpi is not None:
+        chunks.append(png_chunk(b'pHYs', struct.pack('>IIB', int(dpi[0] / 0.0254 + 0.5), int(dpi[1] / 0.0254 + 0.5), 1)))
+
+    # The zlib header (with the level hint) and the Adler-32 of all the scanlines wrap the strips
+    level_hint = 0 if PNG_COMPRESS_LEVEL < 2 or PNG_COMPRESS_STRATEGY >= zlib.Z_HUFFMAN_ONLY else 1 if PNG_COMPRESS_LEVEL < 6 else 2 if PNG_COMPRESS_LEVEL == 6 else 3
+    flags = level_hint << 6
+    flags += (31 - (0x78 * 256 + flags) % 31) % 31
+    idat = [bytes([0x78, flags])]
+    adler = 1
+
+    adaptive = img.mode != 'P'
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(compress_strip, img, y0, y1, bpp, adaptive, i == len(strips) - 1) for i, (y0, y1) in enumerate(strips)]
+        try:
+            # In order, the checksum is combined strip by strip
+            for i, future in enumerate(futures):
+                data, strip_adler, length = future.result()
+                idat.append(data)
+                adler = adler32_combine(adler, strip_adler, length)
+                pt.step((i + 1) / len(futures))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    idat.append(struct.pack('>I', adler))
+
+    chunks.append(png_chunk(b'IDAT', b''.join(idat)))
+    chunks.append(png_chunk(b'IEND', b''))
+    return b''.join(chunks)
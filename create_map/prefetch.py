@@ -0,0 +1,97 @@
+import argparse
+import collections
+import hashlib
+import logging
+import os
+import sys
+import time
+from typing import Callable, Optional
+import dto
+from batch import print_line
+from replay import load_records, set_arg
+
+### STATIC CONFIGURATION ###
+
+PREFETCH_HISTORY_TOP = 20 # Number of the most requested areas warmed by the offline prefetch
+
+### /STATIC CONFIGURATION ###
+
+logger = logging.getLogger('create_map.prefetch')
+
+def parse_prefetch_args(args=None):
+    """
+    Parse command line arguments for the offline prefetch (create_map.py --prefetch_history FOLDER --output_folder FOLDER).
+    """
+    parser = argparse.ArgumentParser(description="Warm the raster cache for the most requested areas of the stored maps")
+    parser.add_argument("--prefetch_history", type=str, help="Folder with the conf.json files of the stored maps (searched recursively)", required=True)
+    parser.add_argument("--output_folder", type=str, help="Output folder with the raster cache", required=True)
+    parser.add_argument("--data_folder", type=str, help="Folder of the raster sources stored without a path in conf.json")
+    parser.add_argument("--top", type=int, help="Number of areas to prefetch", default=PREFETCH_HISTORY_TOP)
+
+    if args is None:
+        args = sys.argv[1:]
+
+    return parser.parse_args(args)
+
+def get_area_key(args: dict):
+    return (args['raster_type'], args['raster_source'], args['zoom_adjust'], args['map_w'], args['map_s'], args['map_e'], args['map_n'], args['map_size_w_m'], args['map_size_h_m'])
+
+def get_hot_areas(history_folder: str, data_folder: Optional[str] = None, top: int = PREFETCH_HISTORY_TOP):
+    """
+    Returns the command line arguments of the prefetch requests for the top most requested areas
+    (the same raster, bounds and size) in the conf.json files of the stored maps.
+    """
+    counts = collections.Counter()
+    latest = {}
+    for record in load_records(history_folder, data_folder):
+        if os.path.basename(record.fn) != 'conf.json':
+            continue
+        try:
+            args = dto.parse_command_line_args(record.argv)
+        except SystemExit:
+            logger.warning(f'Invalid stored request. - ({record.fn})')
+            continue
+        key = get_area_key(args)
+        counts[key] += 1
+        latest[key] = record.argv
+
+    areas = []
+    for key, count in counts.most_common(top):
+        argv = list(latest[key])
+        set_arg(argv, 'request_type', dto.RequestType.MAP_PREFETCH.value)
+        set_arg(argv, 'id', hashlib.md5(repr(key).encode('utf-8')).hexdigest())
+        areas.append((count, argv))
+    return areas
+
+def run_prefetch(run_request: Callable[[list[str]], dict], history_folder: str, output_folder: str, data_folder: Optional[str] = None, top: int = PREFETCH_HISTORY_TOP):
+    """
+    Prefetches the rasters of the most requested areas one after another, at the lowest priority
+    of the machine (nice). A RESULT line is printed for every area and a SUMMARY line at the end.
+
+    Parameters
+    ----------
+    run_request : callable
+        Function that runs a single request from its command line arguments and returns its result dict.
+    """
+    if hasattr(os, 'nice'):
+        os.nice(19)
+
+    start = time.monotonic()
+    areas = get_hot_areas(history_folder, data_folder, top)
+    logger.info(f'Prefetching {len(areas)} areas.')
+
+    results = []
+    for count, argv in areas:
+        set_arg(argv, 'output_folder', output_folder)
+        result = {**run_request(argv), 'requests': count}
+        results.append(result)
+        print_line('RESULT', result)
+
+    summary = {
+        'areas': len(results),
+        'ok': sum(1 for r in results if r['status'] == 'ok'),
+        'failed': sum(1 for r in results if r['status'] != 'ok'),
+        'wall_time_s': round(time.monotonic() - start, 3),
+    }
+    print_line('SUMMARY', summary)
+    return summary
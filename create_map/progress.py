@@ -1,21 +1,75 @@
+import threading
+import time
+
 class ProgressError(Exception):
     pass
 
+class ProgressCancelled(ProgressError):
+    def __init__(self, message='Zahteva je bila preklicana'):
+        super().__init__(message)
+
+class CancellationToken:
+    """
+    Cancellation of a request, checked by the ProgressTracker on every update.
+
+    The token is cancelled with cancel() (eg. from a signal handler) or once poll returns True
+    (eg. when a sentinel file exists). Poll is called at most every poll_interval seconds.
+    """
+    def __init__(self, poll=None, poll_interval=0.2):
+        self.poll = poll
+        self.poll_interval = poll_interval
+        self._cancelled = False
+        self._last_poll = 0
+
+    def cancel(self):
+        """
+        Cancel the request
+        """
+        self._cancelled = True
+
+    def is_cancelled(self):
+        """
+        Check if the request was cancelled
+        """
+        if not self._cancelled and self.poll is not None:
+            now = time.monotonic()
+            if now - self._last_poll >= self.poll_interval:
+                self._last_poll = now
+                if self.poll():
+                    self._cancelled = True
+        return self._cancelled
+
+    def check(self):
+        """
+        Raise ProgressCancelled if the request was cancelled
+        """
+        if self.is_cancelled():
+            raise ProgressCancelled()
+
 class ProgressTracker:
-    def __init__(self, min_value, max_value, on_progress, on_message):
+    def __init__(self, min_value, max_value, on_progress, on_message, token=None):
         assert min_value < max_value
         self.min_value = min_value
         self.max_value = max_value
         self.range = max_value - min_value
         self.on_progress = on_progress
         self.on_message = on_message
+        self.token = token
         self._last_value = None
         self._last_message = None
 
+    def check(self):
+        """
+        Raise ProgressCancelled if the request was cancelled (for long loops that do not update the progress)
+        """
+        if self.token is not None:
+            self.token.check()
+
     def msg(self, message):
         """
         Update message
         """
+        self.check()
         if message != self._last_message:
             self.on_message(message)
             self._last_message = message
@@ -31,6 +85,7 @@ class ProgressTracker:
         Update progress by a fraction of the total range [0, 1]
         """
         assert 0 <= value <= 1
+        self.check()
         if value != self._last_value:
             self.on_progress(value * self.range + self.min_value)
             self._last_value = value
@@ -41,7 +96,7 @@ class ProgressTracker:
         """
         def on_progress(value):
             self.step(value * (max_value - min_value) + min_value)
-        return ProgressTracker(0, 1, on_progress, self.on_message)
+        return ProgressTracker(0, 1, on_progress, self.on_message, self.token)
     
     def over_range(self, min_value, max_value, iterable):
         """
@@ -57,4 +112,40 @@ class ProgressTracker:
             yield x
         sub.step(1)
         
+class ParallelProgress:
+    """
+    Progress of parts of a task that run at the same time on different threads, each part over its
+    own sub-range of the tracker. The reported progress is the sum of the finished fractions of all
+    parts (the same value as when the parts run one after another), it never decreases and updates
+    from different threads are serialized.
+    """
+    def __init__(self, pt: ProgressTracker, token=None):
+        self.pt = pt
+        self.token = token if token is not None else pt.token
+        self._lock = threading.Lock()
+        self._done = {}
+        self._value = 0
+
+    def sub(self, name, min_value=None, max_value=None):
+        """
+        Create the tracker of a part. A part without a range only reports messages.
+        """
+        def on_progress(value):
+            if min_value is None:
+                return
+            with self._lock:
+                self._done[name] = value * (max_value - min_value)
+                value = min(sum(self._done.values()), 1)
+                if value > self._value:
+                    self._value = value
+                    self.pt.step(value)
+
+        def on_message(message):
+            with self._lock:
+                self.pt.msg(message)
+
+        if min_value is not None:
+            self._done[name] = 0
+        return ProgressTracker(0, 1, on_progress, on_message, self.token)
+
 NoProgress = ProgressTracker(0, 1, lambda x: None, lambda x: None)
\ No newline at end of file
@@ -0,0 +1,258 @@
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import glob
+import json
+import logging
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import Optional
+from batch import request_to_argv, percentile, print_line
+
+### STATIC CONFIGURATION ###
+
+REPLAY_PATH_ARGS = ['raster_source', 'slikal', 'slikad'] # Arguments that conf.json stores without their folder
+REPLAY_TIMEOUT_GRACE_S = 5 # Time a timed out request gets to stop after SIGTERM before it is killed
+REPLAY_TOP_ERRORS = 10 # Number of distinct errors listed in the summary
+CACHE_LOG_PATTERNS = [ # (regex on the log of the request, cache, 'hits' or 'misses', or None to read the counts from the hits and misses groups)
+    (re.compile(r'Using cached raster mosaic\.'), 'mosaic', 'hits'),
+    (re.compile(r'Created raster mosaic\.'), 'mosaic', 'misses'),
+    (re.compile(r'Using cached reambulation layer\.'), 'reambulation_layer', 'hits'),
+    (re.compile(r'Created reambulation layer\.'), 'reambulation_layer', 'misses'),
+    (re.compile(r'Using cached tile\.'), 'tile', 'hits'),
+    (re.compile(r'Rendered tile '), 'tile', 'misses'),
+    (re.compile(r'Tile store: (?P<hits>\d+) of \d+ tiles valid, fetching (?P<misses>\d+) '), 'tile_store', None),
+    (re.compile(r'(Map|Atlas) exists \(nothing to do\)\.'), 'output', 'hits'),
+]
+
+### /STATIC CONFIGURATION ###
+
+logger = logging.getLogger('create_map.replay')
+
+class Record:
+    def __init__(self, fn: str, arrival: float, argv: list[str]):
+        self.fn = fn
+        self.arrival = arrival
+        self.argv = argv
+
+def get_arg(argv: list[str], name: str):
+    if f'--{name}' in argv:
+        return argv[argv.index(f'--{name}') + 1]
+    return None
+
+def set_arg(argv: list[str], name: str, value: str):
+    if f'--{name}' in argv:
+        argv[argv.index(f'--{name}') + 1] = value
+    else:
+        argv += [f'--{name}', value]
+
+def load_records(records_folder: str, data_folder: Optional[str] = None, replace: list[tuple[str]] = ()):
+    """
+    Loads the requests from the conf.json files of the finished maps and the stored errors
+    under records_folder (usually the output folder of the server), sorted by arrival.
+
+    Errors store their timestamp and command line. conf.json does not store a timestamp,
+    the time it was written (when the map was finished) is used instead, and the paths in
+    REPLAY_PATH_ARGS are stored without their folder, they are resolved in data_folder.
+    The replace rules of the errors (the same as for INPUT_CONTEXT) and the given replace
+    rules are applied to all arguments.
+    """
+    records = []
+
+    for fn in glob.glob(os.path.join(records_folder, '**', 'conf.json'), recursive=True):
+        with open(fn, 'r', encoding='utf-8') as f:
+            argv = request_to_argv(json.load(f))
+        if data_folder is not None:
+            for name in REPLAY_PATH_ARGS:
+                value = get_arg(argv, name)
+                if value and not value.startswith('https://') and not os.path.isabs(value):
+                    set_arg(argv, name, os.path.join(data_folder, value))
+        records.append(Record(fn, os.path.getmtime(fn), argv))
+
+    for fn in glob.glob(os.path.join(records_folder, '**', 'errors', '*.json'), recursive=True):
+        with open(fn, 'r', encoding='utf-8') as f:
+            error = json.load(f)
+        argv = request_to_argv(error)
+        for f, t in error.get('replace', []):
+            argv = [arg.replace(f, t) for arg in argv]
+        records.append(Record(fn, datetime.datetime.fromisoformat(error['timestamp']).timestamp(), argv))
+
+    for record in records:
+        for f, t in replace:
+            record.argv = [arg.replace(f, t) for arg in record.argv]
+        # Progress and errors are reported on stderr, the errors are read from there
+        record.argv = [arg for arg in record.argv if arg not in ('--emit-progress', '--estimate')] + ['--emit-progress']
+
+    records.sort(key=lambda record: record.arrival)
+    return records
+
+def get_arrival_offsets(records: list[Record], speed: float, max_gap_s: Optional[float] = None):
+    """
+    Offsets (seconds from the start of the replay) at which the records are issued.
+    Gaps between arrivals are divided by speed and capped at max_gap_s, speed 0 issues all records at once.
+    """
+    offsets = []
+    offset = 0.0
+    for i, record in enumerate(records):
+        if i > 0 and speed > 0:
+            gap = (record.arrival - records[i - 1].arrival) / speed
+            if max_gap_s is not None:
+                gap = min(gap, max_gap_s)
+            offset += max(gap, 0)
+        offsets.append(offset)
+    return offsets
+
+def parse_cache_stats(log: str):
+    """
+    Counts the cache hits and misses from the log of a request, see CACHE_LOG_PATTERNS.
+    """
+    stats = {}
+    for line in log.splitlines():
+        for pattern, name, kind in CACHE_LOG_PATTERNS:
+            m = pattern.search(line)
+            if m is None:
+                continue
+            stat = stats.setdefault(name, {'hits': 0, 'misses': 0})
+            if kind is None:
+                stat['hits'] += int(m['hits'])
+                stat['misses'] += int(m['misses'])
+            else:
+                stat[kind] += 1
+    return stats
+
+def run_record(script: str, record: Record, timeout: Optional[float] = None):
+    """
+    Runs the request in its own create_map.py process.
+    """
+    result = {'record': os.path.relpath(record.fn), 'id': get_arg(record.argv, 'id'), 'request_type': get_arg(record.argv, 'request_type')}
+    start = time.monotonic()
+    # In its own process group, so the worker processes of the request can be killed with it
+    process = subprocess.Popen([sys.executable, script] + record.argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace', start_new_session=True)
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+        status = 'ok' if process.returncode == 0 else 'error'
+    except subprocess.TimeoutExpired:
+        # create_map.py cancels the request on SIGTERM, give it time to clean up
+        process.send_signal(signal.SIGTERM)
+        try:
+            stdout, stderr = process.communicate(timeout=REPLAY_TIMEOUT_GRACE_S)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            stdout, stderr = process.communicate()
+        status = 'timeout'
+    result['service_s'] = round(time.monotonic() - start, 3)
+    result['status'] = status
+
+    errors = [line[len('ERROR: '):] for line in stderr.splitlines() if line.startswith('ERROR: ')]
+    if status == 'error':
+        result['error'] = errors[-1] if len(errors) > 0 else f'Exit code {process.returncode}'
+    result['cache'] = parse_cache_stats(stdout)
+    return result
+
+def run_replay(records: list[Record], workers: int, speed: float = 1.0, max_gap_s: Optional[float] = None, timeout: Optional[float] = None, script: Optional[str] = None):
+    """
+    Issues the recorded requests with their original spacing (divided by speed), each in its own
+    create_map.py process, with at most workers requests running at the same time. Requests that
+    arrive while all workers are busy wait for a free worker.
+
+    A RESULT line is printed for every request as it finishes and a SUMMARY line at the end with
+    throughput, the latency distribution (from arrival, including the wait for a worker), cache hit
+    ratios and the most common errors.
+    """
+    if script is None:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'create_map.py')
+
+    offsets = get_arrival_offsets(records, speed, max_gap_s)
+    results = []
+    output_lock = threading.Lock()
+    start = time.monotonic()
+
+    def run(record: Record, arrival: float):
+        result = run_record(script, record, timeout)
+        finished = time.monotonic() - start
+        result['arrival_s'] = round(arrival, 3)
+        result['wait_s'] = round(max(finished - arrival - result['service_s'], 0), 3)
+        result['latency_s'] = round(finished - arrival, 3)
+        with output_lock:
+            results.append(result)
+            print_line('RESULT', result)
+
+    logger.info(f'Replaying {len(records)} requests over {offsets[-1] if len(offsets) > 0 else 0:.1f}s on {workers} workers.')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for record, offset in zip(records, offsets):
+            delay = start + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(run, record, time.monotonic() - start))
+        for future in futures:
+            future.result()
+
+    wall_time = time.monotonic() - start
+    latencies = [r['latency_s'] for r in results if r['status'] == 'ok']
+    waits = [r['wait_s'] for r in results]
+
+    cache = collections.defaultdict(lambda: {'hits': 0, 'misses': 0})
+    for r in results:
+        for name, stat in r['cache'].items():
+            cache[name]['hits'] += stat['hits']
+            cache[name]['misses'] += stat['misses']
+    for stat in cache.values():
+        total = stat['hits'] + stat['misses']
+        stat['hit_ratio'] = round(stat['hits'] / total, 3) if total > 0 else None
+
+    errors = collections.Counter(r.get('error', r['status']) for r in results if r['status'] != 'ok')
+    summary = {
+        'requests': len(results),
+        'ok': sum(1 for r in results if r['status'] == 'ok'),
+        'failed': sum(1 for r in results if r['status'] == 'error'),
+        'timeouts': sum(1 for r in results if r['status'] == 'timeout'),
+        'workers': workers,
+        'speed': speed,
+        'wall_time_s': round(wall_time, 3),
+        'offered_rps': round(len(records) / offsets[-1], 3) if len(offsets) > 0 and offsets[-1] > 0 else None,
+        'throughput_rps': round(len(results) / wall_time, 3) if wall_time > 0 else None,
+        'latency_p50_s': percentile(latencies, 50),
+        'latency_p90_s': percentile(latencies, 90),
+        'latency_p99_s': percentile(latencies, 99),
+        'latency_max_s': max(latencies) if len(latencies) > 0 else None,
+        'wait_p50_s': percentile(waits, 50),
+        'wait_p95_s': percentile(waits, 95),
+        'cache': dict(cache),
+        'errors': dict(errors.most_common(REPLAY_TOP_ERRORS)),
+    }
+    print_line('SUMMARY', summary)
+    return summary
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    parser = argparse.ArgumentParser(description="Replay the stored map requests (conf.json and errors) to reproduce a load locally")
+    parser.add_argument("--records", type=str, help="Folder with the stored requests (searched recursively)", required=True)
+    parser.add_argument("--output_folder", type=str, help="Output folder of the replayed requests (replaces the recorded one)", required=True)
+    parser.add_argument("--data_folder", type=str, help="Folder of the raster sources and logos stored without a path in conf.json")
+    parser.add_argument("--replace", type=str, nargs=2, action='append', metavar=('FROM', 'TO'), help="Replace a string in all arguments (can be repeated)", default=[])
+    parser.add_argument("--workers", type=int, help="Number of requests running at the same time", default=os.cpu_count() or 1)
+    parser.add_argument("--speed", type=float, help="Time compression of the arrivals (1 is the original spacing, 0 issues all at once)", default=1.0)
+    parser.add_argument("--max_gap_s", type=float, help="Longest pause between two arrivals in seconds (after compression)")
+    parser.add_argument("--timeout", type=float, help="Cancel requests running longer than this many seconds")
+    parser.add_argument("--limit", type=int, help="Replay only the first N requests")
+    args = parser.parse_args()
+
+    records = load_records(args.records, args.data_folder, args.replace)
+    if args.limit is not None:
+        records = records[:args.limit]
+    for record in records:
+        set_arg(record.argv, 'output_folder', args.output_folder)
+
+    summary = run_replay(records, args.workers, args.speed, args.max_gap_s, args.timeout)
+    exit(1 if summary['failed'] + summary['timeouts'] > 0 else 0)
+
+if __name__ == '__main__':
+    main()
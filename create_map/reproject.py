@@ -0,0 +1,142 @@
+import concurrent.futures
+import functools
+import math
+import os
+import cv2
+import numpy as np
+import pyproj
+import rasterio.transform
+from progress import ProgressTracker, NoProgress
+
+### STATIC CONFIGURATION ###
+
+REPROJECT_MESH_STEP = 64 # Distance in output pixels between the points that are transformed exactly, the source coordinates in between are interpolated
+REPROJECT_MESH_CACHE_SIZE = 32 # Number of transformation meshes kept in memory
+REPROJECT_BLOCK_SIZE = 1024 # Size of the square blocks of the output remapped at once by one thread
+REPROJECT_THREADS = None # Threads remapping the blocks (None uses all cores)
+REPROJECT_INTERPOLATION = cv2.INTER_LINEAR # Interpolation of the source pixels
+
+### /STATIC CONFIGURATION ###
+
+@functools.lru_cache(maxsize=8)
+def get_transformer(from_epsg: int, to_epsg: int):
+    return pyproj.Transformer.from_crs(pyproj.CRS.from_epsg(from_epsg), pyproj.CRS.from_epsg(to_epsg), always_xy=True)
+
+def transform_bounds(bounds: tuple[float], from_epsg: int, to_epsg: int):
+    """
+    Returns the bounds (west, south, east, north) in to_epsg of the whole area inside bounds in from_epsg,
+    including the parts that the rotation between the coordinate systems moves outside the transformed corners.
+    """
+    if from_epsg == to_epsg:
+        return tuple(bounds)
+    return get_transformer(from_epsg, to_epsg).transform_bounds(*bounds, densify_pts=21)
+
+@functools.lru_cache(maxsize=REPROJECT_MESH_CACHE_SIZE)
+def get_mesh(dst_bounds: tuple[float], dst_shape: tuple[int], dst_epsg: int, src_epsg: int, step: int = REPROJECT_MESH_STEP):
+    """
+    Transforms the centers of every step-th pixel (rows, cols) of the output grid (and of the last row and column)
+    into the source coordinate system. Returns the source x and y coordinates of the mesh points.
+    """
+    rows = np.arange(max(math.ceil((dst_shape[0] - 1) / step), 1) + 1) * step
+    cols = np.arange(max(math.ceil((dst_shape[1] - 1) / step), 1) + 1) * step
+    dst_transform = rasterio.transform.from_bounds(*dst_bounds, dst_shape[1], dst_shape[0])
+    x = dst_transform.c + (cols + 0.5) * dst_transform.a
+    y = dst_transform.f + (rows + 0.5) * dst_transform.e
+    xx, yy = np.meshgrid(x, y)
+    src_x, src_y = get_transformer(dst_epsg, src_epsg).transform(xx, yy)
+    src_x.flags.writeable = False
+    src_y.flags.writeable = False
+    return src_x, src_y
+
+def get_interpolation_weights(count: int, start: int, stop: int, step: int):
+    """
+    Weights (count, stop - start) of the linear interpolation of count mesh points step pixels apart to the pixels [start, stop).
+    """
+    p = np.arange(start, stop)
+    p0 = np.minimum(p // step, count - 2)
+    t = ((p - p0 * step) / step).astype(np.float32)
+    weights = np.zeros((count, stop - start), dtype=np.float32)
+    weights[p0, np.arange(stop - start)] = 1 - t
+    weights[p0 + 1, np.arange(stop - start)] = t
+    return weights
+
+def interpolate_mesh(mesh: np.ndarray, step: int, rows: tuple[int], cols: tuple[int]):
+    """
+    Bilinearly interpolates the mesh to the pixels [rows[0], rows[1]) x [cols[0], cols[1]) of the output.
+    """
+    row_weights = get_interpolation_weights(mesh.shape[0], *rows, step)
+    col_weights = get_interpolation_weights(mesh.shape[1], *cols, step)
+    return row_weights.T @ (mesh.astype(np.float32) @ col_weights)
+
+def remap_block(src: np.ndarray, src_mesh: tuple[np.ndarray], step: int, rows: tuple[int], cols: tuple[int], out: np.ndarray, nodata: int):
+    """
+    Fills the block [rows[0], rows[1]) x [cols[0], cols[1]) of out (bands, rows, cols) from src (bands, rows, cols).
+    src_mesh are the source pixel coordinates of the mesh points.
+    """
+    mesh_x, mesh_y = src_mesh
+    map_x = interpolate_mesh(mesh_x, step, rows, cols)
+    map_y = interpolate_mesh(mesh_y, step, rows, cols)
+
+    # Only remap from the part of the source under the block (OpenCV limits the size of the source)
+    x0 = max(int(math.floor(map_x.min())) - 2, 0)
+    y0 = max(int(math.floor(map_y.min())) - 2, 0)
+    x1 = min(int(math.ceil(map_x.max())) + 3, src.shape[2])
+    y1 = min(int(math.ceil(map_y.max())) + 3, src.shape[1])
+    if x1 <= x0 or y1 <= y0:
+        return
+
+    # Fixed point maps, converted once for all bands
+    map_x -= x0
+    map_y -= y0
+    map_xy, map_frac = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+    for band in range(src.shape[0]):
+        out[band, rows[0]:rows[1], cols[0]:cols[1]] = cv2.remap(
+            src[band, y0:y1, x0:x1], map_xy, map_frac, REPROJECT_INTERPOLATION,
+            borderMode=cv2.BORDER_CONSTANT, borderValue=nodata)
+
+def reproject(src: np.ndarray, src_transform: rasterio.transform.Affine, src_epsg: int, dst_bounds: tuple[float], dst_shape: tuple[int], dst_epsg: int = 3794, nodata: int = 255, pt: ProgressTracker = NoProgress):
+    """
+    Reprojects the raster into the grid of dst_shape (rows, cols) pixels exactly covering dst_bounds in dst_epsg.
+
+    Only the points of a coarse mesh are transformed between the coordinate systems (cached, see get_mesh),
+    the source coordinates of the other pixels are interpolated. The output is remapped in blocks on a thread pool.
+
+    Parameters
+    ----------
+    src : np.ndarray
+        Source raster (bands, rows, cols).
+    src_transform : Affine
+        Transform of the source raster in src_epsg.
+    dst_bounds : tuple (west, south, east, north)
+        Bounds of the output in dst_epsg.
+
+    Returns the reprojected raster (bands, rows, cols), pixels outside the source are nodata.
+    """
+    step = REPROJECT_MESH_STEP
+    mesh_x, mesh_y = get_mesh(tuple(dst_bounds), tuple(dst_shape), dst_epsg, src_epsg, step)
+    # Source pixel coordinates of the mesh points (OpenCV has the pixel centers at integer coordinates),
+    # the transform is affine, so it is the same to apply it before the interpolation
+    inverse = ~src_transform
+    src_mesh = (
+        inverse.a * mesh_x + inverse.b * mesh_y + inverse.c - 0.5,
+        inverse.d * mesh_x + inverse.e * mesh_y + inverse.f - 0.5,
+    )
+    out = np.full((src.shape[0], *dst_shape), nodata, dtype=src.dtype)
+
+    blocks = [
+        ((r, min(r + REPROJECT_BLOCK_SIZE, dst_shape[0])), (c, min(c + REPROJECT_BLOCK_SIZE, dst_shape[1])))
+        for r in range(0, dst_shape[0], REPROJECT_BLOCK_SIZE)
+        for c in range(0, dst_shape[1], REPROJECT_BLOCK_SIZE)
+    ]
+    workers = REPROJECT_THREADS or os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(remap_block, src, src_mesh, step, rows, cols, out, nodata) for rows, cols in blocks]
+        try:
+            for i, future in enumerate(concurrent.futures.as_completed(futures)):
+                future.result()
+                pt.step((i + 1) / len(futures))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return out
@@ -0,0 +1,107 @@
+import math
+from typing import Optional, Union
+import cv2
+import numpy as np
+from PIL import Image
+
+### STATIC CONFIGURATION ###
+
+RESAMPLE_REDUCING_GAP = 2.0 # The final filter always downscales by at least this much after the integer box reduction (higher is closer to a plain resize)
+RESAMPLE_THREADS = None # Threads used by OpenCV for the box reduction (None uses all cores)
+
+### /STATIC CONFIGURATION ###
+
+# Support of the PIL filters in source pixels (at scale 1)
+FILTER_SUPPORT = {
+    Image.Resampling.NEAREST: 0,
+    Image.Resampling.BOX: 0.5,
+    Image.Resampling.BILINEAR: 1,
+    Image.Resampling.HAMMING: 1,
+    Image.Resampling.BICUBIC: 2,
+    Image.Resampling.LANCZOS: 3,
+}
+
+if RESAMPLE_THREADS is not None:
+    cv2.setNumThreads(RESAMPLE_THREADS)
+
+def get_reduce_factor(box_size: tuple[float], size: tuple[int]):
+    """
+    Integer factor the source can be box reduced by before resizing box_size to size.
+    """
+    scale = min(box_size[0] / size[0], box_size[1] / size[1])
+    return max(1, int(scale / RESAMPLE_REDUCING_GAP))
+
+def reduce_array(a: np.ndarray, factor: int):
+    """
+    Reduces the image array (rows, cols, bands) by averaging factor x factor blocks, the same as Image.reduce.
+    Blocks at the right and bottom edge are averaged over the pixels they contain.
+    """
+    h, w = a.shape[:2]
+    fh, fw = h // factor, w // factor
+    out = np.empty((-(-h // factor), -(-w // factor)) + a.shape[2:], dtype=a.dtype)
+
+    # Full blocks, integer INTER_AREA is an exact (multithreaded) box average
+    if fh > 0 and fw > 0:
+        out[:fh, :fw] = cv2.resize(a[:fh * factor, :fw * factor], (fw, fh), interpolation=cv2.INTER_AREA).reshape(out[:fh, :fw].shape)
+    # Partial blocks
+    if fw < out.shape[1]:
+        out[:fh, fw:] = np.asarray(Image.fromarray(np.ascontiguousarray(a[:fh * factor, fw * factor:])).reduce(factor))
+    if fh < out.shape[0]:
+        out[fh:] = np.asarray(Image.fromarray(np.ascontiguousarray(a[fh * factor:])).reduce(factor))
+    return out
+
+def resize(img: Union[Image.Image, np.ndarray], size: tuple[int], resample: Image.Resampling = Image.Resampling.LANCZOS, box: Optional[tuple[float]] = None, factor: Optional[int] = None):
+    """
+    Resizes the image (or RGB image array) like Image.resize, but large downscales are first box reduced
+    by an integer factor, so the filter only runs over a small image.
+
+    Parameters
+    ----------
+    box : tuple (left, upper, right, lower)
+        Area of the source that is resized, the pixels around it are used for the support of the filter.
+    factor : int
+        Factor of the box reduction, by default chosen with get_reduce_factor. Pass the same factor when
+        resizing parts of one image (eg. strips) so that they are all reduced on the same grid.
+
+    Returns the resized Image.
+    """
+    src_size = img.size if isinstance(img, Image.Image) else (img.shape[1], img.shape[0])
+    if box is None:
+        box = (0, 0, *src_size)
+    if factor is None:
+        factor = get_reduce_factor((box[2] - box[0], box[3] - box[1]), size)
+
+    if factor <= 1:
+        if not isinstance(img, Image.Image):
+            img = Image.fromarray(img)
+        return img.resize(size, resample=resample, box=box)
+
+    # Reduce only the blocks under the box and the support of the filter around it
+    support = FILTER_SUPPORT.get(resample, 3)
+    margin_x = (math.ceil(support * max((box[2] - box[0]) / size[0] / factor, 1)) + 1) * factor
+    margin_y = (math.ceil(support * max((box[3] - box[1]) / size[1] / factor, 1)) + 1) * factor
+    x0 = max(int(box[0]) - margin_x, 0) // factor * factor
+    y0 = max(int(box[1]) - margin_y, 0) // factor * factor
+    x1 = min(math.ceil((box[2] + margin_x) / factor) * factor, src_size[0])
+    y1 = min(math.ceil((box[3] + margin_y) / factor) * factor, src_size[1])
+
+    premultiplied = False
+    if isinstance(img, Image.Image):
+        crop = img.crop((x0, y0, x1, y1))
+        if crop.mode == 'RGBA':
+            # Image.resize filters RGBA with premultiplied alpha, so transparent pixels do not bleed their color
+            crop = crop.convert('RGBa')
+            premultiplied = True
+        a = np.asarray(crop)
+    else:
+        a = img[y0:y1, x0:x1]
+
+    reduced = reduce_array(a, factor)
+    if premultiplied:
+        reduced = Image.frombytes('RGBa', (reduced.shape[1], reduced.shape[0]), reduced.tobytes())
+    else:
+        reduced = Image.fromarray(reduced)
+
+    box = ((box[0] - x0) / factor, (box[1] - y0) / factor, (box[2] - x0) / factor, (box[3] - y0) / factor)
+    resized = reduced.resize(size, resample=resample, box=box)
+    return resized.convert('RGBA') if premultiplied else resized
@@ -0,0 +1,373 @@
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import multiprocessing.managers
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+import dto
+from batch import request_to_argv, percentile, print_line
+from progress import ProgressCancelled
+
+### STATIC CONFIGURATION ###
+
+SCHEDULER_PRIORITIES = { # Priority class of every request type (lower runs first)
+    dto.RequestType.MAP_PREVIEW: 0,
+    dto.RequestType.MAP_REAMBULATION: 1,
+    dto.RequestType.CREATE_MAP: 2,
+    dto.RequestType.MAP_ATLAS: 3,
+    dto.RequestType.MAP_PREFETCH: 4,
+}
+SCHEDULER_RESERVED_PREVIEW_SLOTS = 1 # Worker slots that only previews can use
+SCHEDULER_AGING_S = 30 # A waiting job moves up one priority class every this many seconds
+SCHEDULER_METRICS_WINDOW = 1000 # Number of recent wait times kept per request type for the metrics
+DAEMON_PARENT_POLL_S = 1 # How often the worker processes of the daemon check that it is still running
+SCHEDULER_MEMORY_FRACTION = 0.8 # Fraction of the physical memory the estimated peak memory of the running jobs may add up to (None only limits the slots)
+
+### /STATIC CONFIGURATION ###
+
+logger = logging.getLogger('create_map.scheduler')
+
+class Job:
+    def __init__(self, job_id: str, request_type: dto.RequestType, argv: list[str], memory_bytes: int = 0):
+        self.id = job_id
+        self.request_type = request_type
+        self.argv = argv
+        # Estimated peak memory, 0 when unknown
+        self.memory_bytes = memory_bytes
+        self.enqueued = time.monotonic()
+        self.started = None
+
+class Scheduler:
+    """
+    Schedules jobs on a fixed number of worker slots.
+
+    Every request type has its own FIFO lane with a priority class. When a slot frees up, the job
+    with the best priority runs first, where waiting jobs gain one priority class every
+    SCHEDULER_AGING_S seconds, so big jobs are not starved. Part of the slots is reserved for
+    previews, so a preview never waits for a full map render to finish.
+
+    With a memory budget, a job only starts while the estimated peak memory of the running jobs and
+    its own fits in the budget (or when nothing else runs). The next job in line that does not fit
+    holds back the other jobs until enough memory is freed, only previews still pass it.
+    """
+    def __init__(self, slots: int, reserved_preview_slots: int = SCHEDULER_RESERVED_PREVIEW_SLOTS, aging_s: float = SCHEDULER_AGING_S, memory_bytes: Optional[int] = None):
+        self.slots = slots
+        self.memory_bytes = memory_bytes
+        self.running_memory_bytes = 0
+        # At least one slot has to remain for the other request types
+        self.reserved_preview_slots = max(0, min(reserved_preview_slots, slots - 1))
+        self.aging_s = aging_s
+        self.lanes = {t: collections.deque() for t in dto.RequestType}
+        self.running = {t: 0 for t in dto.RequestType}
+        self.completed = {t: 0 for t in dto.RequestType}
+        self.running_jobs = set()
+        self.wait_times = {t: collections.deque(maxlen=SCHEDULER_METRICS_WINDOW) for t in dto.RequestType}
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def submit(self, job: Job, on_queued: Optional[Callable[[Job, int], None]] = None):
+        """
+        Queues the job. on_queued is called with the job and the depth of its lane while the job
+        can not be started yet, so it is reported as queued before it is reported as started.
+        """
+        with self.cond:
+            self.lanes[job.request_type].append(job)
+            if on_queued is not None:
+                on_queued(job, len(self.lanes[job.request_type]))
+            self.cond.notify_all()
+
+    def cancel(self, job_id: str):
+        """
+        Removes the queued jobs with the id and returns them.
+        """
+        with self.cond:
+            cancelled = []
+            for lane in self.lanes.values():
+                for job in [job for job in lane if job.id == job_id]:
+                    lane.remove(job)
+                    cancelled.append(job)
+            return cancelled
+
+    def is_running(self, job_id: str):
+        with self.cond:
+            return any(job.id == job_id for job in self.running_jobs)
+
+    def close(self):
+        """
+        Stops accepting jobs, next_job returns None once the queued jobs are started.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def _fits(self, job: Job, running: int):
+        if self.memory_bytes is None or running == 0:
+            return True
+        return self.running_memory_bytes + job.memory_bytes <= self.memory_bytes
+
+    def _pick(self, now: float):
+        running = sum(self.running.values())
+        if running >= self.slots:
+            return None
+
+        other_running = running - self.running[dto.RequestType.MAP_PREVIEW]
+        candidates = []
+        for request_type, lane in self.lanes.items():
+            if len(lane) == 0:
+                continue
+            if request_type != dto.RequestType.MAP_PREVIEW and other_running >= self.slots - self.reserved_preview_slots:
+                continue
+            job = lane[0]
+            score = (SCHEDULER_PRIORITIES.get(request_type, max(SCHEDULER_PRIORITIES.values())) - (now - job.enqueued) / self.aging_s, job.enqueued)
+            candidates.append((score, job))
+        candidates.sort(key=lambda candidate: candidate[0])
+
+        for i, (_, job) in enumerate(candidates):
+            if self._fits(job, running):
+                # Only previews may pass a job that waits for memory
+                if i == 0 or job.request_type == dto.RequestType.MAP_PREVIEW:
+                    return job
+        return None
+
+    def next_job(self, timeout: Optional[float] = None):
+        """
+        Waits for a free slot and returns the next job to run (or None once closed and empty).
+        """
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                job = self._pick(now)
+                if job is not None:
+                    self.lanes[job.request_type].popleft()
+                    self.running[job.request_type] += 1
+                    self.running_memory_bytes += job.memory_bytes
+                    self.running_jobs.add(job)
+                    job.started = now
+                    self.wait_times[job.request_type].append(now - job.enqueued)
+                    return job
+                if self.closed and all(len(lane) == 0 for lane in self.lanes.values()):
+                    return None
+                # Wake up periodically, aging can change the order without any other event
+                if not self.cond.wait(timeout if timeout is not None else self.aging_s):
+                    if timeout is not None:
+                        return None
+
+    def finish(self, job: Job):
+        with self.cond:
+            self.running[job.request_type] -= 1
+            self.running_memory_bytes -= job.memory_bytes
+            self.running_jobs.discard(job)
+            self.completed[job.request_type] += 1
+            self.cond.notify_all()
+
+    def metrics(self):
+        """
+        Queue depth, running and completed jobs and wait times (seconds) per request type.
+        """
+        with self.cond:
+            now = time.monotonic()
+            lanes = {}
+            for request_type in dto.RequestType:
+                wait_times = [round(t, 3) for t in self.wait_times[request_type]]
+                lane = self.lanes[request_type]
+                lanes[request_type.value] = {
+                    'queue_depth': len(lane),
+                    'running': self.running[request_type],
+                    'completed': self.completed[request_type],
+                    'oldest_wait_s': round(now - lane[0].enqueued, 3) if len(lane) > 0 else 0,
+                    'wait_p50_s': percentile(wait_times, 50),
+                    'wait_p95_s': percentile(wait_times, 95),
+                    'wait_max_s': max(wait_times) if len(wait_times) > 0 else None,
+                }
+            return {
+                'slots': self.slots,
+                'reserved_preview_slots': self.reserved_preview_slots,
+                'memory_bytes': self.memory_bytes,
+                'running_memory_bytes': self.running_memory_bytes,
+                'lanes': lanes,
+            }
+
+def parse_daemon_args(args=None):
+    """
+    Parse command line arguments for daemon mode (create_map.py --daemon --workers N).
+    """
+    parser = argparse.ArgumentParser(description="Run map requests from stdin on a scheduled worker pool")
+    parser.add_argument("--daemon", action="store_true", help="Run as a daemon", required=True)
+    parser.add_argument("--workers", type=int, help="Number of worker processes", default=os.cpu_count() or 1)
+    parser.add_argument("--reserved_preview_slots", type=int, help="Workers reserved for previews", default=SCHEDULER_RESERVED_PREVIEW_SLOTS)
+
+    if args is None:
+        args = sys.argv[1:]
+
+    return parser.parse_args(args)
+
+def get_request_type(argv: list[str]):
+    if '--request_type' in argv:
+        return dto.RequestType(argv[argv.index('--request_type') + 1])
+    raise ValueError('Missing request type')
+
+def get_request_id(argv: list[str]):
+    if '--id' in argv:
+        return argv[argv.index('--id') + 1]
+    return ''
+
+def get_memory_budget(fraction: Optional[float] = SCHEDULER_MEMORY_FRACTION):
+    """
+    Memory budget of the scheduler, the fraction of the physical memory (None when unknown or disabled).
+    """
+    if fraction is None:
+        return None
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * fraction)
+    except (AttributeError, ValueError, OSError):
+        # Not available on Windows
+        return None
+
+def exit_with_parent(parent_pid: int):
+    """
+    Exits the process once its parent (the daemon) is gone, eg. after it was killed, instead of waiting for work forever.
+    """
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(DAEMON_PARENT_POLL_S)
+        os._exit(1)
+    threading.Thread(target=watch, daemon=True).start()
+
+def init_daemon_worker(parent_pid: int):
+    exit_with_parent(parent_pid)
+    # stdout carries the protocol, everything else goes to stderr
+    sys.stdout = sys.stderr
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+def run_daemon(run_job: Callable[[list[str], str, Any], Dict[str, Any]], workers: int, reserved_preview_slots: int = SCHEDULER_RESERVED_PREVIEW_SLOTS, estimate_job: Optional[Callable[[list[str]], Optional[dict]]] = None):
+    """
+    Reads requests from stdin (one JSON object per line) and runs them on a pool of worker processes
+    in the order chosen by the Scheduler.
+
+    Requests use the same format as the batch mode, with an optional "job" id (the request id by default).
+    {"command": "metrics"} prints the scheduler metrics, {"command": "cancel", "id": "..."} cancels a queued
+    or running job and {"command": "shutdown"} (or the end of the input) stops reading, the queued jobs still run.
+    Events are printed to stdout as tagged JSON lines with the job id: QUEUED, STARTED, PROGRESS, MESSAGE,
+    RESULT and METRICS. The RESULT of a failed or cancelled job has the message for the user.
+
+    The web app runs one daemon with MAX_MAPPERS workers, see src/lib/api/execute.ts.
+
+    Parameters
+    ----------
+    run_job : callable
+        Picklable function that runs a request from its command line arguments in a worker process.
+        It gets the job id, a queue for (tag, data) progress events and a shared dict with the ids
+        of the cancelled jobs and returns the result dict.
+    estimate_job : callable, optional
+        Estimates the resource usage of a request from its command line arguments (or returns None).
+        The estimated peak memory of the jobs is admitted against the memory budget of the scheduler.
+    """
+    memory_budget = get_memory_budget() if estimate_job is not None else None
+    scheduler = Scheduler(workers, reserved_preview_slots, memory_bytes=memory_budget)
+    output_lock = threading.Lock()
+
+    def emit(tag: str, data: dict):
+        with output_lock:
+            print_line(tag, data)
+
+    # Workers are started from the dispatch thread, forking while the other threads hold locks can deadlock them
+    mp_context = multiprocessing.get_context('spawn')
+    manager = multiprocessing.managers.SyncManager(ctx=mp_context)
+    manager.start(exit_with_parent, (os.getpid(),))
+    progress_queue = manager.Queue()
+    cancelled_jobs = manager.dict()
+    def create_executor():
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=init_daemon_worker, initargs=(os.getpid(),))
+    executor = create_executor()
+
+    def on_done(job: Job, future: concurrent.futures.Future):
+        scheduler.finish(job)
+        cancelled_jobs.pop(job.id, None)
+        try:
+            result = future.result()
+        except Exception as e:
+            # The worker itself failed (eg. it was killed)
+            result = {'status': 'error', 'error': f'{type(e).__name__}: {e}', 'message': 'Interna napaka'}
+        emit('RESULT', {
+            **result,
+            'id': job.id,
+            'request_type': job.request_type.value,
+            'wait_s': round(job.started - job.enqueued, 3),
+            'total_s': round(time.monotonic() - job.enqueued, 3),
+        })
+
+    def dispatch():
+        nonlocal executor
+        while True:
+            job = scheduler.next_job()
+            if job is None:
+                break
+            emit('STARTED', {'id': job.id, 'request_type': job.request_type.value, 'wait_s': round(job.started - job.enqueued, 3)})
+            try:
+                future = executor.submit(run_job, job.argv, job.id, progress_queue, cancelled_jobs)
+            except concurrent.futures.BrokenExecutor:
+                # A worker died (eg. out of memory), the jobs it shared the pool with have failed already
+                logger.warning('Worker pool is broken, starting a new one.')
+                executor.shutdown(wait=False)
+                executor = create_executor()
+                future = executor.submit(run_job, job.argv, job.id, progress_queue, cancelled_jobs)
+            future.add_done_callback(lambda f, job=job: on_done(job, f))
+
+    def forward_progress():
+        while True:
+            event = progress_queue.get()
+            if event is None:
+                break
+            emit(*event)
+
+    dispatch_thread = threading.Thread(target=dispatch, daemon=True)
+    progress_thread = threading.Thread(target=forward_progress, daemon=True)
+    dispatch_thread.start()
+    progress_thread.start()
+    logger.info(f'Daemon running with {workers} workers ({scheduler.reserved_preview_slots} reserved for previews, memory budget {memory_budget} bytes).')
+
+    for line in sys.stdin:
+        line = line.strip()
+        if line == '':
+            continue
+        job_id = None
+        try:
+            request = json.loads(line)
+            if request.get('command') == 'metrics':
+                emit('METRICS', scheduler.metrics())
+                continue
+            if request.get('command') == 'cancel':
+                job_id = str(request['id'])
+                for job in scheduler.cancel(job_id):
+                    emit('RESULT', {'id': job.id, 'request_type': job.request_type.value, 'status': 'cancelled', 'message': str(ProgressCancelled()), 'wait_s': round(time.monotonic() - job.enqueued, 3)})
+                # Running jobs stop at their next progress update
+                if scheduler.is_running(job_id):
+                    cancelled_jobs[job_id] = True
+                continue
+            if request.get('command') == 'shutdown':
+                break
+            job_id = request.pop('job', None)
+            argv = request_to_argv(request)
+            job = Job(str(job_id) if job_id is not None else get_request_id(argv), get_request_type(argv), argv)
+        except (ValueError, TypeError, AttributeError, KeyError) as e:
+            emit('RESULT', {'id': job_id, 'status': 'error', 'error': f'Invalid request: {e}', 'message': 'Interna napaka'})
+            continue
+        if estimate_job is not None:
+            estimate = estimate_job(argv)
+            if estimate is not None:
+                job.memory_bytes = estimate['peak_memory_bytes']
+        scheduler.submit(job, lambda job, queue_depth: emit('QUEUED', {'id': job.id, 'request_type': job.request_type.value, 'queue_depth': queue_depth}))
+
+    scheduler.close()
+    dispatch_thread.join()
+    executor.shutdown(wait=True)
+    progress_queue.put(None)
+    progress_thread.join()
+    manager.shutdown()
+    emit('METRICS', scheduler.metrics())
@@ -0,0 +1,113 @@
+import concurrent.futures
+import logging
+import threading
+import time
+from typing import Any, Callable, Optional
+from progress import ProgressTracker, NoProgress, ParallelProgress, CancellationToken
+
+### STATIC CONFIGURATION ###
+
+STAGE_MAX_WORKERS = 4 # Number of threads running the independent stages of a request
+
+### /STATIC CONFIGURATION ###
+
+logger = logging.getLogger('create_map.stages')
+
+class Stage:
+    """
+    A step of a request that runs once the stages it depends on are finished.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage, the results of run_stages are stored under it.
+    fn : callable
+        Called with the progress tracker of the stage and the results of the stages in deps (in the same order).
+    deps : list of str
+        Names of the stages whose results the stage needs.
+    progress : tuple (min, max), optional
+        Sub-range of the request progress the stage reports over, stages without it only report messages.
+    """
+    def __init__(self, name: str, fn: Callable[..., Any], deps: list[str] = (), progress: Optional[tuple[float]] = None):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.progress = progress
+
+def run_stages(stages: list[Stage], pt: ProgressTracker = NoProgress, max_workers: int = STAGE_MAX_WORKERS):
+    """
+    Runs the stages on a thread pool, every stage as soon as the stages it depends on are finished,
+    so the duration approaches the longest chain of dependent stages instead of the sum of all stages.
+    Stages must be listed after the stages they depend on.
+
+    When a stage fails, no more stages are started, the running ones are cancelled at their next
+    progress update and the error of the failed stage is raised.
+
+    The result of a stage is released as soon as all the stages depending on it are finished, so large
+    intermediate results (eg. images) are not kept until the end. Returns the results of the stages
+    no other stage depends on, by name.
+    """
+    names = set()
+    for stage in stages:
+        for dep in stage.deps:
+            if dep not in names:
+                raise ValueError(f'Stage {stage.name} depends on {dep}, which is not listed before it')
+        names.add(stage.name)
+
+    failed = threading.Event()
+    parent_token = pt.token
+    token = CancellationToken(lambda: failed.is_set() or (parent_token is not None and parent_token.is_cancelled()), poll_interval=0)
+    progress = ParallelProgress(pt, token)
+    trackers = {stage.name: progress.sub(stage.name, *(stage.progress or ())) for stage in stages}
+
+    dependents = {stage.name: 0 for stage in stages}
+    for stage in stages:
+        for dep in stage.deps:
+            dependents[dep] += 1
+
+    results = {}
+    finished = set()
+    durations = {}
+    error = None
+    start = time.monotonic()
+
+    def run(stage: Stage):
+        stage_start = time.monotonic()
+        result = stage.fn(trackers[stage.name], *(results[dep] for dep in stage.deps))
+        trackers[stage.name].step(1)
+        durations[stage.name] = time.monotonic() - stage_start
+        return result
+
+    pending = list(stages)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='stage') as executor:
+        while len(pending) > 0 or len(running) > 0:
+            if error is None:
+                for stage in [s for s in pending if all(dep in finished for dep in s.deps)]:
+                    pending.remove(stage)
+                    running[executor.submit(run, stage)] = stage
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage.name] = future.result()
+                    finished.add(stage.name)
+                    for dep in stage.deps:
+                        dependents[dep] -= 1
+                        if dependents[dep] == 0:
+                            del results[dep]
+                except BaseException as e:
+                    # Keep the first error, the other stages fail with ProgressCancelled because of it
+                    if error is None:
+                        error = e
+                        failed.set()
+
+            if error is not None and len(running) == 0:
+                break
+
+    if error is not None:
+        raise error
+
+    logger.info(f'Finished {len(stages)} stages in {time.monotonic() - start:.2f}s ({sum(durations.values()):.2f}s of stage time). - ' + ', '.join(f'{name}: {d:.2f}s' for name, d in durations.items()))
+    return results
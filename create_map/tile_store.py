@@ -0,0 +1,329 @@
+import argparse
+import concurrent.futures
+import email.utils
+import hashlib
+import io
+import logging
+import math
+import os
+import re
+import sqlite3
+import sys
+import time
+import mercantile
+import numpy as np
+import requests
+import xyzservices
+import metrics
+from PIL import Image
+from typing import Optional
+from progress import ProgressTracker, NoProgress, ProgressCancelled
+
+### STATIC CONFIGURATION ###
+
+TILE_SIZE = 256 # Size of the tiles of the tile servers in pixels
+TILE_STORE_USER_AGENT = 'Topograf (+https://topograf.scuke.si)' # Sent with every tile request (required by the OSM tile usage policy)
+TILE_STORE_DEFAULT_MAX_AGE = 7 * 24 * 3600 # Expiry of tiles in seconds when the server does not send caching headers
+TILE_STORE_MAX_BYTES = 2 * 1024 * 1024 * 1024 # Size of the (unpinned) tiles in one store before the least recently used tiles are evicted
+TILE_STORE_EVICT_RATIO = 0.8 # Evict tiles until the store is at this fraction of the maximum size
+TILE_STORE_FETCH_WORKERS = 2 # Parallel downloads (the OSM tile usage policy allows 2)
+TILE_STORE_TIMEOUT = 30 # Timeout of a single tile download in seconds
+TILE_STORE_CANCEL_POLL_S = 0.2 # How often cancellation is checked while waiting for downloads
+TILE_STORE_SEED_MAX_TILES = 200000 # Refuse to seed more tiles than this in one run
+SLOVENIA_BOUNDS = (13.375, 45.42, 16.61, 46.88) # (west, south, east, north) in WGS84
+
+### /STATIC CONFIGURATION ###
+
+logger = logging.getLogger('create_map.tile_store')
+
+class TileStore:
+    """
+    Persistent z/x/y tile store for one tile server, kept in an MBTiles (SQLite) file.
+
+    Next to the tile data every tile keeps the ETag and expiry sent by the server and the
+    time of its last access. Expired tiles are revalidated with a conditional request and
+    the least recently used tiles are evicted when the store grows too large. Seeded tiles
+    are pinned: they are always served from the store and never evicted.
+    """
+    def __init__(self, tiles_url: str, path: str):
+        self.tiles_url = tiles_url
+        self.path = path
+        self.provider = xyzservices.TileProvider(url=tiles_url, attribution='', name='url')
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS tiles (
+                zoom_level INTEGER NOT NULL,
+                tile_column INTEGER NOT NULL,
+                tile_row INTEGER NOT NULL,
+                tile_data BLOB NOT NULL,
+                etag TEXT,
+                expires REAL NOT NULL,
+                last_access REAL NOT NULL,
+                pinned INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (zoom_level, tile_column, tile_row)
+            );
+            CREATE INDEX IF NOT EXISTS tiles_last_access ON tiles (pinned, last_access);
+        ''')
+        image_format = 'jpg' if re.search(r'\.jpe?g', tiles_url) else 'png'
+        self.db.executemany('INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)', [
+            ('name', tiles_url),
+            ('format', image_format),
+            ('type', 'baselayer'),
+            ('version', '1.3'),
+        ])
+        self.db.commit()
+
+    @classmethod
+    def open(cls, tiles_url: str, cache_dir: str):
+        url_hash = hashlib.md5(tiles_url.encode('utf-8')).hexdigest()
+        os.makedirs(cache_dir, exist_ok=True)
+        return cls(tiles_url, os.path.join(cache_dir, f'{url_hash}.mbtiles'))
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fetch_tile(self, session: requests.Session, tile: mercantile.Tile, etag: Optional[str]):
+        """
+        Downloads a tile, returns (data, etag, expires). Data is None if the stored tile is still valid (304).
+        """
+        headers = {'If-None-Match': etag} if etag is not None else {}
+        response = session.get(self.provider.build_url(x=tile.x, y=tile.y, z=tile.z), headers=headers, timeout=TILE_STORE_TIMEOUT)
+        if response.status_code == 304:
+            return None, etag, get_expires(response)
+        response.raise_for_status()
+        return response.content, response.headers.get('ETag'), get_expires(response)
+
+    def get_tiles(self, tiles: list[mercantile.Tile], pin: bool = False, pt: ProgressTracker = NoProgress):
+        """
+        Returns a dict with the encoded image of every tile, downloading missing and expired tiles.
+
+        Parameters
+        ----------
+        pin : bool
+            Pin the tiles (used for seeding), pinned tiles are only revalidated when seeding.
+        """
+        pt.step(0)
+        now = time.time()
+        stored = {}
+        for tile in tiles:
+            row = self.db.execute(
+                'SELECT tile_data, etag, expires, pinned FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                (tile.z, tile.x, flip_y(tile))).fetchone()
+            if row is not None:
+                stored[tile] = row
+
+        def needs_fetch(tile):
+            if tile not in stored:
+                return True
+            _, _, expires, pinned = stored[tile]
+            return expires < now and (pin or not pinned)
+
+        to_fetch = [tile for tile in tiles if needs_fetch(tile)]
+        hits = len(tiles) - len(to_fetch)
+        logger.info(f'Tile store: {hits} of {len(tiles)} tiles valid, fetching {len(to_fetch)} ({len(stored) - hits} expired). - ({self.tiles_url})')
+
+        result = {tile: stored[tile][0] for tile in tiles if tile in stored}
+        metrics.cache_lookup('tile_store', True, sum(len(stored[tile][0]) for tile in tiles if not needs_fetch(tile)), hits)
+        fetched_bytes = 0
+        if len(to_fetch) > 0:
+            # The executor is not used as a context manager, leaving it would wait for the running downloads
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=TILE_STORE_FETCH_WORKERS)
+            with requests.Session() as session:
+                session.headers['User-Agent'] = TILE_STORE_USER_AGENT
+                futures = {
+                    executor.submit(self.fetch_tile, session, tile, stored[tile][1] if tile in stored else None): tile
+                    for tile in to_fetch
+                }
+                try:
+                    for i, future in enumerate(self._as_completed(futures, pt)):
+                        pt.step(0.9 * (i + 1) / len(futures))
+                        tile = futures[future]
+                        try:
+                            data, etag, expires = future.result()
+                        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                            if tile not in stored or not is_unavailable(e):
+                                raise
+                            # Offline or the server is unavailable, use the expired tile
+                            logger.warning(f'Using expired tile {tile.z}/{tile.x}/{tile.y} ({e})')
+                            continue
+
+                        if data is None:
+                            data = stored[tile][0]
+                        else:
+                            fetched_bytes += len(data)
+                        result[tile] = data
+                        self.db.execute(
+                            'INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, etag, expires, last_access, pinned) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (tile.z, tile.x, flip_y(tile), data, etag, expires, now, int(pin or (tile in stored and stored[tile][3]))))
+                except ProgressCancelled:
+                    # Keep the tiles fetched so far
+                    self.db.commit()
+                    raise
+                finally:
+                    # All downloads are done unless the loop stopped early, then do not wait for the rest
+                    executor.shutdown(wait=False, cancel_futures=True)
+
+        self.db.executemany(
+            'UPDATE tiles SET last_access = ? WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+            [(now, tile.z, tile.x, flip_y(tile)) for tile in tiles])
+        self.db.commit()
+        logger.info(f'Tile store: fetched {fetched_bytes} bytes. - ({self.tiles_url})')
+        metrics.cache_lookup('tile_store', False, fetched_bytes, len(to_fetch))
+        pt.step(1)
+        return result
+
+    @staticmethod
+    def _as_completed(futures, pt: ProgressTracker):
+        """
+        Yields the futures as they complete, checking for cancellation while waiting
+        (a single slow download can take up to TILE_STORE_TIMEOUT).
+        """
+        pending = set(futures)
+        while len(pending) > 0:
+            pt.check()
+            done, pending = concurrent.futures.wait(pending, timeout=TILE_STORE_CANCEL_POLL_S, return_when=concurrent.futures.FIRST_COMPLETED)
+            yield from done
+
+    def get_mosaic(self, bounds: tuple[float], zoom: int, pt: ProgressTracker = NoProgress):
+        """
+        Stitches the tiles covering the bounds into one image.
+
+        Parameters
+        ----------
+        bounds : tuple (west, south, east, north)
+            The bounds in WGS84.
+
+        Returns the image (rows, cols, RGB) and its extent (left, right, bottom, top) in EPSG:3857.
+        """
+        tiles = list(mercantile.tiles(*bounds, [zoom]))
+        tile_data = self.get_tiles(tiles, pt=pt.sub(0, 0.9))
+
+        min_x = min(t.x for t in tiles)
+        min_y = min(t.y for t in tiles)
+        cols = max(t.x for t in tiles) - min_x + 1
+        rows = max(t.y for t in tiles) - min_y + 1
+
+        mosaic = None
+        for tile in tiles:
+            pt.check()
+            tile_img = np.asarray(Image.open(io.BytesIO(tile_data[tile])).convert('RGB'))
+            h, w = tile_img.shape[:2]
+            if mosaic is None:
+                mosaic = np.zeros((rows * h, cols * w, 3), dtype=np.uint8)
+            x, y = tile.x - min_x, tile.y - min_y
+            mosaic[y * h:(y + 1) * h, x * w:(x + 1) * w] = tile_img
+
+        left, top = mercantile.xy(*mercantile.ul(min_x, min_y, zoom))
+        right, bottom = mercantile.xy(*mercantile.ul(min_x + cols, min_y + rows, zoom))
+        pt.step(1)
+        return mosaic, (left, right, bottom, top)
+
+    def evict(self, max_bytes: int = TILE_STORE_MAX_BYTES):
+        """
+        Removes the least recently used unpinned tiles until the store fits into max_bytes.
+        """
+        total_bytes = self.db.execute('SELECT COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles WHERE pinned = 0').fetchone()[0]
+        if total_bytes <= max_bytes:
+            return
+
+        evict = []
+        for rowid, size in self.db.execute('SELECT rowid, LENGTH(tile_data) FROM tiles WHERE pinned = 0 ORDER BY last_access'):
+            if total_bytes <= max_bytes * TILE_STORE_EVICT_RATIO:
+                break
+            evict.append((rowid,))
+            total_bytes -= size
+
+        self.db.executemany('DELETE FROM tiles WHERE rowid = ?', evict)
+        self.db.commit()
+        logger.info(f'Evicted {len(evict)} tiles from the tile store. - ({self.tiles_url})')
+
+def flip_y(tile: mercantile.Tile):
+    # MBTiles stores rows in the TMS scheme (origin bottom left)
+    return (1 << tile.z) - 1 - tile.y
+
+def get_expires(response: requests.Response):
+    cache_control = response.headers.get('Cache-Control', '')
+    max_age = re.search(r'max-age=(\d+)', cache_control)
+    if max_age is not None:
+        return time.time() + int(max_age.group(1))
+
+    if 'Expires' in response.headers:
+        try:
+            return email.utils.parsedate_to_datetime(response.headers['Expires']).timestamp()
+        except (TypeError, ValueError):
+            pass
+
+    return time.time() + TILE_STORE_DEFAULT_MAX_AGE
+
+def is_unavailable(e: requests.RequestException):
+    """
+    Whether the request failed because the server is unreachable or temporarily unavailable
+    (server errors and rate limiting), so a stored tile can be served instead.
+    """
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and (e.response.status_code >= 500 or e.response.status_code == 429)
+    return True
+
+def get_zoom(bounds: tuple[float], zoom_adjust: int, max_zoom: int):
+    """
+    Picks the zoom level for the bounds (west, south, east, north) in WGS84,
+    the same way contextily does it for bounds2img. Used when the output resolution is not known.
+    """
+    zoom_lon = math.ceil(math.log2(360 * 2.0 / (bounds[2] - bounds[0])))
+    zoom_lat = math.ceil(math.log2(360 * 2.0 / (bounds[3] - bounds[1])))
+    return min(min(zoom_lon, zoom_lat) + zoom_adjust, max_zoom)
+
+def get_resolution(zoom: int, lat: float):
+    """
+    Ground resolution of the tiles at the zoom level and latitude in meters per pixel.
+    """
+    return 2 * math.pi * 6378137 / TILE_SIZE * math.cos(math.radians(lat)) / 2 ** zoom
+
+def get_zoom_for_resolution(target_resolution: float, lat: float, zoom_adjust: int, max_zoom: int):
+    """
+    Picks the zoom level with the resolution closest to the target resolution (meters per output pixel),
+    shifted by zoom_adjust. Each zoom level has 4x the tiles of the previous one, so the closest level
+    is chosen on a logarithmic scale instead of always rounding up to the more detailed one.
+    """
+    zoom = max(0, round(math.log2(get_resolution(0, lat) / target_resolution)))
+    return min(max(zoom + zoom_adjust, 0), max_zoom)
+
+def seed(tiles_url: str, cache_dir: str, zooms: list[int], bounds: tuple[float] = SLOVENIA_BOUNDS):
+    """
+    Downloads and pins all tiles inside the bounds at the given zoom levels, so they can be used offline.
+    """
+    tiles = [tile for zoom in zooms for tile in mercantile.tiles(*bounds, [zoom])]
+    if len(tiles) > TILE_STORE_SEED_MAX_TILES:
+        raise ValueError(f'Too many tiles to seed ({len(tiles)}, max {TILE_STORE_SEED_MAX_TILES})')
+
+    logger.info(f'Seeding {len(tiles)} tiles at zoom levels {zooms}.')
+    with TileStore.open(tiles_url, cache_dir) as store:
+        # Commit in chunks, so an interrupted seed keeps the tiles downloaded so far
+        chunk_size = 1000
+        for i in range(0, len(tiles), chunk_size):
+            store.get_tiles(tiles[i:i + chunk_size], pin=True)
+            logger.info(f'Seeded {min(i + chunk_size, len(tiles))} of {len(tiles)} tiles.')
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+    parser = argparse.ArgumentParser(description="Seed the tile store for offline use")
+    parser.add_argument("--raster_source", type=str, help="Tile server URL", required=True)
+    parser.add_argument("--output_folder", type=str, help="Output folder path", required=True)
+    parser.add_argument("--zoom", type=int, nargs='+', help="Zoom levels to seed", required=True)
+    parser.add_argument("--bounds", type=float, nargs=4, help="Bounds to seed (west south east north in WGS84), defaults to Slovenia", default=SLOVENIA_BOUNDS)
+    args = parser.parse_args()
+
+    seed(args.raster_source, os.path.join(args.output_folder, 'tiles'), args.zoom, tuple(args.bounds))
+
+if __name__ == '__main__':
+    main()
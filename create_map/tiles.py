@@ -0,0 +1,184 @@
+import argparse
+import logging
+import os
+import sys
+import numpy as np
+import mercantile
+import rasterio
+import rasterio.warp
+import rasterio.enums
+import rasterio.transform
+import rasterio.plot
+import shapely
+from PIL import Image
+import dto
+import cache
+import create_map
+import metrics
+from create_map import get_cache_dir, get_cache_index, get_raster_map_bounds, get_raster_epsg
+from progress import ProgressError
+
+### STATIC CONFIGURATION ###
+
+TILE_SIZE = 256 # Size of the rendered tiles in pixels
+TILE_MIN_ZOOM = 8 # Lowest zoom level that is rendered (lower levels would need too many raster files)
+TILE_MAX_ZOOM = 18 # Highest zoom level that is rendered
+TILE_MAX_FILES = 12 # Maximum number of raster files that can be used for a single tile
+TILE_CACHE_MAX_BYTES = 512 * 1024 * 1024 # Size of the tile cache before the least recently used tiles are evicted
+TILE_CACHE_EVICT_RATIO = 0.8 # Evict tiles until the cache is at this fraction of the maximum size
+
+### /STATIC CONFIGURATION ###
+
+logger = logging.getLogger('create_map.tiles')
+
+def get_tile_cache_fn(raster_folder: str, z: int, x: int, y: int):
+    folder_hash = get_cache_index({'raster_folder': os.path.abspath(raster_folder)})
+    return os.path.join(get_cache_dir(f'xyz_tiles/{folder_hash}/{z}/{x}'), f'{y}.png')
+
+def open_raster_for_resolution(fp: str, target_res: float):
+    """
+    Opens the raster file at the coarsest overview level that still has at least the target resolution.
+    Falls back to the full resolution raster if the file has no overviews.
+    """
+    src = rasterio.open(fp)
+    overview_level = None
+    for i, factor in enumerate(src.overviews(1)):
+        if src.res[0] * factor > target_res:
+            break
+        overview_level = i
+
+    if overview_level is None:
+        return src
+
+    src.close()
+    return rasterio.open(fp, overview_level=overview_level)
+
+def render_tile(raster_type: dto.RasterType, raster_folder: str, z: int, x: int, y: int):
+    """
+    Renders a single XYZ (EPSG:3857) tile from the local raster files.
+
+    Returns the tile as an RGBA image, parts of the tile without raster data are transparent.
+    """
+    if not TILE_MIN_ZOOM <= z <= TILE_MAX_ZOOM:
+        raise ProgressError(f'Nivo podrobnosti {z} ni podprt')
+
+    src_crs = f'EPSG:{get_raster_epsg(raster_type)}'
+    tile_bounds = mercantile.xy_bounds(x, y, z)
+    bounds = rasterio.warp.transform_bounds('EPSG:3857', src_crs, *tile_bounds)
+    target_res = (bounds[2] - bounds[0]) / TILE_SIZE
+
+    raster_bounds = get_raster_map_bounds(raster_folder)
+    bbox = shapely.geometry.box(*bounds)
+    selected_files = [
+        os.path.join(raster_folder, filename)
+        for filename, file_bounds in raster_bounds.items()
+        if bbox.intersects(shapely.geometry.box(*file_bounds))
+    ]
+
+    tile = np.zeros((4, TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+    if len(selected_files) > TILE_MAX_FILES:
+        raise ProgressError('Izbrano območje je preveliko')
+
+    dst_transform = rasterio.transform.from_bounds(*tile_bounds, TILE_SIZE, TILE_SIZE)
+    for i, fp in enumerate(selected_files):
+        with open_raster_for_resolution(fp, target_res) as src:
+            rasterio.warp.reproject(
+                source=rasterio.band(src, [1, 2, 3]),
+                destination=tile,
+                src_crs=src.crs or src_crs,
+                dst_transform=dst_transform,
+                dst_crs='EPSG:3857',
+                dst_alpha=4,
+                resampling=rasterio.enums.Resampling.lanczos,
+                init_dest_nodata=(i == 0),
+            )
+
+    logger.info(f'Rendered tile {z}/{x}/{y} from {len(selected_files)} files.')
+    return Image.fromarray(rasterio.plot.reshape_as_image(tile), 'RGBA')
+
+def get_tile(raster_type: dto.RasterType, raster_folder: str, z: int, x: int, y: int):
+    """
+    Returns the path to the cached PNG of the tile, rendering it first if needed.
+    """
+    tile_fn = get_tile_cache_fn(raster_folder, z, x, y)
+    with cache.single_flight(tile_fn, create_map.USE_CACHE) as cached:
+        if cached:
+            # Touch the tile so that eviction keeps recently used tiles
+            os.utime(tile_fn)
+            logger.info(f'Using cached tile. - ({z}/{x}/{y})')
+            metrics.cache_lookup('xyz_tile', True, os.path.getsize(tile_fn))
+            return tile_fn
+
+        tile = render_tile(raster_type, raster_folder, z, x, y)
+        with cache.atomic_write(tile_fn) as f:
+            tile.save(f, format='png', optimize=True)
+        metrics.cache_lookup('xyz_tile', False, os.path.getsize(tile_fn))
+    return tile_fn
+
+def evict_tile_cache(max_bytes: int = TILE_CACHE_MAX_BYTES):
+    """
+    Removes the least recently used tiles until the tile cache fits into the configured size.
+    """
+    tiles = []
+    total_bytes = 0
+    for root, _, files in os.walk(get_cache_dir('xyz_tiles')):
+        for fn in files:
+            if not fn.endswith('.png'):
+                continue
+            fp = os.path.join(root, fn)
+            st = os.stat(fp)
+            tiles.append((st.st_mtime, st.st_size, fp))
+            total_bytes += st.st_size
+
+    if total_bytes <= max_bytes:
+        return
+
+    evicted = 0
+    for _, size, fp in sorted(tiles):
+        if total_bytes <= max_bytes * TILE_CACHE_EVICT_RATIO:
+            break
+        try:
+            os.remove(fp)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        evicted += 1
+
+    logger.info(f'Evicted {evicted} tiles from the tile cache.')
+
+def parse_tile(tile: str):
+    try:
+        z, x, y = (int(p) for p in tile.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid tile "{tile}" (expected z/x/y)')
+    return z, x, y
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+    parser = argparse.ArgumentParser(description="Render XYZ tiles from local raster folders")
+    parser.add_argument("--raster_type", type=str, help="Raster type", required=True)
+    parser.add_argument("--raster_source", type=str, help="Raster source path", required=True)
+    parser.add_argument("--output_folder", type=str, help="Output folder path", required=True)
+    parser.add_argument("tiles", type=parse_tile, nargs='+', help="Tiles to render (z/x/y)")
+    args = parser.parse_args()
+
+    create_map.OUTPUT_DIR = args.output_folder
+    raster_type = dto.RasterType(args.raster_type)
+    metrics.set_default_labels(request_type='tiles')
+
+    failed = False
+    for z, x, y in args.tiles:
+        try:
+            print(f'TILE: {z}/{x}/{y} {get_tile(raster_type, args.raster_source, z, x, y)}')
+        except ProgressError as e:
+            logger.error(e)
+            print(f'ERROR: {z}/{x}/{y} {e}', file=sys.stderr)
+            failed = True
+
+    evict_tile_cache()
+    create_map.flush_metrics()
+    exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -49,6 +49,7 @@ export interface CreateMapBaseRequest {
 
 export interface CreateMapReambulationRequest extends CreateMapBaseRequest { }
 export interface CreateMapPreviewRequest extends CreateMapBaseRequest { }
+export interface CreateMapPrefetchRequest extends CreateMapBaseRequest { }
 export interface CreateMapCreateRequest extends CreateMapBaseRequest {
   target_scale: number;
   edge_wgs84: boolean;
@@ -59,6 +60,8 @@ export interface CreateMapCreateRequest extends CreateMapBaseRequest {
   slikad?: File
   reambulation_layers?: FileList
   control_points: string; // ControlPointsConfig as JSON string
+  variants?: string; // further variants of the map as JSON string (naslov1, naslov2, dodatno and control_points of each)
+  geotiff?: boolean; // also save the map as a tiled GeoTIFF with overviews (map.tif)
 }
 
 function FormatMapBaseRequest(c: CreateMapBaseRequest) {
@@ -83,6 +86,10 @@ export function FormatMapPreviewRequest(c: CreateMapPreviewRequest) {
   return FormatMapBaseRequest(c);
 }
 
+export function FormatMapPrefetchRequest(c: CreateMapPrefetchRequest) {
+  return FormatMapBaseRequest(c);
+}
+
 export function FormatMapCreateRequest(c: CreateMapCreateRequest) {
   const fd = FormatMapBaseRequest(c);
   // Removed debug statement to avoid accidental output in production
@@ -99,5 +106,7 @@ export function FormatMapCreateRequest(c: CreateMapCreateRequest) {
     }
   }
   fd.append('control_points', c.control_points);
+  if (c.variants) fd.append('variants', c.variants);
+  if (c.geotiff) fd.append('geotiff', c.geotiff.toString());
   return fd;
 }
\ No newline at end of file
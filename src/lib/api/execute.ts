@@ -1,10 +1,11 @@
 import { platform } from 'os';
 import fs from 'node:fs';
+import { randomUUID } from 'node:crypto';
+import { createInterface } from 'node:readline';
 import { CREATE_MAP_PY_FOLDER } from '$env/static/private';
 import { MAX_MAPPERS } from '$env/static/private';
-import { spawn } from 'node:child_process';
+import { spawn, type ChildProcessWithoutNullStreams } from 'node:child_process';
 import { ProgressError } from '$lib/api/progress_tracker';
-import pLimit from 'p-limit';
 
 function getPythonBin(venv_folder: string) {
   if (platform() === 'win32') {
@@ -22,67 +23,132 @@ if (!fs.existsSync(script_path)) {
   process.exit(1);
 }
 
-const concurrent_execution_limit = pLimit(parseInt(MAX_MAPPERS) || 2);
+const mappers = parseInt(MAX_MAPPERS) || 2;
 
-export async function runCreateMapPy(request: Object, on_progress: (progress: number) => void, on_message: (message: string) => void, on_error: (error: string) => void) {
-  const with_limit = concurrent_execution_limit(() => new Promise((resolve, reject) => {
-    const args = [script_path, ...Object.entries(request).flatMap((kv) => [`--${kv[0]}`, kv[1]]), '--emit-progress'];
+interface Job {
+  on_progress: (progress: number) => void
+  on_message: (message: string) => void
+  on_error: (error: string) => void
+  resolve: (value: unknown) => void
+  reject: (reason?: any) => void
+  started: boolean
+}
 
-    on_message('Zagon obdelave');
-    const child = spawn(python_bin, args);
+// Jobs sent to the daemon that have no result yet, by job id
+const jobs: Map<string, Job> = new Map();
+let daemon: ChildProcessWithoutNullStreams | undefined;
 
-    child.stdout.on('data', (data) => {
-      const output = data.toString().trim();
-      console.log(output);
-    });
+// create_map.py --daemon schedules the requests on MAX_MAPPERS worker processes (previews first) and
+// reports their events as tagged JSON lines on stdout, see run_daemon in create_map/scheduler.py
+function getDaemon() {
+  if (daemon !== undefined) return daemon;
 
-    let last_error = 'Interna napaka';
-    child.stderr.on('data', (data) => {
-      const output = data.toString();
-      const lines = output.split('\n');
-      let latest_progress;
-      let latest_message;
-      let latest_error;
-      lines.forEach((line: string) => {
-        if (line.length === 0) return;
-        if (line.startsWith('PROGRESS:')) {
-          latest_progress = parseFloat(line.split(' ')[1])
-        }
-        else if (line.startsWith('MESSAGE: ')) {
-          latest_message = line.substring(9);
-        }
-        else if (line.startsWith('ERROR: ')) {
-          latest_error = line.substring(7);
-        }
-        else {
-          console.error(line);
-        }
-      });
-      if (latest_progress !== undefined && on_progress !== undefined) {
-        on_progress(latest_progress)
-      }
-      if (latest_message !== undefined && on_message !== undefined) {
-        on_message(latest_message)
-      }
-      if (latest_error !== undefined && on_error !== undefined) {
-        last_error = latest_error;
-        on_error(latest_error)
-      }
-    });
+  const child = spawn(python_bin, [script_path, '--daemon', '--workers', `${mappers}`]);
+  daemon = child;
 
-    child.on('error', (error) => {
-      console.error(error);
-      reject(error);
-    });
+  createInterface({ input: child.stdout }).on('line', (line) => {
+    const separator = line.indexOf(': ');
+    if (separator < 0) {
+      console.log(line);
+      return;
+    }
+    const tag = line.substring(0, separator);
+    let data;
+    try {
+      data = JSON.parse(line.substring(separator + 2));
+    } catch {
+      console.log(line);
+      return;
+    }
+    const job = jobs.get(data.id);
+    if (job === undefined) return;
 
-    child.on('close', (code) => {
-      if (code === 0) {
-        resolve(code);
+    if (tag === 'QUEUED') {
+      job.on_message('Čakanje na vrsto');
+    }
+    else if (tag === 'STARTED') {
+      job.started = true;
+      job.on_message('Zagon obdelave');
+    }
+    else if (tag === 'PROGRESS') {
+      job.on_progress(data.progress);
+    }
+    else if (tag === 'MESSAGE') {
+      job.on_message(data.message);
+    }
+    else if (tag === 'RESULT') {
+      jobs.delete(data.id);
+      if (data.status === 'ok') {
+        job.resolve(0);
       } else {
-        reject(new ProgressError(last_error));
+        const message = data.message ?? 'Interna napaka';
+        if (data.error !== undefined) console.error(`[${data.id}] ${data.error}`);
+        job.on_error(message);
+        job.reject(new ProgressError(message));
       }
+    }
+  });
+
+  // Logs of the daemon and its workers
+  createInterface({ input: child.stderr }).on('line', (line) => console.error(line));
+
+  const onExit = (reason: string) => {
+    if (daemon !== child) return;
+    console.error(`create_map.py daemon stopped: ${reason}`);
+    // The next request starts a new daemon
+    daemon = undefined;
+    for (const [job_id, job] of jobs) {
+      jobs.delete(job_id);
+      job.on_error('Interna napaka');
+      job.reject(new ProgressError('Interna napaka'));
+    }
+  };
+  child.on('error', (error) => onExit(`${error}`));
+  child.on('close', (code) => onExit(`exit code ${code}`));
+  // The daemon exits once stdin closes, a write after that must not crash the server
+  child.stdin.on('error', (error) => console.error(error));
+
+  return child;
+}
+
+// Prefetching has the lowest priority, it only runs when no request is waiting and a mapper stays free for the next one
+export function isMapperIdle() {
+  let running = 0;
+  for (const job of jobs.values()) {
+    if (!job.started) return false;
+    running++;
+  }
+  return running < Math.max(mappers - 1, 1);
+}
+
+export async function runCreateMapPy(request: Object, on_progress: (progress: number) => void, on_message: (message: string) => void, on_error: (error: string) => void, signal?: AbortSignal) {
+  // The client is gone before the request was sent
+  if (signal?.aborted) {
+    throw new ProgressError('Zahteva je bila preklicana');
+  }
+
+  const job_id = randomUUID();
+  const args = Object.entries(request).flatMap((kv) => [`--${kv[0]}`, `${kv[1]}`]);
+
+  return new Promise((resolve, reject) => {
+    const child = getDaemon();
+
+    // The daemon drops the job if it is still queued, a running job stops at its next progress update
+    const on_abort = () => {
+      if (jobs.has(job_id)) child.stdin.write(JSON.stringify({ command: 'cancel', id: job_id }) + '\n');
+    };
+    signal?.addEventListener('abort', on_abort, { once: true });
+    const cleanup = () => signal?.removeEventListener('abort', on_abort);
+
+    jobs.set(job_id, {
+      on_progress,
+      on_message,
+      on_error,
+      resolve: (value) => { cleanup(); resolve(value); },
+      reject: (reason) => { cleanup(); reject(reason); },
+      started: false,
     });
-  }))
-  on_message('Čakanje na vrsto');
-  return with_limit;
-}
\ No newline at end of file
+    on_message('Čakanje na vrsto');
+    child.stdin.write(JSON.stringify({ job: job_id, args }) + '\n');
+  });
+}
@@ -1,4 +1,4 @@
-import { TEMP_FOLDER, DTK25_FOLDER, DTK50_FOLDER, DTK10_FOLDER, DTK5_FOLDER, DMV125_FOLDER } from "$env/static/private";
+import { TEMP_FOLDER, DTK25_FOLDER, DTK50_FOLDER, DTK10_FOLDER, DTK5_FOLDER, DMV125_FOLDER, CREATE_MAP_PY_FOLDER } from "$env/static/private";
 import fs from "node:fs";
 import { TopoFormData, get_request_id } from "./validation_util";
 import type { PathLike } from "node:fs";
@@ -6,7 +6,10 @@ import type { RasterType } from "./dto"
 import crypto_js from 'crypto-js';
 const { MD5 } = crypto_js;
 
-export type RequestType = 'map_preview' | 'create_map' | 'map_reambulation';
+// Limits shared with create_map.py
+const limits: { map_size_max_m: number, map_size_min_m: number } = JSON.parse(fs.readFileSync(`${CREATE_MAP_PY_FOLDER}/limits.json`, 'utf-8'));
+
+export type RequestType = 'map_preview' | 'create_map' | 'map_reambulation' | 'map_prefetch';
 
 class MapBaseRequest {
   id: string = '';
@@ -53,10 +56,10 @@ class MapBaseRequest {
     })()
     this.map_size_w_m = fd.get_number('map_size_w_m');
     this.map_size_h_m = fd.get_number('map_size_h_m');
-    if (this.map_size_w_m > 1) throw new Error('Velikost karte je prevelika (širina) (max 1m)');
-    if (this.map_size_h_m > 1) throw new Error('Velikost karte je prevelika (višina) (max 1m)');
-    if (this.map_size_w_m < 0.1) throw new Error('Velikost karte je premajhna (širina) (min 0.1m)');
-    if (this.map_size_h_m < 0.1) throw new Error('Velikost karte je premajhna (višina) (min 0.1m)');
+    if (this.map_size_w_m > limits.map_size_max_m) throw new Error(`Velikost karte je prevelika (širina) (max ${limits.map_size_max_m}m)`);
+    if (this.map_size_h_m > limits.map_size_max_m) throw new Error(`Velikost karte je prevelika (višina) (max ${limits.map_size_max_m}m)`);
+    if (this.map_size_w_m < limits.map_size_min_m) throw new Error(`Velikost karte je premajhna (širina) (min ${limits.map_size_min_m}m)`);
+    if (this.map_size_h_m < limits.map_size_min_m) throw new Error(`Velikost karte je premajhna (višina) (min ${limits.map_size_min_m}m)`);
     this.output_folder = TEMP_FOLDER;
     if (!fs.existsSync(this.output_folder)) fs.mkdirSync(this.output_folder, { recursive: true });
   }
@@ -86,6 +89,18 @@ export class MapReambulationRequest extends MapBaseRequest {
   }
 }
 
+export class MapPrefetchRequest extends MapBaseRequest {
+  private constructor(tfd: TopoFormData) {
+    super('map_prefetch', tfd);
+  }
+
+  public static async validate(fd: FormData) {
+    const validated = new MapPrefetchRequest(new TopoFormData(fd));
+    validated.id = get_request_id(validated);
+    return validated;
+  }
+}
+
 export class MapCreateRequest extends MapBaseRequest {
   target_scale: number;
   edge_wgs84: boolean;
@@ -96,6 +111,8 @@ export class MapCreateRequest extends MapBaseRequest {
   slikad: PathLike;
   reambulation_layers: string;
   control_points: string;
+  variants: string;
+  geotiff: boolean;
   dmv125_folder: PathLike;
 
   private constructor(tfd: TopoFormData) {
@@ -122,6 +139,23 @@ export class MapCreateRequest extends MapBaseRequest {
         throw new Error('Kontrolne točke niso v pravilni obliki (JSON)');
       }
     }
+    this.variants = tfd.fd.has('variants') ? tfd.get('variants') : '[]';
+    let variants;
+    try {
+      variants = JSON.parse(this.variants);
+    } catch (error) {
+      throw new Error('Različice karte niso v pravilni obliki (JSON)');
+    }
+    if (!Array.isArray(variants)) throw new Error('Različice karte niso v pravilni obliki (JSON)');
+    if (variants.length > 10) throw new Error('Preveč različic karte (max 10)');
+    for (const variant of variants) {
+      if (typeof variant.naslov1 !== 'string' || typeof variant.naslov2 !== 'string' || typeof variant.dodatno !== 'string') throw new Error('Različice karte niso v pravilni obliki (JSON)');
+      if (variant.naslov1.length > 30) throw new Error('Naslov (1) je predolg (max 30 znakov)');
+      if (variant.naslov2.length > 30) throw new Error('Naslov (2) je predolg (max 30 znakov)');
+      if (variant.dodatno.length > 70) throw new Error('Dodatna vrstica je predolgo (max 70 znakov)');
+      if (!Array.isArray(variant.control_points?.cps)) throw new Error('Kontrolne točke niso v pravilni obliki (JSON)');
+    }
+    this.geotiff = tfd.fd.has('geotiff') && tfd.get('geotiff') === 'true';
     this.dmv125_folder = DMV125_FOLDER;
   }
 
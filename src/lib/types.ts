@@ -20,6 +20,8 @@ export type CreatedMapConf = {
   slikad: string | null;
   map_id: string;
   id: string;
+  variants?: { naslov1: string; naslov2: string; dodatno: string }[];
+  geotiff?: boolean;
 };
 
 export type GetMapOptions = (L: typeof import('leaflet')) => MapOptions;
@@ -61,7 +61,7 @@ export async function POST(event) {
   }
 
   try {
-    await runCreateMapPy(validated, ...pt);
+    await runCreateMapPy(validated, ...pt, request.signal);
     console.log(`[${validated.id}] Map created`);
     return new Response(validated.id);
   } catch (error) {
@@ -0,0 +1,46 @@
+import { RateLimiter } from 'sveltekit-rate-limiter/server';
+import { MapPrefetchRequest } from '$lib/api/validation';
+import { isMapperIdle, runCreateMapPy } from '$lib/api/execute';
+import { dev } from '$app/environment';
+
+const limiter = new RateLimiter({
+  IP: [120, 'h'],
+  IPUA: [20, 'm'],
+});
+
+// Areas prefetched (or being prefetched) since the server started
+const prefetched = new Set<string>();
+
+export async function POST(event) {
+  const { request } = event;
+
+  let validated: MapPrefetchRequest;
+  try {
+    validated = await MapPrefetchRequest.validate(await request.formData());
+  } catch (error) {
+    let error_message = '';
+    if (error instanceof Error) error_message = error.message;
+    else error_message = `${error}`;
+    console.log('Bad request:', error_message);
+    return new Response(error_message, { status: 400 });
+  }
+
+  // Nothing to prefetch without a raster, for areas already prefetched or when the mappers are busy
+  if (validated.raster_source === '' || prefetched.has(validated.id) || !isMapperIdle()) {
+    return new Response(null, { status: 204 });
+  }
+
+  if (await limiter.isLimited(event)) {
+    if (dev) console.log('Rate limited');
+    else return new Response(null, { status: 204 });
+  }
+
+  console.log(`[${validated.id}] Request for map prefetch`);
+  prefetched.add(validated.id);
+
+  // The client does not wait for the prefetch, the preview of the area waits for the cache instead
+  runCreateMapPy(validated, () => {}, () => {}, () => {}).catch(() => {
+    prefetched.delete(validated.id);
+  });
+  return new Response(null, { status: 202 });
+}
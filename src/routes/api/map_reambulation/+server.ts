@@ -61,7 +61,7 @@ export async function POST(event) {
   }
 
   try {
-    await runCreateMapPy(validated, ...pt);
+    await runCreateMapPy(validated, ...pt, request.signal);
     const png = await fs.promises.readFile(output_file);
     return new Response(png, { headers: { 'Content-Type': 'application/zip' } });
   } catch (error) {
@@ -21,5 +21,9 @@ export const load = (async (event) => {
 
   const map_config = JSON.parse((await fs.promises.readFile(`${map_path}/conf.json`)).toString()) as CreatedMapConf;
   const map_cp_report_exists = fs.existsSync(`${map_path}/cp_report.pdf`)
-  return { request_origin, map_config, map_cp_report_exists };
+  // The GeoTIFFs of all variants are saved together with their maps
+  const map_geotiff_exists = fs.existsSync(`${map_path}/map.tif`)
+  // Variants are numbered from 1 (map-1.pdf, cp_report-1.pdf, ...)
+  const variant_cp_reports_exist = (map_config.variants ?? []).map((_, i) => fs.existsSync(`${map_path}/cp_report-${i + 1}.pdf`));
+  return { request_origin, map_config, map_cp_report_exists, map_geotiff_exists, variant_cp_reports_exist };
 }) satisfies PageServerLoad;
\ No newline at end of file
@@ -20,20 +20,44 @@ export async function GET(event) {
     return new Response('File not found', { status: 404 });
   }
 
-  const file_stream = fs.createReadStream(file_path_abs);
   const content_type = (() => {
     if (file_name.endsWith('.pdf')) return 'application/pdf';
     if (file_name.endsWith('.json')) return 'application/json';
     if (file_name.endsWith('.png')) return 'image/png';
     if (file_name.endsWith('.webp')) return 'image/webp';
+    if (file_name.endsWith('.tif')) return 'image/tiff';
     return 'application/octet-stream';
   })();
 
+  // Single byte ranges, so tiles and overviews of GeoTIFFs can be read without downloading the whole file
+  // (other requests, also with several ranges, get the whole file)
+  const file_size = fs.statSync(file_path_abs).size;
+  const range = /^bytes=(\d*)-(\d*)$/.exec(event.request.headers.get('range') ?? '');
+  if (range && (range[1] !== '' || range[2] !== '')) {
+    const start = range[1] === '' ? Math.max(file_size - Number(range[2]), 0) : Number(range[1]);
+    const end = range[1] === '' || range[2] === '' ? file_size - 1 : Math.min(Number(range[2]), file_size - 1);
+    if (start > end || start >= file_size) {
+      return new Response('Range not satisfiable', { status: 416, headers: { 'Content-Range': `bytes */${file_size}` } });
+    }
+    const file_stream = fs.createReadStream(file_path_abs, { start, end });
+    return new Response(Readable.toWeb(file_stream) as ReadableStream, {
+      status: 206,
+      headers: {
+        'Content-Type': content_type,
+        'Content-Length': (end - start + 1).toString(),
+        'Content-Range': `bytes ${start}-${end}/${file_size}`,
+        'Accept-Ranges': 'bytes',
+      },
+    });
+  }
+
+  const file_stream = fs.createReadStream(file_path_abs);
   const readable = Readable.toWeb(file_stream) as ReadableStream;
   return new Response(readable, {
     headers: {
       'Content-Type': content_type,
+      'Content-Length': file_size.toString(),
+      'Accept-Ranges': 'bytes',
     },
   });
 }
-